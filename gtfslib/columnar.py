@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#    This file is part of Gtfslib-python.
+#
+#    Gtfslib-python is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Gtfslib-python is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with gtfslib-python.  If not, see <http://www.gnu.org/licenses/>.
+"""
+@author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
+"""
+from array import array
+
+from sqlalchemy.types import Boolean, Float, Integer
+try:
+    # Optional, columns are returned as numpy arrays if available
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    # 64-bit integers: 'l' is only 32-bit on Windows, and 'q' missing on Python 2
+    _INT_TYPECODE = array('q').typecode
+except ValueError:
+    _INT_TYPECODE = 'l'
+
+
+class DictionaryColumn(object):
+    """
+    A dictionary-encoded column, for IDs and other repeated values: the value
+    of row i is values[codes[i]]. codes is an integer array, values the list
+    of distinct values (None included), in order of first appearance.
+    """
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    def __iter__(self):
+        values = self.values
+        return (values[code] for code in self.codes)
+
+    def decode(self):
+        """Return the values of all rows, as a list."""
+        return list(self)
+
+    def __repr__(self):
+        return "<%s(%d rows, %d values)>" % (self.__class__.__name__, len(self.codes), len(self.values))
+
+
+class _ColumnBuilder(object):
+    """Accumulate the values of a column: integers and booleans (as 0/1) in a
+       64-bit integer array, switched to a 'd' array with NaN for NULLs if any; floats
+       in a 'd' array, with NaN for NULLs; anything else dictionary-encoded."""
+
+    def __init__(self, column_type):
+        if isinstance(column_type, (Integer, Boolean)):
+            self._data = array(_INT_TYPECODE)
+            self._encoded = False
+        elif isinstance(column_type, Float):
+            self._data = array('d')
+            self._encoded = False
+        else:
+            self._data = array(_INT_TYPECODE)
+            self._encoded = True
+            self._codes = {}
+            self._values = []
+
+    def append(self, value):
+        if self._encoded:
+            code = self._codes.get(value)
+            if code is None:
+                code = self._codes[value] = len(self._values)
+                self._values.append(value)
+            self._data.append(code)
+        elif value is None:
+            if self._data.typecode == _INT_TYPECODE:
+                self._data = array('d', self._data)
+            self._data.append(float('nan'))
+        else:
+            self._data.append(value)
+
+    def build(self):
+        data = self._data
+        if numpy is not None:
+            data = numpy.frombuffer(data, dtype=numpy.dtype(data.typecode)) if len(data) else numpy.array([], dtype=data.typecode)
+        if self._encoded:
+            return DictionaryColumn(data, self._values)
+        return data
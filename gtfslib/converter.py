@@ -16,18 +16,43 @@
 """
 @author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
 """
+import hashlib
 import logging
+import multiprocessing
+from collections import defaultdict
 
-from gtfslib.model import Agency, FeedInfo, Route, Calendar, CalendarDate, Stop, \
-    Trip, StopTime, Transfer, Shape, ShapePoint, Zone, FareAttribute, FareRule
-from gtfslib.spatial import DistanceCache, orthodromic_distance,\
-    orthodromic_seg_distance
+from sqlalchemy import inspect
+from sqlalchemy.orm import object_mapper
+
+from gtfslib.csvgtfs import parse_chunk
+from gtfslib.model import Agency, FeedInfo, Route, Calendar, CalendarDate, DateBitmap, Stop, \
+    Trip, StopTime, Transfer, Shape, ShapePoint, Zone, FareAttribute, FareRule, Frequency
+from gtfslib.spatial import DistanceCache, SegmentIndex, orthodromic_seg_distance,\
+    cumulative_orthodromic_distances
 from gtfslib.utils import timing, fmttime, ContinousPiecewiseLinearFunc
 
 logger = logging.getLogger('libgtfs')
 
 DOW_NAMES = { 0: 'monday', 1: 'tuesday', 2: 'wednesday', 3: 'thursday', 4: 'friday', 5: 'saturday', 6: 'sunday' }
 
+# Column order of the plain tuples used for core-level bulk inserts
+_SHAPE_COLUMNS = ('feed_id', 'shape_id')
+_STOP_COLUMNS = ('feed_id', 'stop_id', 'parent_station_id', 'location_type', 'stop_name', 'stop_lat', 'stop_lon',
+                 'wheelchair_boarding', 'stop_code', 'stop_desc', 'zone_id', 'stop_url', 'stop_timezone')
+_CALENDAR_DATE_COLUMNS = ('feed_id', 'service_id', 'date')
+_TRIP_COLUMNS = ('feed_id', 'trip_id', 'route_id', 'service_id', 'shape_id', 'wheelchair_accessible', 'bikes_allowed',
+                 'exact_times', 'frequency_generated', 'trip_headsign', 'trip_short_name', 'direction_id', 'block_id')
+_SHAPE_POINT_COLUMNS = ('feed_id', 'shape_id', 'shape_pt_sequence', 'shape_pt_lat', 'shape_pt_lon', 'shape_dist_traveled')
+_STOP_TIME_COLUMNS = ('feed_id', 'trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time',
+                      'shape_dist_traveled', 'interpolated', 'timepoint', 'pickup_type', 'drop_off_type', 'stop_headsign')
+_FREQUENCY_COLUMNS = ('feed_id', 'trip_id', 'start_time', 'end_time', 'headway_secs', 'exact_times')
+# Columns read from the GTFS files for the largest tables
+_GTFS_SHAPE_COLUMNS = ('shape_id', 'shape_pt_sequence', 'shape_pt_lat', 'shape_pt_lon', 'shape_dist_traveled')
+_GTFS_STOP_TIME_COLUMNS = ('trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time',
+                           'shape_dist_traveled', 'pickup_type', 'drop_off_type', 'stop_headsign')
+# Checkpointed imports commit normalized trips by batches of (at least) this size
+_CHECKPOINT_TRIPS = 10000
+
 def _toint(s, default_value=None):
     if s is None or len(s) == 0:
         if default_value is None:
@@ -55,6 +80,96 @@ def _todate(s, default_value=None):
         return default_value
     return CalendarDate.fromYYYYMMDD(s).as_date()
 
+def _astuple(obj, columns):
+    # Unset or non-mapped fields are stored as NULL
+    return tuple(getattr(obj, column, None) for column in columns)
+
+def _asdict(row, columns):
+    # For error reporting only
+    return dict(zip(columns, row))
+
+def _convert_stop_time(stoptime):
+    # Input in _GTFS_STOP_TIME_COLUMNS order, output the same
+    # typed values with the "interpolated" flag appended
+    trip_id, stop_id, stopseq, arrtime, deptime, shpdist, pkptype, drptype, headsign = stoptime
+    stopseq = _toint(stopseq)
+    # Mark times to interpolate later on 
+    arrtime = _timetoint(arrtime, -999999)
+    deptime = _timetoint(deptime, -999999)
+    if arrtime == -999999:
+        arrtime = deptime
+    if deptime == -999999:
+        deptime = arrtime
+    interp = arrtime < 0 and deptime < 0
+    shpdist = _tofloat(shpdist, -999999)
+    pkptype = _toint(pkptype, StopTime.PICKUP_DROPOFF_REGULAR)
+    drptype = _toint(drptype, StopTime.PICKUP_DROPOFF_REGULAR)
+    return (trip_id, stop_id, stopseq, arrtime, deptime, shpdist, pkptype, drptype, headsign, interp)
+
+def _convert_stop_times_chunk(chunk):
+    # Run in a worker process: must be a module-level function
+    header, lines = chunk
+    return [ _convert_stop_time(stoptime) for stoptime in parse_chunk(header, lines, _GTFS_STOP_TIME_COLUMNS) ]
+
+def _converted_stop_times(gtfs, jobs):
+    if jobs <= 1:
+        for stoptime in gtfs.stop_times(columns=_GTFS_STOP_TIME_COLUMNS):
+            yield _convert_stop_time(stoptime)
+        return
+    # Chunks are parsed out of order but collected in order: the output
+    # does not depend on the number of jobs.
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for stoptimes in pool.imap(_convert_stop_times_chunk, gtfs.chunks('stop_times.txt')):
+            for stoptime in stoptimes:
+                yield stoptime
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+class _ShapeRecord(object):
+    """Lightweight in-memory shape, used during import and normalization."""
+    __slots__ = ('shape_id', 'points')
+
+    def __init__(self, shape_id):
+        self.shape_id = shape_id
+        self.points = []
+
+class _ShapePointRecord(object):
+    """Lightweight in-memory shape point, used during import and normalization."""
+    __slots__ = ('shape_pt_sequence', 'shape_pt_lat', 'shape_pt_lon', 'shape_dist_traveled')
+
+    def __init__(self, shape_pt_sequence, shape_pt_lat, shape_pt_lon, shape_dist_traveled):
+        self.shape_pt_sequence = shape_pt_sequence
+        self.shape_pt_lat = shape_pt_lat
+        self.shape_pt_lon = shape_pt_lon
+        self.shape_dist_traveled = shape_dist_traveled
+
+    def lat(self):
+        return self.shape_pt_lat
+
+    def lon(self):
+        return self.shape_pt_lon
+
+class _StopTimeRecord(object):
+    """Lightweight in-memory stop time, used during import and normalization.
+       The trip ID is not stored, stop times are grouped by trip."""
+    __slots__ = ('stop', 'stop_sequence', 'arrival_time', 'departure_time', 'shape_dist_traveled',
+                 'interpolated', 'pickup_type', 'drop_off_type', 'stop_headsign')
+
+    def __init__(self, stop, stop_sequence, arrival_time, departure_time, shape_dist_traveled,
+                 interpolated, pickup_type, drop_off_type, stop_headsign):
+        self.stop = stop
+        self.stop_sequence = stop_sequence
+        self.arrival_time = arrival_time
+        self.departure_time = departure_time
+        self.shape_dist_traveled = shape_dist_traveled
+        self.interpolated = interpolated
+        self.pickup_type = pickup_type
+        self.drop_off_type = drop_off_type
+        self.stop_headsign = stop_headsign
+
 class _CacheEntry(object):
 
     def __init__(self, distance):
@@ -79,8 +194,13 @@ class _OdometerShape(object):
     # is 2 * arctan(K).
     K = 0.001
 
+    # Shapes with at least this number of points use a spatial
+    # segment index to snap stops, smaller ones a linear scan.
+    MIN_INDEXED_POINTS = 100
+
     def __init__(self, shape):
         self._shape = shape
+        self._index = None
         self._cache = _CacheEntry(None)
         self._cache_hit = 0
         self._cache_miss = 0
@@ -91,23 +211,16 @@ class _OdometerShape(object):
         # Normalize the shape here:
         # 1) dist_traveled to meters
         # 2) pt_seq to contiguous numbering from 0
-        ptseq = 0
-        distance_meters = 0.0
-        last_pt = None
+        # Note: we do not use distance cache, as most probably
+        # many of the points will be different from each other.
         shape.points.sort(key=lambda p: p.shape_pt_sequence)
-        for pt in shape.points:
-            if last_pt is not None:
-                # Note: we do not use distance cache, as most probably
-                # many of the points will be different from each other.
-                distance_meters += orthodromic_distance(last_pt, pt)
-            last_pt = pt
+        distances = cumulative_orthodromic_distances(shape.points)
+        if self._xdist is not None:
+            # Remember the distance mapping for stop times
+            self._xdist.extend([ pt.shape_dist_traveled for pt in shape.points ], distances)
+        for ptseq, (pt, distance_meters) in enumerate(zip(shape.points, distances)):
             pt.shape_pt_sequence = ptseq
-            old_distance = pt.shape_dist_traveled
             pt.shape_dist_traveled = distance_meters
-            # Remember the distance mapping for stop times
-            if self._xdist:
-                self._xdist.append(old_distance, pt.shape_dist_traveled)
-            ptseq += 1
 
     def reset(self):
         self._distance = 0
@@ -130,26 +243,7 @@ class _OdometerShape(object):
                 self._cache_cursor = cache_entry
                 self._cache_hit += 1
                 return cache_entry.distance()
-            min_dist = 1e20
-            best_i = self._istart
-            best_dist = 0
-            for i in range(self._istart, len(self._shape.points) - 1):
-                a = self._shape.points[i]
-                b = self._shape.points[i+1]
-                dist, pdist = orthodromic_seg_distance(stop, a, b)
-                newdist = a.shape_dist_traveled + pdist
-                howfar = newdist - self._distance
-                # Add a slight "cone" offset. There are pathological
-                # cases with backtracking shapes where the best distance
-                # is slightly better way further (for eg 0.01m) than at
-                # the starting point (for eg 0.02m). In that case we should
-                # obviously keep the first point instead of moving too fast
-                # to the shape end. That offset should help for some cases.
-                dist += howfar * self.K
-                if dist < min_dist:
-                    min_dist = dist
-                    best_i = i
-                    best_dist = newdist
+            best_i, best_dist = self._closest_segment(stop)
             if best_dist > self._distance:
                 self._distance = best_dist
             else:
@@ -164,6 +258,53 @@ class _OdometerShape(object):
             self._cache_cursor = self._cache_cursor.insert(stop, self._distance)
             return self._distance
 
+    def _segment_cost(self, stop, i):
+        a = self._shape.points[i]
+        b = self._shape.points[i+1]
+        dist, pdist = orthodromic_seg_distance(stop, a, b)
+        newdist = a.shape_dist_traveled + pdist
+        howfar = newdist - self._distance
+        # Add a slight "cone" offset. There are pathological
+        # cases with backtracking shapes where the best distance
+        # is slightly better way further (for eg 0.01m) than at
+        # the starting point (for eg 0.02m). In that case we should
+        # obviously keep the first point instead of moving too fast
+        # to the shape end. That offset should help for some cases.
+        return dist + howfar * self.K, newdist
+
+    def _closest_segment(self, stop):
+        """Return the index of the best segment for the stop, starting from
+           the current one, and the distance along the shape of the stop
+           projection on it. For ties, the first segment wins."""
+        points = self._shape.points
+        min_dist = 1e20
+        best_i = self._istart
+        best_dist = 0
+        if len(points) < self.MIN_INDEXED_POINTS:
+            for i in range(self._istart, len(points) - 1):
+                dist, newdist = self._segment_cost(stop, i)
+                if dist < min_dist:
+                    min_dist = dist
+                    best_i = i
+                    best_dist = newdist
+            return best_i, best_dist
+        if self._index is None:
+            self._index = SegmentIndex(points)
+        # Any segment after the current one is at least that far along
+        # the shape, this bounds the cone offset from below.
+        slack = (self._distance - points[self._istart].shape_dist_traveled) * self.K
+        for lower_bound, segments in self._index.segments_by_distance(stop, self._istart):
+            if lower_bound - slack > min_dist:
+                # No remaining segment can be better
+                break
+            for i in segments:
+                dist, newdist = self._segment_cost(stop, i)
+                if dist < min_dist or (dist == min_dist and i < best_i):
+                    min_dist = dist
+                    best_i = i
+                    best_dist = newdist
+        return best_i, best_dist
+
     def _debug_cache(self):
         logger.debug("Shape %s: Cache hit: %d, misses: %d" % (self._shape.shape_id, self._cache_hit, self._cache_miss))
 
@@ -197,14 +338,269 @@ class _Odometer(object):
         self._last_stop = stop
         return self._distance
 
+    def snaps_all(self, old_dists_traveled):
+        """Return True if all stops would be snapped on the current shape,
+           that is if none of the original shape_dist_traveled is used."""
+        if self._odoshp is None:
+            return False
+        return self._odoshp._xdist is None or not any(old_dists_traveled)
+
     def _debug_cache(self):
         self._odoshp._debug_cache()
 
+class _ReplayOdometer(object):
+    """An odometer replaying distances computed beforehand, in order."""
+
+    def __init__(self, distances):
+        self._distances = distances
+        self._i = 0
+
+    def reset(self):
+        self._i = 0
+
+    def dist_traveled(self, stop, old_dist_traveled):
+        distance = self._distances[self._i]
+        self._i += 1
+        return distance
+
+class _SnappingCache(object):
+    """Persistent stop-to-shape snapping cache, stored in the database.
+       Entries are keyed by the hash of the shape geometry and the hash of
+       the sequence of stop coordinates, which fully determine the result."""
+
+    # Change this if the snapping algorithm results change
+    VERSION = 1
+
+    def __init__(self, dao):
+        self._dao = dao
+        self.hits = 0
+        self.misses = 0
+
+    def load_shape(self, shape):
+        h = hashlib.sha1()
+        h.update(("v%d;%r;" % (self.VERSION, _OdometerShape.K)).encode('ascii'))
+        for pt in shape.points:
+            h.update(("%r,%r;" % (pt.shape_pt_lat, pt.shape_pt_lon)).encode('ascii'))
+        self._shape_hash = h.hexdigest()
+        self._entries = self._dao.snapping_cache(self._shape_hash)
+        self._new_entries = {}
+
+    def pattern_hash(self, stop_times):
+        h = hashlib.sha1()
+        for stoptime in stop_times:
+            h.update(("%r,%r;" % (stoptime.stop.stop_lat, stoptime.stop.stop_lon)).encode('ascii'))
+        return h.hexdigest()
+
+    def get(self, pattern_hash):
+        distances = self._entries.get(pattern_hash)
+        if distances is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return distances
+
+    def put(self, pattern_hash, distances):
+        self._entries[pattern_hash] = distances
+        self._new_entries[pattern_hash] = distances
+
+    def store_shape(self):
+        self._dao.store_snapping_cache(self._shape_hash, self._new_entries)
+        self._new_entries = {}
+
+class _FeedSync(object):
+    """
+    Apply a new version of a feed as a difference against the stored one,
+    for incremental reloads. Small entities are merged on their primary key,
+    and the stored ones absent from the new version deleted at the end.
+    Trips (with their stop times and frequencies), shapes and calendars are
+    compared using hashes of their source data, stored with the feed.
+    """
+
+    # Entities merged through the ORM, in deletion order
+    MERGED_CLASSES = (Route, FareAttribute, Calendar, Zone, Agency, FeedInfo)
+
+    def __init__(self, dao, feed_id, settings):
+        self._dao = dao
+        self._feed_id = feed_id
+        # Changing the import settings invalidates all hashes
+        self._salt = repr(settings)
+        self._old_hashes = dao.entity_hashes(feed_id)
+        if not self._old_hashes and dao.feed(feed_id) is not None:
+            logger.warning("No hashes stored for feed ID '%s', reloading it completely" % feed_id)
+            dao.delete_feed(feed_id)
+            dao.flush()
+        self._new_hashes = {}
+        # Preload existing entities, merging will then update them in place
+        self._unmerged = {}
+        for clazz in self.MERGED_CLASSES:
+            for obj in dao.session().query(clazz).filter(clazz.feed_id == feed_id):
+                self._unmerged[id(obj)] = obj
+        self._rows = {}
+
+    def add(self, obj):
+        # Reset columns not set, they may have been before
+        for prop in object_mapper(obj).column_attrs:
+            if prop.key not in vars(obj):
+                setattr(obj, prop.key, None)
+        self._unmerged.pop(id(self._dao.merge(obj)), None)
+
+    def upsert(self, clazz, columns, rows):
+        # Rows are keyed on their 2 first columns (feed and entity IDs)
+        existing = self._rows.get(clazz)
+        if existing is None:
+            existing = self._rows[clazz] = { row[:2]: row for row in self._dao.feed_rows(clazz, columns, self._feed_id) }
+        self._dao.bulk_insert(clazz, columns, [ row for row in rows if row[:2] not in existing ])
+        self._dao.bulk_update(clazz, columns, [ row for row in rows if row[:2] in existing and existing[row[:2]] != row ])
+        for row in rows:
+            existing[row[:2]] = None
+        self._dao.flush()
+
+    def clear(self, clazz):
+        self._dao.bulk_delete(clazz, ('feed_id',), [ (self._feed_id,) ])
+
+    def hash(self, data):
+        return hashlib.sha1((self._salt + repr(data)).encode('utf-8')).hexdigest()
+
+    def changed(self, kind, entity_id, data):
+        """Register the source data of an entity, return True if it is new or changed."""
+        h = self.hash(data)
+        self._new_hashes[(kind, entity_id)] = h
+        return self._old_hashes.get((kind, entity_id)) != h
+
+    def existed(self, kind, entity_id):
+        return (kind, entity_id) in self._old_hashes
+
+    def removed(self, kind):
+        return [ entity_id for (kind2, entity_id) in self._old_hashes
+                 if kind2 == kind and (kind2, entity_id) not in self._new_hashes ]
+
+    def finish(self):
+        """Delete removed entities, once no longer referenced, and store hashes."""
+        feed_id = self._feed_id
+        removed_calendars = [ (feed_id, service_id) for service_id in self.removed('calendar') ]
+        if not self._dao.compact_calendars():
+            self._dao.bulk_delete(CalendarDate, ('feed_id', 'service_id'), removed_calendars)
+        removed_shapes = [ (feed_id, shape_id) for shape_id in self.removed('shape') ]
+        self._dao.bulk_delete(ShapePoint, ('feed_id', 'shape_id'), removed_shapes)
+        self._dao.bulk_delete(Shape, ('feed_id', 'shape_id'), removed_shapes)
+        # Stops before stations
+        removed_stops = [ row for row in self._rows.get(Stop, {}).values() if row is not None ]
+        removed_stops.sort(key=lambda row: row[_STOP_COLUMNS.index('location_type')])
+        for clazz in self.MERGED_CLASSES:
+            if clazz is Zone:
+                self._dao.bulk_delete(Stop, ('feed_id', 'stop_id'), [ row[:2] for row in removed_stops ])
+            objs = [ obj for obj in self._unmerged.values() if isinstance(obj, clazz) ]
+            if not objs:
+                continue
+            # Identity keys do not need loading expired instances
+            keys = [ inspect(obj).identity for obj in objs ]
+            for obj in objs:
+                self._dao.session().expunge(obj)
+            self._dao.bulk_delete(clazz, [ column.name for column in object_mapper(objs[0]).primary_key ], keys)
+        changed = { key: h for key, h in self._new_hashes.items() if self._old_hashes.get(key) != h }
+        removed = [ key for key in self._old_hashes if key not in self._new_hashes ]
+        self._dao.update_entity_hashes(changed, removed, feed_id)
+        logger.info("Incremental reload: %d new or changed, %d removed hashed entities" % (len(changed), len(removed)))
+
+class _Checkpoints(object):
+    """
+    Commit each phase of an import separately, recording the progress in the
+    database, so that an interrupted import can be resumed. When resuming,
+    phases already committed are replayed without writing anything, as the
+    following ones depend on their in-memory state. Stands for the DAO during
+    the import: write methods are skipped while replaying, and only
+    checkpoints commit.
+    """
+
+    PHASES = ('feedinfo', 'agencies', 'stops', 'transfers', 'routes', 'fares', 'calendars', 'shapes', 'trips',
+              'normalization', 'frequencies')
+    WRITE_METHODS = ('add', 'add_all', 'bulk_insert', 'bulk_update', 'bulk_delete', 'delete_trips', 'expand_frequencies')
+
+    def __init__(self, dao, feed_id, source_digest, resume):
+        self._dao = dao
+        self._feed_id = feed_id
+        self._source_digest = source_digest
+        state = dao.loader_state(feed_id) if resume else None
+        if state is None:
+            if resume:
+                logger.warning("No import of feed ID '%s' to resume, starting over" % feed_id)
+            phase, progress = self.PHASES[0], 0
+            dao.store_loader_state(source_digest, phase, progress, feed_id)
+            dao.commit()
+        else:
+            digest, phase, progress = state
+            if digest != source_digest:
+                raise ValueError("Import of feed ID '%s' was started from another file, cannot resume it" % feed_id)
+            logger.info("Resuming import of feed ID '%s' at phase '%s' (%d)" % (feed_id, phase, progress))
+        self._resume_phase = self.PHASES.index(phase)
+        self._resume_progress = progress
+        self._phase = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._dao, name)
+        if name not in self.WRITE_METHODS:
+            return attr
+        def write(*args, **kwargs):
+            if not self.replaying():
+                return attr(*args, **kwargs)
+        return write
+
+    def commit(self):
+        # Only checkpoints commit
+        pass
+
+    def begin(self, phase):
+        """Checkpoint the phase in progress, and start the given one."""
+        self._checkpoint(self.PHASES.index(phase), 0)
+        if self.replaying():
+            logger.info("Phase '%s' already imported, replaying it" % phase)
+
+    def replaying(self):
+        return self._phase < self._resume_phase
+
+    def progress(self):
+        """Return the units of work of the current phase committed by a previous import."""
+        return self._resume_progress if self._phase == self._resume_phase else 0
+
+    def advance(self, progress):
+        """Checkpoint the current phase, after the given number of units of work."""
+        self._checkpoint(self._phase, progress)
+
+    def finish(self):
+        self._dao.flush()
+        self._dao.clear_loader_state(self._feed_id)
+        self._dao.commit()
+
+    def _checkpoint(self, phase, progress):
+        self._phase = phase
+        if (phase, progress) <= (self._resume_phase, self._resume_progress):
+            # Nothing written since the resumed checkpoint
+            return
+        self._dao.flush()
+        self._dao.store_loader_state(self._source_digest, self.PHASES[phase], progress, self._feed_id)
+        self._dao.commit()
+
 @timing
-def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization=False):
+def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization=False, snapping_cache=False, jobs=1,
+                        lazy_frequencies=False, incremental=False, checkpointed=False, resume=False, source_digest=None,
+                        metrics=None):
     
     feedinfo2 = None
     logger.info("Importing feed ID '%s'" % feed_id)
+    # In incremental mode, only differences with the stored feed are written
+    sync = _FeedSync(dao, feed_id, (disable_normalization, lazy_frequencies)) if incremental else None
+    checkpoints = _Checkpoints(dao, feed_id, source_digest, resume) if checkpointed else None
+    if checkpoints is not None:
+        dao = checkpoints
+    def begin_phase(phase):
+        if checkpoints is not None:
+            checkpoints.begin(phase)
+        if metrics is not None:
+            metrics.begin_phase(phase)
+    if metrics is not None:
+        metrics.begin_phase('feedinfo')
+    dao.create_partitions(feed_id)
+    add = dao.add if sync is None else sync.add
     n_feedinfo = 0
     for feedinfo in gtfs.feedinfo():
         n_feedinfo += 1
@@ -218,10 +614,11 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
     if feedinfo2 is None:
         # Optional, generate empty feed info
         feedinfo2 = FeedInfo(feed_id)
-    dao.add(feedinfo2)
+    add(feedinfo2)
     dao.flush()
     logger.info("Imported %d feedinfo" % n_feedinfo)
 
+    begin_phase('agencies')
     logger.info("Importing agencies...")
     n_agencies = 0
     single_agency = None
@@ -236,18 +633,18 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
         else:
             single_agency = None
         n_agencies += 1
-        dao.add(agency2)
+        add(agency2)
         agency_ids.add(agency2.agency_id)
     dao.flush()
     logger.info("Imported %d agencies" % n_agencies)
 
-    def import_stop(stop, stoptype, zone_ids, item_ids, station_ids=None):
+    def import_stop(stop, stoptype, zone_ids, items, stops_q, stations2=None):
         zone_id = stop.get('zone_id')
         if zone_id and zone_id not in zone_ids:
             # Lazy-creation of zone
             zone = Zone(feed_id, zone_id)
             zone_ids.add(zone_id)
-            dao.add(zone)
+            add(zone)
         stop['location_type'] = _toint(stop.get('location_type'), Stop.TYPE_STOP)
         if stop['location_type'] != stoptype:
             return 0
@@ -268,7 +665,7 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
         # This field has been renamed for consistency
         parent_id = stop.get('parent_station')
         stop['parent_station_id'] = parent_id if parent_id else None
-        if parent_id and station_ids and parent_id not in station_ids:
+        if parent_id and stations2 and parent_id not in stations2:
             if lenient:
                 logger.error("Parent station ID '%s' in '%s' is invalid, resetting." % (parent_id, stop))
                 stop['parent_station_id'] = None
@@ -276,30 +673,41 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
                 raise KeyError("Parent station ID '%s' in '%s' is invalid." % (parent_id, stop))
         stop.pop('parent_station', None)
         stop2 = Stop(feed_id, **stop)
-        dao.add(stop2)
-        item_ids.add(stop2.stop_id)
+        stops_q.append(_astuple(stop2, _STOP_COLUMNS))
+        items[stop2.stop_id] = stop2
         return 1
 
-    stop_ids = set()
-    station_ids = set()
+    # Keep stops in memory, they are needed for trip normalization
+    stops2 = {}
+    stations2 = {}
     zone_ids = set()
+    begin_phase('stops')
     logger.info("Importing zones, stations and stops...")
     n_stations = n_stops = 0
+    # Stations must be inserted before the stops referencing them
+    stations_q = []
     for station in gtfs.stops():
-        n_stations += import_stop(station, Stop.TYPE_STATION, zone_ids, station_ids)
+        n_stations += import_stop(station, Stop.TYPE_STATION, zone_ids, stations2, stations_q)
+    insert_stops = dao.bulk_insert if sync is None else sync.upsert
+    insert_stops(Stop, _STOP_COLUMNS, stations_q)
+    stops_q = []
     for stop in gtfs.stops():
-        n_stops += import_stop(stop, Stop.TYPE_STOP, zone_ids, stop_ids, station_ids)
+        n_stops += import_stop(stop, Stop.TYPE_STOP, zone_ids, stops2, stops_q, stations2)
+    insert_stops(Stop, _STOP_COLUMNS, stops_q)
     dao.flush()
     logger.info("Imported %d zones, %d stations and %d stops" % (len(zone_ids), n_stations, n_stops))
 
+    begin_phase('transfers')
     logger.info("Importing transfers...")
     n_transfers = 0
+    if sync is not None:
+        sync.clear(Transfer)
     for transfer in gtfs.transfers():
         from_stop_id = transfer.get('from_stop_id')
         to_stop_id = transfer.get('to_stop_id')
         transfer['transfer_type'] = _toint(transfer.get('transfer_type'), 0)
         for stop_id in (from_stop_id, to_stop_id):
-            if stop_id not in station_ids and stop_id not in stop_ids:
+            if stop_id not in stations2 and stop_id not in stops2:
                 if lenient:
                     logger.error("Stop ID '%s' in '%s' is invalid, skipping." % (stop_id, transfer))
                     continue
@@ -311,6 +719,7 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
     dao.flush()
     logger.info("Imported %d transfers" % (n_transfers))
     
+    begin_phase('routes')
     logger.info("Importing routes...")
     n_routes = 0
     route_ids = set()
@@ -327,14 +736,17 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
             else:
                 raise KeyError("agency ID '%s' in '%s' is invalid." % (agency_id, route))
         route2 = Route(feed_id, **route)
-        dao.add(route2)
+        add(route2)
         route_ids.add(route2.route_id)
         n_routes += 1
     dao.flush()
     logger.info("Imported %d routes" % n_routes)
 
+    begin_phase('fares')
     logger.info("Importing fares...")
     n_fares = 0
+    if sync is not None:
+        sync.clear(FareRule)
     for fare_attr in gtfs.fare_attributes():
         fare_id = fare_attr.get('fare_id')
         fare_price = _tofloat(fare_attr.get('price'))
@@ -348,7 +760,7 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
             transfer_duration = _toint(fare_attr.get('transfer_duration'))
         fare = FareAttribute(feed_id, fare_id, fare_price, currency_type,
                              payment_method, n_transfers, transfer_duration)
-        dao.add(fare)
+        add(fare)
         n_fares += 1
     dao.flush()
     fare_rules = set()
@@ -365,6 +777,7 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
     dao.flush()
     logger.info("Imported %d fare and %d rules" % (n_fares, len(fare_rules)))
 
+    begin_phase('calendars')
     logger.info("Importing calendars...")
     calanddates2 = {}
     for calendar in gtfs.calendars():
@@ -397,46 +810,78 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
     n_calendars = 0
     n_caldates = 0
     calendar_ids = set()
+    caldates_q = []
+    # Dates may only be stored in their compact form, with calendars
+    compact_calendars = dao.compact_calendars()
     for (calendar2, dates2) in calanddates2.values():
-        calendar2.dates = [ d for d in dates2 ]
-        dao.add(calendar2)
+        bitmap = DateBitmap.from_dates(dates2)
+        calendar2.start_date = bitmap.start_date
+        calendar2.days = bitmap.days
+        add(calendar2)
         calendar_ids.add(calendar2.service_id)
         n_calendars += 1
-        n_caldates += len(calendar2.dates)
+        n_caldates += len(dates2)
+        if compact_calendars:
+            continue
+        if sync is not None:
+            dates2 = sorted(dates2)
+            if not sync.changed('calendar', calendar2.service_id, [ d.as_date() for d in dates2 ]):
+                continue
+            dao.bulk_delete(CalendarDate, ('feed_id', 'service_id'), [ (feed_id, calendar2.service_id) ])
+        caldates_q.extend((feed_id, calendar2.service_id, d.as_date()) for d in dates2)
+    # Calendars are flushed before their dates are inserted
+    dao.bulk_insert(CalendarDate, _CALENDAR_DATE_COLUMNS, caldates_q)
     dao.flush()
     logger.info("Imported %d calendars and %d dates" % (n_calendars, n_caldates))
 
+    begin_phase('shapes')
     logger.info("Importing shapes...")
     n_shape_pts = 0
-    shape_ids = set()
-    shapepts_q = []
-    for shpt in gtfs.shapes():
-        shape_id = shpt.get('shape_id')
-        if shape_id not in shape_ids:
-            dao.add(Shape(feed_id, shape_id))
-            dao.flush()
-            shape_ids.add(shape_id)
-        pt_seq = _toint(shpt.get('shape_pt_sequence'))
+    # Shape points are kept in memory until normalized
+    shapes2 = {}
+    for shape_id, pt_seq, lat, lon, dist_traveled in gtfs.shapes(columns=_GTFS_SHAPE_COLUMNS):
+        shape2 = shapes2.get(shape_id)
+        if shape2 is None:
+            shape2 = shapes2[shape_id] = _ShapeRecord(shape_id)
+        pt_seq = _toint(pt_seq)
         # This field is optional
-        dist_traveled = _tofloat(shpt.get('shape_dist_traveled'), -999999)
-        lat = _tofloat(shpt.get('shape_pt_lat'))
-        lon = _tofloat(shpt.get('shape_pt_lon'))
-        shape_point = ShapePoint(feed_id, shape_id, pt_seq, lat, lon, dist_traveled)
-        shapepts_q.append(shape_point)
+        dist_traveled = _tofloat(dist_traveled, -999999)
+        lat = _tofloat(lat)
+        lon = _tofloat(lon)
+        shape2.points.append(_ShapePointRecord(pt_seq, lat, lon, dist_traveled))
         n_shape_pts += 1
         if n_shape_pts % 100000 == 0:
             logger.info("%d shape points" % n_shape_pts)
-            dao.bulk_save_objects(shapepts_q)
-            dao.flush()
-            shapepts_q = []
-    dao.bulk_save_objects(shapepts_q)
+    for shape2 in shapes2.values():
+        shape2.points.sort(key=lambda p: p.shape_pt_sequence)
+        for pt1, pt2 in zip(shape2.points, shape2.points[1:]):
+            if pt1.shape_pt_sequence == pt2.shape_pt_sequence:
+                raise KeyError("Duplicated shape point sequence %d in shape '%s'" % (pt1.shape_pt_sequence, shape2.shape_id))
+    if sync is None:
+        dao.bulk_insert(Shape, _SHAPE_COLUMNS, [ (feed_id, shape_id) for shape_id in shapes2 ])
+    else:
+        # Only new or changed shapes are normalized and written
+        changed_shape_ids = set()
+        shape_hashes = {}
+        for shape2 in shapes2.values():
+            points = [ (pt.shape_pt_sequence, pt.shape_pt_lat, pt.shape_pt_lon, pt.shape_dist_traveled) for pt in shape2.points ]
+            if sync.changed('shape', shape2.shape_id, points):
+                changed_shape_ids.add(shape2.shape_id)
+            shape_hashes[shape2.shape_id] = sync.hash(points)
+        dao.bulk_delete(ShapePoint, ('feed_id', 'shape_id'),
+                        [ (feed_id, shape_id) for shape_id in changed_shape_ids if sync.existed('shape', shape_id) ])
+        dao.bulk_insert(Shape, _SHAPE_COLUMNS,
+                        [ (feed_id, shape_id) for shape_id in changed_shape_ids if not sync.existed('shape', shape_id) ])
     dao.flush()
-    logger.info("Imported %d shapes and %d points" % (len(shape_ids), n_shape_pts))
+    logger.info("Imported %d shapes and %d points" % (len(shapes2), n_shape_pts))
 
+    begin_phase('trips')
     logger.info("Importing trips...")
     n_trips = 0
     trips_q = []
     trip_ids = set()
+    # Trip IDs per shape ID (None for trips w/o shape), in import order
+    trips_by_shape = defaultdict(list)
     for trip in gtfs.trips():
         trip['wheelchair_accessible'] = _toint(trip.get('wheelchair_accessible'), Trip.WHEELCHAIR_UNKNOWN)
         trip['bikes_allowed'] = _toint(trip.get('bikes_allowed'), Trip.BIKES_UNKNOWN)
@@ -455,81 +900,106 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
             else:
                 raise KeyError("Route ID '%s' in trip '%s' is invalid." % (route_id, trip))
         trip2 = Trip(feed_id, frequency_generated=False, **trip)
-        
-        trips_q.append(trip2)
+
+        trips_q.append(_astuple(trip2, _TRIP_COLUMNS))
         n_trips += 1
-        if n_trips % 10000 == 0:
-            dao.bulk_save_objects(trips_q)
-            dao.flush()
+        # In incremental mode trips are written once compared, with their stop times
+        if n_trips % 10000 == 0 and sync is None:
+            dao.bulk_insert(Trip, _TRIP_COLUMNS, trips_q)
             logger.info('%s trips' % n_trips)
             trips_q = []
 
         trip_ids.add(trip.get('trip_id'))
-    dao.bulk_save_objects(trips_q)
+        trips_by_shape[trip2.shape_id].append(trip2.trip_id)
+    if sync is None:
+        dao.bulk_insert(Trip, _TRIP_COLUMNS, trips_q)
     dao.flush()
-    
+
     logger.info("Imported %d trips" % n_trips)
 
+    if metrics is not None:
+        # Part of the trips phase for checkpoints
+        metrics.begin_phase('stoptimes')
     logger.info("Importing stop times...")
     n_stoptimes = 0
-    stoptimes_q = []
-    for stoptime in gtfs.stop_times():
-        stopseq = _toint(stoptime.get('stop_sequence'))
-        # Mark times to interpolate later on 
-        arrtime = _timetoint(stoptime.get('arrival_time'), -999999)
-        deptime = _timetoint(stoptime.get('departure_time'), -999999)
-        if arrtime == -999999:
-            arrtime = deptime
-        if deptime == -999999:
-            deptime = arrtime
-        interp = arrtime < 0 and deptime < 0
-        shpdist = _tofloat(stoptime.get('shape_dist_traveled'), -999999)
-        pkptype = _toint(stoptime.get('pickup_type'), StopTime.PICKUP_DROPOFF_REGULAR)
-        drptype = _toint(stoptime.get('drop_off_type'), StopTime.PICKUP_DROPOFF_REGULAR)
-        trip_id = stoptime.get('trip_id')
+    # Stop times are grouped by trip and kept in memory until normalized
+    stoptimes_by_trip = defaultdict(list)
+    for stoptime in _converted_stop_times(gtfs, jobs):
+        trip_id, stop_id, stopseq, arrtime, deptime, shpdist, pkptype, drptype, headsign, interp = stoptime
         if trip_id not in trip_ids:
             if lenient:
-                logger.error("Trip ID '%s' in '%s' is invalid. Skipping stop time." % (trip_id, stoptime))
+                logger.error("Trip ID '%s' in '%s' is invalid. Skipping stop time." % (trip_id, _asdict(stoptime, _GTFS_STOP_TIME_COLUMNS)))
                 continue
             else:
-                raise KeyError("Trip ID '%s' in '%s' is invalid." % (trip_id, stoptime))
-        stop_id = stoptime.get('stop_id')
-        if stop_id not in stop_ids:
+                raise KeyError("Trip ID '%s' in '%s' is invalid." % (trip_id, _asdict(stoptime, _GTFS_STOP_TIME_COLUMNS)))
+        stop = stops2.get(stop_id)
+        if stop is None:
             if lenient:
-                logger.error("Stop ID '%s' in '%s' is invalid. Skipping stop time." % (stop_id, stoptime))
+                logger.error("Stop ID '%s' in '%s' is invalid. Skipping stop time." % (stop_id, _asdict(stoptime, _GTFS_STOP_TIME_COLUMNS)))
                 continue
             else:
-                raise KeyError("Trip ID '%s' in stoptime '%s' is invalid." % (stop_id, stoptime))
-        stoptime2 = StopTime(feed_id, trip_id, stop_id,
-                stop_sequence=stopseq, arrival_time=arrtime, departure_time=deptime,
-                shape_dist_traveled=shpdist, interpolated=interp,
-                pickup_type=pkptype, drop_off_type=drptype,
-                stop_headsign=stoptime.get('stop_headsign'))
-        stoptimes_q.append(stoptime2)
+                raise KeyError("Trip ID '%s' in stoptime '%s' is invalid." % (stop_id, _asdict(stoptime, _GTFS_STOP_TIME_COLUMNS)))
+        stoptimes_by_trip[trip_id].append(_StopTimeRecord(stop, stopseq, arrtime, deptime,
+                shpdist, interp, pkptype, drptype, headsign))
         n_stoptimes += 1
-        # Commit every now and then
-        if n_stoptimes % 50000 == 0:
+        if n_stoptimes % 100000 == 0:
             logger.info("%d stop times" % n_stoptimes)
-            dao.bulk_save_objects(stoptimes_q)
-            dao.flush()
-            stoptimes_q = []
-    dao.bulk_save_objects(stoptimes_q)
+    for trip_id, stoptimes in stoptimes_by_trip.items():
+        stoptimes.sort(key=lambda st: st.stop_sequence)
+        stoptimes2 = stoptimes[:1]
+        for stoptime in stoptimes[1:]:
+            if stoptime.stop_sequence == stoptimes2[-1].stop_sequence:
+                if lenient:
+                    logger.error("Duplicated stop sequence %d in trip '%s', skipping." % (stoptime.stop_sequence, trip_id))
+                    n_stoptimes -= 1
+                    continue
+                else:
+                    raise KeyError("Duplicated stop sequence %d in trip '%s'" % (stoptime.stop_sequence, trip_id))
+            stoptimes2.append(stoptime)
+        stoptimes[:] = stoptimes2
+    logger.info("Parsed %d stop times" % n_stoptimes)
 
-    logger.info("Imported %d stop times" % n_stoptimes)
-    logger.info("Committing")
-    dao.flush()
-    # TODO Add option to enable/disable this commit
-    # to ensure import is transactionnal
-    dao.commit()
-    logger.info("Commit done")
+    if sync is not None:
+        # Compare trips using all source data their normalized version depends on
+        frequencies_by_trip = defaultdict(list)
+        for frequency in gtfs.frequencies():
+            frequencies_by_trip[frequency.get('trip_id')].append(sorted(frequency.items()))
+        changed_trip_ids = set()
+        for trip_row in trips_q:
+            trip_id = trip_row[_TRIP_COLUMNS.index('trip_id')]
+            shape_id = trip_row[_TRIP_COLUMNS.index('shape_id')]
+            data = (trip_row, shape_hashes.get(shape_id), frequencies_by_trip.get(trip_id),
+                    [ (st.stop.stop_id, st.stop.stop_lat, st.stop.stop_lon, st.stop_sequence, st.arrival_time,
+                       st.departure_time, st.shape_dist_traveled, st.interpolated, st.pickup_type,
+                       st.drop_off_type, st.stop_headsign) for st in stoptimes_by_trip.get(trip_id, ()) ])
+            if sync.changed('trip', trip_id, data):
+                changed_trip_ids.add(trip_id)
+            if trip_id in frequencies_by_trip and not lazy_frequencies:
+                sync.changed('template', trip_id, None)
+        deleted_trip_ids = [ trip_id for trip_id in changed_trip_ids if sync.existed('trip', trip_id) ] + sync.removed('trip')
+        dao.delete_trips(deleted_trip_ids, feed_id,
+                         templates=[ trip_id for trip_id in deleted_trip_ids if sync.existed('template', trip_id) ])
+        dao.bulk_insert(Trip, _TRIP_COLUMNS, [ trip_row for trip_row in trips_q
+                                               if trip_row[_TRIP_COLUMNS.index('trip_id')] in changed_trip_ids ])
+        dao.flush()
+        logger.info("%d new or changed trips, %d deleted" % (len(changed_trip_ids), len(deleted_trip_ids)))
+        # Only new or changed trips are normalized and written
+        for shape_id in trips_by_shape:
+            trips_by_shape[shape_id] = [ trip_id for trip_id in trips_by_shape[shape_id] if trip_id in changed_trip_ids ]
+        for trip_id in list(stoptimes_by_trip):
+            if trip_id not in changed_trip_ids:
+                del stoptimes_by_trip[trip_id]
+        for shape_id in list(shapes2):
+            if shape_id not in changed_shape_ids and not trips_by_shape.get(shape_id):
+                del shapes2[shape_id]
 
-    def normalize_trip(trip, odometer):
+    def normalize_trip(trip_id, stop_times, odometer):
         stopseq = 0
-        n_stoptimes = len(trip.stop_times)
+        n_stoptimes = len(stop_times)
         last_stoptime_with_time = None
         to_interpolate = []
         odometer.reset()
-        for stoptime in trip.stop_times:
+        for stoptime in stop_times:
             stoptime.stop_sequence = stopseq
             stoptime.shape_dist_traveled = odometer.dist_traveled(stoptime.stop,
                         stoptime.shape_dist_traveled if stoptime.shape_dist_traveled != -999999 else None)
@@ -545,7 +1015,7 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
                 if len(to_interpolate) > 0:
                     # Interpolate
                     if last_stoptime_with_time is None:
-                        logger.error("Cannot interpolate missing time at trip start: %s" % trip)
+                        logger.error("Cannot interpolate missing time at trip start: %s" % trip_id)
                         for stti in to_interpolate:
                             # Use first defined time as fallback value.
                             stti.arrival_time = stoptime.arrival_time
@@ -564,53 +1034,139 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
         if len(to_interpolate) > 0:
             # Should not happen, but handle the case, we never know
             if last_stoptime_with_time is None:
-                logger.error("Cannot interpolate missing time, no time at all: %s" % trip)
+                logger.error("Cannot interpolate missing time, no time at all: %s" % trip_id)
                 # Keep times NULL (TODO: or remove the trip?)
             else:
-                logger.error("Cannot interpolate missing time at trip end: %s" % trip)
+                logger.error("Cannot interpolate missing time at trip end: %s" % trip_id)
                 for stti in to_interpolate:
                     # Use last defined time as fallback value
                     stti.arrival_time = last_stoptime_with_time.departure_time
                     stti.departure_time = last_stoptime_with_time.departure_time
 
+    # Normalized (or not) items are inserted in a single pass
+    begin_phase('normalization')
+    shapepts_q = []
+    stoptimes_q = []
+    def queue_shape_points(shape2):
+        if sync is not None and shape2.shape_id not in changed_shape_ids:
+            return
+        for pt in shape2.points:
+            shapepts_q.append((feed_id, shape2.shape_id, pt.shape_pt_sequence,
+                               pt.shape_pt_lat, pt.shape_pt_lon, pt.shape_dist_traveled))
+        if len(shapepts_q) >= 100000:
+            dao.bulk_insert(ShapePoint, _SHAPE_POINT_COLUMNS, shapepts_q)
+            del shapepts_q[:]
+
+    def queue_stop_times(trip_id, stop_times):
+        for st in stop_times:
+            stoptimes_q.append((feed_id, trip_id, st.stop.stop_id, st.stop_sequence,
+                                st.arrival_time, st.departure_time, st.shape_dist_traveled,
+                                st.interpolated, StopTime.TIMEPOINT_EXACT,
+                                st.pickup_type, st.drop_off_type, st.stop_headsign))
+        if len(stoptimes_q) >= 50000:
+            dao.bulk_insert(StopTime, _STOP_TIME_COLUMNS, stoptimes_q)
+            del stoptimes_q[:]
+
+    def flush_queues():
+        dao.bulk_insert(ShapePoint, _SHAPE_POINT_COLUMNS, shapepts_q)
+        dao.bulk_insert(StopTime, _STOP_TIME_COLUMNS, stoptimes_q)
+        del shapepts_q[:]
+        del stoptimes_q[:]
+
+    # Trips normalized by an interrupted import, when resuming
+    skipped_trip_ids = set()
     if disable_normalization:
         logger.info("Skipping shapes and trips normalization")
+        for shape2 in shapes2.values():
+            queue_shape_points(shape2)
+        for trip_id, stop_times in stoptimes_by_trip.items():
+            queue_stop_times(trip_id, stop_times)
     else:
         logger.info("Normalizing shapes and trips...")
         nshapes = 0
         ntrips = 0
         odometer = _Odometer()
+        snapcache = _SnappingCache(dao) if snapping_cache else None
+        # Shapes normalized, with their trips, by an interrupted import are skipped
+        replaying = checkpoints is not None and checkpoints.replaying()
+        nshapes_done = checkpoints.progress() if checkpoints is not None else 0
+        if replaying:
+            nshapes_done = len(shapes2)
+        checkpoint_ntrips = 0
         # Process shapes and associated trips
-        for shape in dao.shapes(fltr=Shape.feed_id == feed_id, prefetch_points=True, batch_size=50):
+        for shape2 in shapes2.values():
+            if nshapes < nshapes_done:
+                skipped_trip_ids.update(trips_by_shape.get(shape2.shape_id, ()))
+                nshapes += 1
+                continue
             # Shape will be registered in the normalize
-            odometer.normalize_and_register_shape(shape)
-            for trip in dao.trips(fltr=(Trip.feed_id == feed_id) & (Trip.shape_id == shape.shape_id), prefetch_stop_times=True, prefetch_stops=True, batch_size=800):
-                normalize_trip(trip, odometer)
+            odometer.normalize_and_register_shape(shape2)
+            queue_shape_points(shape2)
+            if snapcache is not None:
+                snapcache.load_shape(shape2)
+            for trip_id in trips_by_shape.get(shape2.shape_id, ()):
+                stop_times = stoptimes_by_trip.get(trip_id, ())
+                if snapcache is not None and stop_times and odometer.snaps_all(st.shape_dist_traveled if st.shape_dist_traveled != -999999 else None
+                                                                for st in stop_times):
+                    pattern_hash = snapcache.pattern_hash(stop_times)
+                    distances = snapcache.get(pattern_hash)
+                    if distances is not None:
+                        normalize_trip(trip_id, stop_times, _ReplayOdometer(distances))
+                    else:
+                        normalize_trip(trip_id, stop_times, odometer)
+                        snapcache.put(pattern_hash, [ st.shape_dist_traveled for st in stop_times ])
+                else:
+                    normalize_trip(trip_id, stop_times, odometer)
+                queue_stop_times(trip_id, stop_times)
                 ntrips += 1
                 if ntrips % 1000 == 0:
                     logger.info("%d trips, %d shapes" % (ntrips, nshapes))
-                    dao.flush()
+            if snapcache is not None:
+                snapcache.store_shape()
             nshapes += 1
+            if checkpoints is not None and ntrips - checkpoint_ntrips >= _CHECKPOINT_TRIPS:
+                flush_queues()
+                checkpoints.advance(nshapes)
+                checkpoint_ntrips = ntrips
             #odometer._debug_cache()
         # Process trips w/o shapes
-        for trip in dao.trips(fltr=(Trip.feed_id == feed_id) & (Trip.shape_id == None), prefetch_stop_times=True, prefetch_stops=True, batch_size=800):
+        noshape_trip_ids = trips_by_shape.get(None, ())
+        if replaying:
+            skipped_trip_ids.update(noshape_trip_ids)
+            noshape_trip_ids = ()
+        for trip_id in noshape_trip_ids:
+            stop_times = stoptimes_by_trip.get(trip_id, ())
             odometer.register_noshape()
-            normalize_trip(trip, odometer)
+            normalize_trip(trip_id, stop_times, odometer)
+            queue_stop_times(trip_id, stop_times)
             ntrips += 1
             if ntrips % 1000 == 0:
                 logger.info("%d trips" % ntrips)
-                dao.flush()
-        dao.flush()
+        # Trips referencing an unknown shape are not normalized
+        for shape_id, shape_trip_ids in trips_by_shape.items():
+            if shape_id is not None and shape_id not in shapes2:
+                for trip_id in shape_trip_ids:
+                    queue_stop_times(trip_id, stoptimes_by_trip.get(trip_id, ()))
         logger.info("Normalized %d trips and %d shapes" % (ntrips, nshapes))
+        if snapcache is not None:
+            logger.info("Snapping cache: %d hits, %d misses" % (snapcache.hits, snapcache.misses))
+    flush_queues()
+    dao.flush()
+    logger.info("Imported %d shape points and %d stop times" % (n_shape_pts, n_stoptimes))
 
     # Note: we expand frequencies *after* normalization
     # for performances purpose only: that minimize the
     # number of trips to normalize. We can do that since
     # the expansion is neutral trip-normalization-wise.
-    logger.info("Expanding frequencies...")
+    # In lazy mode frequencies are stored as-is, along with their
+    # template trips, and expanded on the fly by the DAO.
+    begin_phase('frequencies')
+    logger.info("Storing frequencies..." if lazy_frequencies else "Expanding frequencies...")
     n_freq = 0
     n_exp_trips = 0
-    trips_to_delete = []
+    frequencies_q = []
+    departures = []
+    template_trip_ids = set()
     for frequency in gtfs.frequencies():
         trip_id = frequency.get('trip_id')
         if trip_id not in trip_ids:
@@ -619,50 +1175,49 @@ def _convert_gtfs_model(feed_id, gtfs, dao, lenient=False, disable_normalization
                 continue
             else:
                 raise KeyError("Trip ID '%s' in '%s' is invalid." % (trip_id, frequency))
-        trip = dao.trip(trip_id, feed_id=feed_id)
+        if sync is not None and trip_id not in changed_trip_ids:
+            continue
         start_time = _timetoint(frequency.get('start_time'))
         end_time = _timetoint(frequency.get('end_time'))
         headway_secs = _toint(frequency.get('headway_secs'))
         exact_times = _toint(frequency.get('exact_times'), Trip.TIME_APPROX)
+        n_freq += 1
+        if lazy_frequencies:
+            frequencies_q.append((feed_id, trip_id, start_time, end_time, headway_secs, exact_times))
+            continue
+        if trip_id in skipped_trip_ids:
+            # Normalized by an interrupted import, read them back
+            base_time = dao.stoptimes(fltr=(StopTime.feed_id == feed_id) & (StopTime.trip_id == trip_id)
+                                      & (StopTime.stop_sequence == 0))[0].departure_time
+        else:
+            # In-memory stop times are the normalized ones, sorted
+            base_time = stoptimes_by_trip[trip_id][0].departure_time
         for trip_dep_time in range(start_time, end_time, headway_secs):
             # Here we assume departure time are all different.
             # That's a requirement in the GTFS specs, but this may break.
             # TODO Make the expanded trip ID generation parametrable.
-            trip_id2 = trip.trip_id + "@" + fmttime(trip_dep_time)
-            trip2 = Trip(feed_id, trip_id2, trip.route_id, trip.service_id,
-                         wheelchair_accessible=trip.wheelchair_accessible,
-                         bikes_allowed=trip.bikes_allowed,
-                         exact_times=exact_times,
-                         frequency_generated=True,
-                         trip_headsign=trip.trip_headsign,
-                         trip_short_name=trip.trip_short_name,
-                         direction_id=trip.direction_id,
-                         block_id=trip.block_id)
-            trip2.stop_times = []
-            base_time = trip.stop_times[0].departure_time
-            for stoptime in trip.stop_times:
-                arrtime = None if stoptime.arrival_time is None else stoptime.arrival_time - base_time + trip_dep_time
-                deptime = None if stoptime.departure_time is None else stoptime.departure_time - base_time + trip_dep_time
-                stoptime2 = StopTime(feed_id, trip_id2, stoptime.stop_id, stoptime.stop_sequence,
-                            arrival_time=arrtime,
-                            departure_time=deptime,
-                            shape_dist_traveled=stoptime.shape_dist_traveled,
-                            interpolated=stoptime.interpolated,
-                            timepoint=stoptime.timepoint,
-                            pickup_type=stoptime.pickup_type,
-                            drop_off_type=stoptime.drop_off_type)
-                trip2.stop_times.append(stoptime2)
+            trip_id2 = trip_id + "@" + fmttime(trip_dep_time)
+            departures.append((trip_id2, trip_id, trip_dep_time - base_time, exact_times))
             n_exp_trips += 1
-            # This will add the associated stop times
-            dao.add(trip2)
         # Do not delete trip now, as two frequency can refer to same trip
-        trips_to_delete.append(trip)
-        n_freq += 1
-    for trip in trips_to_delete:
-        # This also delete the associated stop times
-        dao.delete(trip)
-    dao.flush()
-    dao.commit()
-    logger.info("Expanded %d frequencies to %d trips." % (n_freq, n_exp_trips))
+        template_trip_ids.add(trip_id)
+    if lazy_frequencies:
+        dao.bulk_insert(Frequency, _FREQUENCY_COLUMNS, frequencies_q)
+        dao.flush()
+        dao.commit()
+        logger.info("Stored %d frequencies." % n_freq)
+    else:
+        # Trips and stop times are copied and deleted in the database
+        dao.expand_frequencies(feed_id, departures, template_trip_ids)
+        dao.flush()
+        dao.commit()
+        logger.info("Expanded %d frequencies to %d trips." % (n_freq, n_exp_trips))
+
+    if sync is not None:
+        sync.finish()
+        dao.flush()
+        dao.commit()
+    if checkpoints is not None:
+        checkpoints.finish()
 
     logger.info("Feed '%s': import done." % feed_id)
@@ -18,16 +18,30 @@
 """
 import collections
 import csv
+import gzip
 import io
+import mmap
+import operator
+import os
 import six
 import zipfile
 
+def _read_header(rows):
+    header = [ _strip_and_nullify(item) for item in six.next(rows) ]
+    if header[0].startswith(six.u('\ufeff')):
+        header[0] = header[0][1:]
+    return header
+
+def _strip_and_nullify(item):
+    ret = item.strip()
+    if len(ret) == 0:
+        return None
+    return ret
+
 class CsvTableFactory(object):
 
     def __init__(self, objname, rows):
-        self._header = [ self._strip_and_nullify(item) for item in six.next(rows) ]
-        if self._header[0].startswith(six.u('\ufeff')):
-            self._header[0] = self._header[0][1:]
+        self._header = _read_header(rows)
         self._rows = rows
         self._factory = collections.namedtuple(objname, self._header)
 
@@ -37,14 +51,8 @@ class CsvTableFactory(object):
     def __iter__(self):
         return self
 
-    def _strip_and_nullify(self, item):
-        ret = item.strip()
-        if len(ret) == 0:
-            return None
-        return ret
-
     def __next__(self):
-        row = [ self._strip_and_nullify(item) for item in six.next(self._rows) ]
+        row = [ _strip_and_nullify(item) for item in six.next(self._rows) ]
         args = dict(six.moves.zip_longest(self._header, row, fillvalue=None))
         # return self._factory(**args)
         # Directly return the dictionary, do not bother with an object creation
@@ -54,11 +62,48 @@ class CsvTableFactory(object):
     def next(self):
         return self.__next__()
 
-def python2or3_csv(filesource, filename, encoding, dialect=csv.excel, **kwargs):
+class CsvTupleTableFactory(object):
+    """
+    Lightweight reader returning each row as a tuple of the requested columns,
+    in the requested order. Only those cells are stripped; columns absent from
+    the file are always None.
+    """
+
+    def __init__(self, rows, columns):
+        self._header = _read_header(rows)
+        self._rows = rows
+        self._columns = tuple(columns)
+        index = dict((name, i) for i, name in enumerate(self._header))
+        # Missing columns point to an extra empty cell padded at the end of rows
+        padding = len(self._header)
+        indexes = [ index.get(column, padding) for column in self._columns ]
+        self._width = max(indexes) + 1
+        if len(indexes) == 1:
+            self._getter = lambda row: (row[indexes[0]],)
+        else:
+            self._getter = operator.itemgetter(*indexes)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self._columns)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = six.next(self._rows)
+        if len(row) < self._width:
+            row = row + [''] * (self._width - len(row))
+        return tuple([ item.strip() or None for item in self._getter(row) ])
+
+    def next(self):
+        return self.__next__()
+
+def _open_text(filesource, filename, encoding):
     if six.PY2:
-        filedata = filesource.open(filename, 'rU')
-    else:
-        filedata = io.TextIOWrapper(filesource.open(filename, 'r'), encoding=encoding)
+        return filesource.open(filename, 'rU')
+    return io.TextIOWrapper(filesource.open(filename, 'r'), encoding=encoding)
+
+def _csv_rows(filedata, encoding, dialect=csv.excel, **kwargs):
     csvreader = csv.reader(filedata, dialect=dialect, **kwargs)
     for row in csvreader:
         if len(row) == 0:
@@ -68,6 +113,16 @@ def python2or3_csv(filesource, filename, encoding, dialect=csv.excel, **kwargs):
         else:
             yield row
 
+def python2or3_csv(filesource, filename, encoding, dialect=csv.excel, **kwargs):
+    filedata = _open_text(filesource, filename, encoding)
+    for row in _csv_rows(filedata, encoding, dialect=dialect, **kwargs):
+        yield row
+
+def parse_chunk(header, chunk, columns, encoding='utf-8'):
+    """Parse a chunk from Gtfs.chunks() into a list of projected tuples."""
+    rows = _csv_rows(six.StringIO(header + chunk), encoding)
+    return list(CsvTupleTableFactory(rows, columns))
+
 class ZipFileSource(object):
     
     def __init__(self, inputfile):
@@ -79,6 +134,103 @@ class ZipFileSource(object):
     def close(self):
         self._zipfile.close()
 
+class DirectorySource(object):
+    """Unzipped GTFS: one plain file per table in a directory."""
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self._directory)
+
+    def _path(self, filename):
+        path = os.path.join(self._directory, filename)
+        if not os.path.isfile(path):
+            # Same as zipfile, for missing optional tables
+            raise KeyError(filename)
+        return path
+
+    def open(self, filename, mode='rU'):
+        if six.PY2:
+            return open(self._path(filename), mode)
+        return io.open(self._path(filename), 'rb')
+
+    def close(self):
+        pass
+
+class MmapSource(DirectorySource):
+    """Unzipped GTFS in a directory, tables being memory-mapped instead of read."""
+
+    def open(self, filename, mode='rU'):
+        with io.open(self._path(filename), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files cannot be mapped
+                return io.BytesIO()
+            # The mapping outlives the file descriptor
+            return _MmapFile(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+class _MmapFile(io.RawIOBase):
+
+    def __init__(self, buf):
+        self._buf = buf
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        # A single copy, sliced out of the mapping: see readinto() to avoid it
+        end = len(self._buf) if size is None or size < 0 else min(len(self._buf), self._pos + size)
+        data = self._buf[self._pos:end]
+        self._pos = end
+        return data
+
+    read1 = read
+
+    def readinto(self, b):
+        n = min(len(b), len(self._buf) - self._pos)
+        if six.PY2:
+            b[:n] = self._buf[self._pos:self._pos + n]
+        else:
+            # Copied straight from the mapping, w/o an intermediate bytes object
+            with memoryview(self._buf) as view:
+                b[:n] = view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def readline(self, size=-1):
+        # Lines are sliced directly out of the mapping
+        end = self._buf.find(b'\n', self._pos)
+        end = len(self._buf) if end < 0 else end + 1
+        if size is not None and size >= 0:
+            end = min(end, self._pos + size)
+        line = self._buf[self._pos:end]
+        self._pos = end
+        return line
+
+    def close(self):
+        if not self.closed:
+            self._buf.close()
+        super(_MmapFile, self).close()
+
+class GzipSource(DirectorySource):
+    """GTFS as a directory of gzipped tables, named after the table file plus '.gz'.
+       Tables w/o a gzipped file are read from the plain file, if any."""
+
+    def open(self, filename, mode='rU'):
+        if not os.path.isfile(os.path.join(self._directory, filename + '.gz')):
+            return DirectorySource.open(self, filename, mode)
+        return gzip.open(self._path(filename + '.gz'), 'rb')
+
+def open_source(path):
+    """Return the source suited to a GTFS path: a zip file, or a directory of
+       plain and/or gzipped tables."""
+    if not os.path.isdir(path):
+        return ZipFileSource(path)
+    if any(name.endswith('.txt.gz') for name in os.listdir(path)):
+        return GzipSource(path)
+    return DirectorySource(path)
+
 class Gtfs(object):
     TABLES = [
             dict(obj='GtfsFeedInfo', getter='feedinfo', table='feed_info.txt', optional=True),
@@ -108,9 +260,12 @@ class Gtfs(object):
         return '<%s %s>' % (self.__class__.__name__, self._filesource)
 
     def make_getter(self, name, filename, optional=False):
-        def getter(self):
+        def getter(self, columns=None):
+            """Rows as dicts, or as tuples of the given columns only."""
             try:
                 myreader = python2or3_csv(self._filesource, filename, 'utf-8')
+                if columns is not None:
+                    return CsvTupleTableFactory(myreader, columns)
                 mytable = CsvTableFactory(name, myreader)
                 return mytable
             except KeyError:
@@ -121,6 +276,33 @@ class Gtfs(object):
                     raise KeyError("Required table '%s' not found in GTFS." % filename)
         return getter
     
+    def chunks(self, filename, chunk_lines=20000):
+        """
+        Split a table into raw text chunks of about chunk_lines lines, for
+        parsing them in parallel with parse_chunk(). Yield (header, chunk)
+        tuples; chunks are cut on row boundaries only, never inside a
+        quoted cell spanning several lines.
+        """
+        try:
+            filedata = _open_text(self._filesource, filename, 'utf-8')
+        except KeyError:
+            raise KeyError("Required table '%s' not found in GTFS." % filename)
+        header = None
+        lines = []
+        in_quotes = False
+        for line in filedata:
+            if header is None:
+                header = line
+                continue
+            lines.append(line)
+            if line.count('"') % 2 == 1:
+                in_quotes = not in_quotes
+            if len(lines) >= chunk_lines and not in_quotes:
+                yield header, ''.join(lines)
+                lines = []
+        if lines:
+            yield header, ''.join(lines)
+
     def __enter__(self):
         return self
     
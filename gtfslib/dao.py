@@ -17,20 +17,32 @@
 @author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
 """
 
+from collections import defaultdict, namedtuple, OrderedDict
+from contextlib import contextmanager
+import datetime
+import hashlib
 from inspect import isclass
+import itertools
+import os
 
+import six
 import sqlalchemy
+from sqlalchemy import event
 from sqlalchemy.orm import subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.query import Query
 from sqlalchemy.orm.session import sessionmaker
 from sqlalchemy.orm.util import aliased
-from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.exc import InvalidRequestError, NoSuchTableError
+from sqlalchemy.sql.visitors import replacement_traverse
 
+from gtfslib.columnar import _ColumnBuilder
 from gtfslib.converter import _convert_gtfs_model
-from gtfslib.csvgtfs import Gtfs, ZipFileSource
+from gtfslib.csvgtfs import Gtfs, open_source
 from gtfslib.model import FeedInfo, Agency, Route, Calendar, CalendarDate, Stop, \
-    Trip, StopTime, Transfer, Shape, Zone, FareAttribute, FareRule, ShapePoint
-from gtfslib.orm import _Orm
-from gtfslib.utils import group_pairs
+    Trip, StopTime, Transfer, Shape, Zone, FareAttribute, FareRule, ShapePoint, Frequency
+from gtfslib.orm import _Orm, _existing_schema
+from gtfslib.utils import group_pairs, fmttime, gtfstime
 
 class Dao(object):
     """
@@ -38,7 +50,22 @@ class Dao(object):
     as this may break auto-complete and thus make the use of this class more difficult.
     """
 
-    def __init__(self, db="", sql_logging=False, schema=None):
+    def __init__(self, db="", sql_logging=False, schema=None, partitioned=False, compact_calendars=False, readonly=False):
+        """With partitioned=True (PostgreSQL 11+ only, and only when creating the
+           database) stop times and shape points are stored in one partition per
+           feed, and deleting a feed drops its partitions instead of deleting rows.
+           An existing partitioned database is detected w/o the flag; asking
+           for partitions on a database w/o them raises ValueError.
+           With compact_calendars=True (SQLite or PostgreSQL, when creating the
+           database) calendar dates are only stored as bitmaps in calendars, see
+           Calendar.bitmap(): calendar_dates is then a read-only view expanding
+           them, much slower to filter on than the table. Existing databases
+           keep the mode they were created with; asking for compact calendars
+           on a database storing calendar dates raises ValueError.
+           With readonly=True (SQLite or PostgreSQL, existing database) the
+           connections are read-only, the session never flushes nor expires
+           loaded objects on commit, and any write raises an error. See also
+           records() for detached objects, not tracked by the session."""
         if db == "" or db is None:
             # In-memory SQLite
             connect_url = "sqlite:///"
@@ -49,9 +76,34 @@ class Dao(object):
             # Assume a SQLite file
             connect_url = "sqlite:///%s" % db
         engine = sqlalchemy.create_engine(connect_url, echo=sql_logging)
-        self._orm = _Orm(engine, schema=schema)
-        Session = sessionmaker(bind=engine)
+        if partitioned and engine.dialect.name != 'postgresql':
+            raise ValueError("Partitioned storage is only supported on PostgreSQL")
+        if readonly:
+            readonly_sql = _READONLY_SQL.get(engine.dialect.name)
+            if readonly_sql is None:
+                raise ValueError("Read-only mode is not supported on %s" % engine.dialect.name)
+            event.listen(engine, 'connect', lambda dbapi_connection, connection_record: _set_readonly(dbapi_connection, readonly_sql))
+        self._readonly = readonly
+        existing_schema = _existing_schema(engine, schema)
+        self._orm = _Orm(engine, schema=schema, partitioned=partitioned, compact_calendars=compact_calendars,
+                         create_schema=not readonly, existing_schema=existing_schema)
+        # Read-only databases created by older versions have no frequencies table
+        self._frequencies_table = not readonly or 'frequencies' in existing_schema['table_names']
+        # On PostgreSQL, bulk inserts are streamed using COPY FROM STDIN
+        self._copy_bulk_insert = engine.dialect.name == 'postgresql' and engine.dialect.driver == 'psycopg2'
+        self._identifier_preparer = engine.dialect.identifier_preparer
+        # Metrics of the import in progress, if any
+        self._metrics = None
+        Session = sessionmaker(bind=engine, autoflush=not readonly, expire_on_commit=not readonly)
         self._session = Session()
+        if readonly:
+            event.listen(self._session, 'before_flush', _refuse_flush)
+        # Whether some frequencies are stored, cached until the end of the transaction
+        self._frequencies = None
+        for identifier in ('after_flush', 'after_bulk_delete', 'after_commit', 'after_rollback'):
+            event.listen(self._session, identifier, self._forget_frequencies)
+        # Classes of the records returned by records(), per mapped class
+        self._record_classes = {}
         self._stoptime1 = aliased(StopTime, name="first_stop_time")
         self._stoptime2 = aliased(StopTime, name="second_stop_time")
         self._transfer_fromstop = aliased(Stop, name="tr_from_stop")
@@ -60,32 +112,330 @@ class Dao(object):
     def session(self):
         return self._session
 
+    def readonly(self):
+        """Return True if opened with readonly=True."""
+        return self._readonly
+
+    def compact_calendars(self):
+        """Return True if calendar dates are only stored as calendar bitmaps."""
+        return self._orm.compact_calendars
+
     def bulk_save_objects(self, objects):
         return self._session.bulk_save_objects(objects)
-        
+
+    def bulk_insert(self, clazz, columns, rows):
+        """Insert rows directly in the table mapped to clazz, w/o creating any ORM
+           object: a single core-level executemany, or a COPY FROM STDIN on PostgreSQL.
+           Each row is a plain tuple containing the values for the given columns,
+           in order. Inserted items are not tracked by the session."""
+        self._bulk_insert(self._orm.table(clazz), columns, rows)
+
+    def bulk_update(self, clazz, columns, rows):
+        """Update rows of the table mapped to clazz, given as plain tuples as for
+           bulk_insert(). Rows are matched on the primary key, whose columns must
+           be part of the given columns."""
+        table = self._orm.table(clazz)
+        keys = [ column.name for column in table.primary_key.columns ]
+        stmt = table.update().where(sqlalchemy.and_(*[ table.c[key] == sqlalchemy.bindparam('_' + key) for key in keys ])) \
+                .values({ column: sqlalchemy.bindparam('_' + column) for column in columns if column not in keys })
+        if rows:
+            self._session.flush()
+            self._session.execute(stmt, [ { '_' + column: value for column, value in zip(columns, row) } for row in rows ])
+
+    def bulk_delete(self, clazz, columns, rows):
+        """Delete rows of the table mapped to clazz matching the given values,
+           one tuple of values per row (usually the primary key columns)."""
+        self._bulk_delete(self._orm.table(clazz), columns, rows)
+
+    def _bulk_delete(self, table, columns, rows):
+        if not rows:
+            return
+        self._session.flush()
+        stmt = table.delete().where(sqlalchemy.and_(*[ table.c[column] == sqlalchemy.bindparam('_' + column) for column in columns ]))
+        self._session.execute(stmt, [ { '_' + column: value for column, value in zip(columns, row) } for row in rows ])
+
+    def feed_rows(self, clazz, columns, feed_id=""):
+        """Return all rows of a feed in the table mapped to clazz, as plain tuples of the given columns."""
+        table = self._orm.table(clazz)
+        query = sqlalchemy.select([ table.c[column] for column in columns ]).where(table.c.feed_id == feed_id)
+        return [ tuple(row) for row in self._session.execute(query) ]
+
+    def columns(self, clazz, columns, fltr=None, batch_size=10000):
+        """Return the given columns of the table mapped to clazz, as an ordered
+           dictionary of column name to column, w/o creating any ORM object.
+           Numbers are returned as numpy arrays if numpy is available, as
+           array.array otherwise; NULL numbers are NaN. IDs, strings and dates
+           are returned as DictionaryColumn. The filter is auto-joined as for
+           the other accessors. Rows are fetched batch_size at a time; frequency
+           templates are not expanded."""
+        table = self._orm.table(clazz)
+        builders = [ _ColumnBuilder(table.c[column].type) for column in columns if column in table.c ]
+        for rows in self._plain_rows(clazz, columns, fltr, batch_size):
+            for builder, values in zip(builders, zip(*rows)):
+                for value in values:
+                    builder.append(value)
+        return OrderedDict((column, builder.build()) for column, builder in zip(columns, builders))
+
+    def records(self, clazz, fltr=None, batch_size=1000):
+        """Yield the rows of the table mapped to clazz as immutable, detached
+           records (named tuples of the table columns, w/o relationships), not
+           tracked by the session. The filter is auto-joined as for the other
+           accessors. Rows are fetched batch_size at a time; frequency templates
+           are not expanded."""
+        table = self._orm.table(clazz)
+        record_class = self._record_classes.get(clazz)
+        if record_class is None:
+            record_class = self._record_classes[clazz] = namedtuple(clazz.__name__ + "Record", table.c.keys())
+        ncolumns = len(table.c)
+        for rows in self._plain_rows(clazz, table.c.keys(), fltr, batch_size):
+            for row in rows:
+                yield record_class._make(row[:ncolumns])
+
+    def _plain_rows(self, clazz, columns, fltr, batch_size):
+        """Yield batches of rows of the given columns of clazz, as returned by
+           a core-level query: no ORM object is created."""
+        table = self._orm.table(clazz)
+        for column in columns:
+            if column not in table.c:
+                raise ValueError("Unknown column %s for %s" % (column, clazz.__name__))
+        query = self._session.query(*[ getattr(clazz, column) for column in columns ])
+        if fltr is not None:
+            autojoiner = _AutoJoiner(self._orm, query, fltr)
+            query = autojoiner.autojoin().filter(fltr)
+            if clazz not in (CalendarDate, Transfer) and autojoiner.joins_any(CalendarDate, Transfer):
+                # Keep one row per item, as those joins may repeat it
+                query = query.add_columns(*table.primary_key.columns).distinct()
+        if batch_size <= 0:
+            batch_size = 1000
+        result = self._session.execute(query.statement.execution_options(stream_results=True))
+        try:
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            result.close()
+
+    def delete_trips(self, trip_ids, feed_id="", templates=()):
+        """Delete trips with their stop times and frequencies. Also delete trips
+           generated by the expansion of the given template trip IDs."""
+        trip_ids = list(trip_ids)
+        templates = list(templates)
+        self._session.flush()
+        for i in range(0, len(trip_ids), 500):
+            chunk = trip_ids[i:i + 500]
+            for clazz in (Frequency, StopTime, Trip):
+                self._session.query(clazz).filter((clazz.feed_id == feed_id) & clazz.trip_id.in_(chunk)) \
+                        .delete(synchronize_session=False)
+        for i in range(0, len(templates), 100):
+            # Expanded trip IDs are "<template ID>@<departure time>"
+            generated = sqlalchemy.or_(*[ Trip.trip_id.like(_like_escape(trip_id) + '@%', escape='\\')
+                                          for trip_id in templates[i:i + 100] ])
+            generated_ids = self._session.query(Trip.trip_id) \
+                    .filter((Trip.feed_id == feed_id) & (Trip.frequency_generated == True) & generated).subquery()
+            self._session.query(StopTime).filter((StopTime.feed_id == feed_id) & StopTime.trip_id.in_(generated_ids)) \
+                    .delete(synchronize_session=False)
+            self._session.query(Trip).filter((Trip.feed_id == feed_id) & (Trip.frequency_generated == True) & generated) \
+                    .delete(synchronize_session=False)
+
+    def entity_hashes(self, feed_id=""):
+        """Return the stored source data hashes of a feed, as a dictionary:
+           (kind, entity ID) -> hash."""
+        table = self._orm.entity_hashes_table
+        query = sqlalchemy.select([ table.c.kind, table.c.entity_id, table.c.hash ]).where(table.c.feed_id == feed_id)
+        return { (kind, entity_id): hsh for kind, entity_id, hsh in self._session.execute(query) }
+
+    def update_entity_hashes(self, changed, removed, feed_id=""):
+        """Store new or changed hashes, given as a dictionary: (kind, entity ID) -> hash,
+           and delete the removed ones, given as a list of (kind, entity ID)."""
+        table = self._orm.entity_hashes_table
+        self._bulk_delete(table, ('feed_id', 'kind', 'entity_id'),
+                          [ (feed_id, kind, entity_id) for kind, entity_id in itertools.chain(changed, removed) ])
+        self._bulk_insert(table, ('feed_id', 'kind', 'entity_id', 'hash'),
+                          [ (feed_id, kind, entity_id, hsh) for (kind, entity_id), hsh in changed.items() ])
+
+    def loader_state(self, feed_id=""):
+        """Return the state of an unfinished checkpointed import of a feed, as a
+           (source digest, phase, progress) tuple, or None."""
+        table = self._orm.loader_state_table
+        query = sqlalchemy.select([ table.c.source_digest, table.c.phase, table.c.progress ]).where(table.c.feed_id == feed_id)
+        row = self._session.execute(query).first()
+        return tuple(row) if row is not None else None
+
+    def store_loader_state(self, source_digest, phase, progress, feed_id=""):
+        table = self._orm.loader_state_table
+        self.clear_loader_state(feed_id)
+        self._session.execute(table.insert(), [ dict(feed_id=feed_id, source_digest=source_digest, phase=phase, progress=progress) ])
+
+    def clear_loader_state(self, feed_id=""):
+        table = self._orm.loader_state_table
+        self._session.execute(table.delete().where(table.c.feed_id == feed_id))
+
+    def _bulk_insert(self, table, columns, rows):
+        if not rows:
+            return
+        # Pending ORM objects may be referenced by the rows to insert
+        self._session.flush()
+        if self._copy_bulk_insert:
+            self._copy_from(table, columns, rows)
+        else:
+            self._session.execute(table.insert(), [ dict(zip(columns, row)) for row in rows ])
+
+    def snapping_cache(self, shape_hash):
+        """Return the persistent snapping cache entries of a shape geometry, as a
+           dictionary: stop pattern hash -> list of stop shape_dist_traveled."""
+        table = self._orm.snapping_cache_table
+        query = sqlalchemy.select([ table.c.pattern_hash, table.c.distances ]).where(table.c.shape_hash == shape_hash)
+        return { pattern_hash: [ float(d) for d in distances.split(',') ] for pattern_hash, distances in self._session.execute(query) }
+
+    def store_snapping_cache(self, shape_hash, entries):
+        """Store new snapping cache entries for a shape geometry, given as a
+           dictionary: stop pattern hash -> list of stop shape_dist_traveled."""
+        if not entries:
+            return
+        table = self._orm.snapping_cache_table
+        self._session.execute(table.insert(), [ dict(shape_hash=shape_hash, pattern_hash=pattern_hash,
+                                                     distances=','.join(repr(d) for d in distances))
+                                               for pattern_hash, distances in entries.items() ])
+
+    def clear_snapping_cache(self):
+        self._session.execute(self._orm.snapping_cache_table.delete())
+
+    def expand_frequencies(self, feed_id, departures, template_trip_ids):
+        """Create frequency-generated trips and their stop times from template
+           trips, then delete the templates. Each departure is a tuple
+           (trip_id, template_trip_id, time_offset, exact_times): the new trip
+           is a copy of the template with all times shifted by time_offset.
+           Copies are made in the database, with INSERT ... SELECT."""
+        departures_table = self._orm.frequency_departures_table
+        trips_table = self._orm.table(Trip)
+        stop_times_table = self._orm.table(StopTime)
+        self._bulk_insert(departures_table, ('feed_id', 'trip_id', 'template_trip_id', 'time_offset', 'exact_times'),
+                          [ (feed_id,) + departure for departure in departures ])
+        dep = departures_table.alias('dep')
+        trp = trips_table.alias('trp')
+        stt = stop_times_table.alias('stt')
+        # Note: shape ID and stop headsigns are not copied over
+        trips_select = sqlalchemy.select([ trp.c.feed_id, dep.c.trip_id, trp.c.route_id, trp.c.service_id,
+                    trp.c.wheelchair_accessible, trp.c.bikes_allowed, dep.c.exact_times,
+                    sqlalchemy.literal(True, type_=sqlalchemy.Boolean), trp.c.trip_headsign,
+                    trp.c.trip_short_name, trp.c.direction_id, trp.c.block_id ]) \
+                .select_from(dep.join(trp, (trp.c.feed_id == dep.c.feed_id) & (trp.c.trip_id == dep.c.template_trip_id))) \
+                .where(dep.c.feed_id == feed_id)
+        self._session.execute(trips_table.insert().from_select([ 'feed_id', 'trip_id', 'route_id', 'service_id',
+                    'wheelchair_accessible', 'bikes_allowed', 'exact_times', 'frequency_generated',
+                    'trip_headsign', 'trip_short_name', 'direction_id', 'block_id' ], trips_select))
+        stop_times_select = sqlalchemy.select([ stt.c.feed_id, dep.c.trip_id, stt.c.stop_id, stt.c.stop_sequence,
+                    stt.c.arrival_time + dep.c.time_offset, stt.c.departure_time + dep.c.time_offset,
+                    stt.c.shape_dist_traveled, stt.c.interpolated, stt.c.timepoint,
+                    stt.c.pickup_type, stt.c.drop_off_type ]) \
+                .select_from(dep.join(stt, (stt.c.feed_id == dep.c.feed_id) & (stt.c.trip_id == dep.c.template_trip_id))) \
+                .where(dep.c.feed_id == feed_id)
+        self._session.execute(stop_times_table.insert().from_select([ 'feed_id', 'trip_id', 'stop_id', 'stop_sequence',
+                    'arrival_time', 'departure_time', 'shape_dist_traveled', 'interpolated', 'timepoint',
+                    'pickup_type', 'drop_off_type' ], stop_times_select))
+        template_trip_ids = list(template_trip_ids)
+        for i in range(0, len(template_trip_ids), 500):
+            chunk = template_trip_ids[i:i + 500]
+            self._session.execute(stop_times_table.delete()
+                    .where((stop_times_table.c.feed_id == feed_id) & stop_times_table.c.trip_id.in_(chunk)))
+            self._session.execute(trips_table.delete()
+                    .where((trips_table.c.feed_id == feed_id) & trips_table.c.trip_id.in_(chunk)))
+        self._session.execute(departures_table.delete().where(departures_table.c.feed_id == feed_id))
+
+    def _copy_from(self, table, columns, rows):
+        # Use the DBAPI connection of the session, so that COPY
+        # runs inside the current transaction.
+        buf = six.StringIO()
+        for row in rows:
+            buf.write(six.u('\t').join(_copy_text_value(value) for value in row))
+            buf.write(six.u('\n'))
+        buf.seek(0)
+        sql = "COPY %s (%s) FROM STDIN" % (self._identifier_preparer.format_table(table),
+                    ", ".join(self._identifier_preparer.quote(column) for column in columns))
+        cursor = self._session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(sql, buf)
+        finally:
+            cursor.close()
+        if self._metrics is not None:
+            # Not seen by SQLAlchemy events
+            self._metrics.count_rows(len(rows))
+
     def add(self, obj):
         self._session.add(obj)
         
     def add_all(self, objs):
         self._session.add_all(objs)
 
+    def merge(self, obj):
+        return self._session.merge(obj)
+
     def delete(self, obj):
         self._session.delete(obj)
         
+    def _partition_name(self, table, feed_id, state="", qualified=True):
+        # Feed IDs can be any string, use a digest to build valid table names
+        suffix = hashlib.sha1(feed_id.encode('utf-8')).hexdigest()[:16]
+        name = self._identifier_preparer.quote("%s_%s%s" % (table.name, suffix, state))
+        if qualified and table.schema is not None:
+            name = "%s.%s" % (self._identifier_preparer.quote_schema(table.schema), name)
+        return name
+
+    def _feed_id_literal(self, feed_id):
+        dialect = self._session.bind.dialect
+        return sqlalchemy.literal(feed_id, sqlalchemy.String).compile(dialect=dialect, compile_kwargs={ 'literal_binds': True })
+
+    def create_partitions(self, feed_id=""):
+        """Create the partitions storing the largest tables of a feed, if the
+           database is partitioned and they do not exist yet."""
+        value = self._feed_id_literal(feed_id)
+        for table in self._orm.partitioned_tables:
+            self._session.execute("CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES IN (%s)" %
+                                  (self._partition_name(table, feed_id), self._identifier_preparer.format_table(table), value))
+
     def delete_feed(self, feed_id):
+        if self._orm.partitioned_tables:
+            # Much faster than deleting rows, and no dead rows left behind
+            self._session.flush()
+            for table in self._orm.partitioned_tables:
+                self._session.execute("DROP TABLE IF EXISTS %s" % self._partition_name(table, feed_id))
         self._session.query(FareRule).filter(FareRule.feed_id == feed_id).delete(synchronize_session=False)
         self._session.query(FareAttribute).filter(FareAttribute.feed_id == feed_id).delete(synchronize_session=False)
+        self._session.query(Frequency).filter(Frequency.feed_id == feed_id).delete(synchronize_session=False)
         self._session.query(StopTime).filter(StopTime.feed_id == feed_id).delete(synchronize_session=False)
         self._session.query(Trip).filter(Trip.feed_id == feed_id).delete(synchronize_session=False)
         self._session.query(ShapePoint).filter(ShapePoint.feed_id == feed_id).delete(synchronize_session=False)
         self._session.query(Shape).filter(Shape.feed_id == feed_id).delete(synchronize_session=False)
-        self._session.query(CalendarDate).filter(CalendarDate.feed_id == feed_id).delete(synchronize_session=False)
+        if not self._orm.compact_calendars:
+            self._session.query(CalendarDate).filter(CalendarDate.feed_id == feed_id).delete(synchronize_session=False)
         self._session.query(Calendar).filter(Calendar.feed_id == feed_id).delete(synchronize_session=False)
         self._session.query(Route).filter(Route.feed_id == feed_id).delete(synchronize_session=False)
+        self._session.query(Transfer).filter(Transfer.feed_id == feed_id).delete(synchronize_session=False)
         self._session.query(Stop).filter(Stop.feed_id == feed_id).delete(synchronize_session=False)
         self._session.query(Agency).filter(Agency.feed_id == feed_id).delete(synchronize_session=False)
         self._session.query(Zone).filter(Zone.feed_id == feed_id).delete(synchronize_session=False)
         self._session.query(FeedInfo).filter(FeedInfo.feed_id == feed_id).delete()
+        entity_hashes = self._orm.entity_hashes_table
+        self._session.execute(entity_hashes.delete().where(entity_hashes.c.feed_id == feed_id))
+        self.clear_loader_state(feed_id)
+
+    def copy_feed(self, from_feed_id, to_feed_id):
+        """Copy all data of a feed under another, not existing, feed ID.
+           Rows are copied by the database, w/o loading any object."""
+        self._session.flush()
+        self.create_partitions(to_feed_id)
+        self._copy_feed_rows(from_feed_id, to_feed_id, self._orm.feed_tables())
+
+    def _copy_feed_rows(self, from_feed_id, to_feed_id, tables):
+        for table in tables:
+            # Surrogate keys (fare rules) are generated anew
+            columns = [ column for column in table.c if column.autoincrement is not True ]
+            select = sqlalchemy.select([ sqlalchemy.literal(to_feed_id, sqlalchemy.String).label('feed_id')
+                                         if column.name == 'feed_id' else column for column in columns ]) \
+                    .where(table.c.feed_id == from_feed_id)
+            self._session.execute(table.insert().from_select([ column.name for column in columns ], select))
 
     def commit(self):
         self._session.commit()
@@ -141,8 +491,6 @@ class Dao(object):
         if fltr is not None:
             idquery = _AutoJoiner(self._orm, idquery, fltr).autojoin()
             idquery = idquery.filter(fltr)
-        # Only query IDs first
-        stopids = idquery.all()
         def query_factory():
             query = self._session.query(Stop)
             if prefetch_parent:
@@ -150,7 +498,7 @@ class Dao(object):
                 if prefetch_substops:
                     query = query.options(subqueryload('sub_stops'))
             return query
-        return self._page_query(query_factory, Stop.feed_id, Stop.stop_id, stopids, batch_size)
+        return self._page_query(query_factory, Stop.feed_id, Stop.stop_id, idquery, batch_size)
 
     def in_area(self, area):
         """Return a filter filtering stops in the given area (RectangularArea...)"""
@@ -246,21 +594,42 @@ class Dao(object):
         return [ date for (date,) in query.all() ]
 
     def trip(self, trip_id, feed_id="", prefetch_stop_times=True):
+        """Also return the transient expanded trips of frequency-based template
+           trips (see trips()), given their "<template_id>@<departure time>" ID."""
         query = self._session.query(Trip)
         if prefetch_stop_times:
             query = query.options(subqueryload('stop_times'))
-        return query.get((feed_id, trip_id))
+        trip = query.get((feed_id, trip_id))
+        if trip is None and '@' in trip_id and self._has_frequencies():
+            template_id, departure = trip_id.rsplit('@', 1)
+            try:
+                departure_time = gtfstime(*[ int(part) for part in departure.split(':') ])
+            except (TypeError, ValueError):
+                return None
+            idquery = self._session.query(Trip.feed_id, Trip.trip_id).filter((Trip.feed_id == feed_id) & (Trip.trip_id == template_id))
+            for _, _, template_departure_time, exact_times in self._frequency_departures(idquery, None, Trip.feed_id, Trip.trip_id):
+                if template_departure_time == departure_time:
+                    # Template stop times are always needed for the expansion
+                    template = self._session.query(Trip).options(subqueryload('stop_times')).get((feed_id, template_id))
+                    return _expand_trip(template, departure_time, exact_times)
+        return trip
     
-    def trips(self, fltr=None, prefetch_stop_times=True, prefetch_routes=False, prefetch_stops=False, prefetch_calendars=False, batch_size=800):
+    def trips(self, fltr=None, prefetch_stop_times=True, prefetch_routes=False, prefetch_stops=False, prefetch_calendars=False, batch_size=800,
+              expand_frequencies=True):
+        """Frequency-based template trips (see load_gtfs lazy_frequencies) are replaced
+           by transient expanded trips, unless expand_frequencies is False. The filter
+           is then evaluated for each departure, with stop times shifted accordingly."""
         idquery = self._session.query(Trip.feed_id, Trip.trip_id).distinct()
         if fltr is not None:
             idquery = _AutoJoiner(self._orm, idquery, fltr).autojoin()
+        freqquery = None
+        if expand_frequencies and self._has_frequencies():
+            freqquery = self._frequency_departures(idquery, fltr, Trip.feed_id, Trip.trip_id)
+            idquery = idquery.filter(~self._frequency_exists(Trip.feed_id, Trip.trip_id))
+        if fltr is not None:
             idquery = idquery.filter(fltr)
-        # Only query IDs first
-        tripids = idquery.all()
-        def query_factory():
+        def query_factory(_prefetch_stop_times=prefetch_stop_times):
             query = self._session.query(Trip)
-            _prefetch_stop_times = prefetch_stop_times
             if prefetch_stops:
                 _prefetch_stop_times = True
             if _prefetch_stop_times:
@@ -273,15 +642,43 @@ class Dao(object):
             if prefetch_calendars:
                 query = query.options(subqueryload('calendar'))
             return query
-        return self._page_query(query_factory, Trip.feed_id, Trip.trip_id, tripids, batch_size)
+        trips = self._page_query(query_factory, Trip.feed_id, Trip.trip_id, idquery, batch_size)
+        if freqquery is None:
+            return trips
+        def expanded_trips():
+            departures = defaultdict(list)
+            for feed_id, trip_id, departure_time, exact_times in freqquery.all():
+                departures[(feed_id, trip_id)].append((departure_time, exact_times))
+            # Template stop times are always needed for the expansion
+            templates = self._page_query(lambda: query_factory(True), Trip.feed_id, Trip.trip_id, departures.keys(), batch_size)
+            for template in templates:
+                for departure_time, exact_times in sorted(departures[(template.feed_id, template.trip_id)]):
+                    yield _expand_trip(template, departure_time, exact_times)
+        return itertools.chain(trips, expanded_trips())
 
-    def stoptimes(self, fltr=None, prefetch_trips=True, prefetch_stop_times=False):
+    def stoptimes(self, fltr=None, prefetch_trips=True, prefetch_stop_times=False, expand_frequencies=True,
+                  stream=False, batch_size=1000):
+        """Stop times of frequency-based template trips are replaced by the stop
+           times of transient expanded trips, as for trips(). With stream=True,
+           return a generator instead of a list: see _stream_query()."""
         query = self._session.query(StopTime).distinct()
         if fltr is not None:
             query = _AutoJoiner(self._orm, query, fltr).autojoin()
+        freqquery = None
+        if expand_frequencies and self._has_frequencies():
+            freqquery = self._frequency_departures(query, fltr, StopTime.feed_id, StopTime.trip_id)
+            query = query.filter(~self._frequency_exists(StopTime.feed_id, StopTime.trip_id))
+        if fltr is not None:
             query = query.filter(fltr)
         if prefetch_stop_times:
             prefetch_trips = True
+        if stream:
+            stoptimes = self._stream_query(query, lambda stoptime: (stoptime,), batch_size, prefetch_trips, prefetch_stop_times)
+            if freqquery is None:
+                return stoptimes
+            # Grouped by template trip, only one is expanded at a time
+            freqquery = freqquery.order_by(StopTime.feed_id, StopTime.trip_id).yield_per(batch_size)
+            return itertools.chain(stoptimes, self._expanded_stoptimes(freqquery, True))
         if prefetch_trips:
             loadopt = subqueryload('trip')
             if prefetch_stop_times:
@@ -290,7 +687,93 @@ class Dao(object):
         # Note: ID batching would be difficult to implement for StopTime
         # as StopTime do have a composite-primary composed of 3 elements
         # and 2 of them (trip_id + stop_seq) can't be grouped easily.
-        return query.all()
+        stoptimes = query.all()
+        if freqquery is not None:
+            stoptimes.extend(self._expanded_stoptimes(freqquery.all(), False))
+        return stoptimes
+
+    def _expanded_stoptimes(self, rows, grouped):
+        # rows: (template stop time, departure time, exact times). If grouped,
+        # rows of a template trip are consecutive: expansions of the previous
+        # template can be forgotten.
+        expanded = {}
+        template_key = None
+        for template_stoptime, departure_time, exact_times in rows:
+            if grouped and (template_stoptime.feed_id, template_stoptime.trip_id) != template_key:
+                template_key = (template_stoptime.feed_id, template_stoptime.trip_id)
+                expanded = {}
+            key = (template_stoptime.feed_id, template_stoptime.trip_id, departure_time)
+            trip = expanded.get(key)
+            if trip is None:
+                trip = expanded[key] = _expand_trip(template_stoptime.trip, departure_time, exact_times)
+            for stoptime in trip.stop_times:
+                if stoptime.stop_sequence == template_stoptime.stop_sequence:
+                    yield stoptime
+
+    def _stream_query(self, query, stoptimes_of, batch_size, prefetch_trips, prefetch_stop_times):
+        """Yield the rows of query, fetched batch_size at a time using yield_per: a
+           server-side (named) cursor on PostgreSQL, incremental fetching on SQLite.
+           Trips of the stop times of each row (given by stoptimes_of) are loaded
+           at once for each batch. Memory use does not depend on the number of
+           rows, as long as the caller does not keep them."""
+        if batch_size <= 0:
+            batch_size = 1000
+        rows = iter(query.yield_per(batch_size))
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            if prefetch_trips:
+                self._prefetch_trips([ stoptime for row in batch for stoptime in stoptimes_of(row) ], prefetch_stop_times)
+            for row in batch:
+                yield row
+
+    def _prefetch_trips(self, stoptimes, prefetch_stop_times):
+        def query_factory():
+            query = self._session.query(Trip)
+            if prefetch_stop_times:
+                query = query.options(subqueryload('stop_times'))
+            return query
+        trip_ids = set((stoptime.feed_id, stoptime.trip_id) for stoptime in stoptimes)
+        trips = { (trip.feed_id, trip.trip_id): trip
+                  for trip in self._page_query(query_factory, Trip.feed_id, Trip.trip_id, trip_ids, len(trip_ids)) }
+        for stoptime in stoptimes:
+            set_committed_value(stoptime, 'trip', trips.get((stoptime.feed_id, stoptime.trip_id)))
+
+    def _has_frequencies(self):
+        if self._frequencies is None:
+            self._frequencies = self._frequencies_table and self._session.query(Frequency.trip_id).first() is not None
+        return self._frequencies
+
+    def _forget_frequencies(self, *args):
+        self._frequencies = None
+
+    def _frequency_exists(self, item_feed_id_column, item_trip_id_column):
+        frequencies = self._orm.table(Frequency)
+        return sqlalchemy.exists().where((frequencies.c.feed_id == item_feed_id_column) & (frequencies.c.trip_id == item_trip_id_column))
+
+    def _frequency_departures(self, query, fltr, item_feed_id_column, item_trip_id_column):
+        # Restrict the query to items of template trips, one row per departure,
+        # adding the departure time and exact_times columns. Departures are
+        # enumerated with a recursive series; the filter is evaluated with
+        # stop times shifted from the template to the departure.
+        frequencies = self._orm.table(Frequency)
+        stop_times = self._orm.table(StopTime)
+        max_departures = self._session.query(sqlalchemy.func.max(
+                    (frequencies.c.end_time - frequencies.c.start_time + frequencies.c.headway_secs - 1) / frequencies.c.headway_secs)).scalar()
+        series = sqlalchemy.select([ sqlalchemy.literal_column('0').label('n') ]).cte('departure_series', recursive=True)
+        series = series.union_all(sqlalchemy.select([ series.c.n + 1 ]).where(series.c.n < (max_departures or 0) - 1))
+        departure_time = frequencies.c.start_time + series.c.n * frequencies.c.headway_secs
+        query = query.join(frequencies, (frequencies.c.feed_id == item_feed_id_column) & (frequencies.c.trip_id == item_trip_id_column)) \
+                .join(series, departure_time < frequencies.c.end_time) \
+                .add_columns(departure_time.label('departure_time'), frequencies.c.exact_times)
+        if fltr is not None:
+            first_stop_times = stop_times.alias('first_stop_times')
+            base_time = sqlalchemy.select([ first_stop_times.c.departure_time ]) \
+                    .where((first_stop_times.c.feed_id == item_feed_id_column) & (first_stop_times.c.trip_id == item_trip_id_column)) \
+                    .order_by(first_stop_times.c.stop_sequence).limit(1).as_scalar()
+            query = query.filter(_shift_stop_times(fltr, stop_times, departure_time - base_time))
+        return query
 
     def hop_first(self):
         return self._stoptime1
@@ -298,13 +781,38 @@ class Dao(object):
     def hop_second(self):
         return self._stoptime2
 
-    def hops(self, delta=1, fltr=None, prefetch_trips=True, prefetch_stop_times=False):
-        query = self._session.query(self._stoptime1, self._stoptime2).filter((self._stoptime1.trip_id == self._stoptime2.trip_id) & ((self._stoptime1.stop_sequence + delta) == self._stoptime2.stop_sequence)).distinct()
+    def hops(self, delta=1, fltr=None, prefetch_trips=True, prefetch_stop_times=False, stream=False, batch_size=1000,
+             window=False):
+        """Return pairs of stop times of the same trip, delta stops apart. With
+           stream=True, return a generator instead of a list: see _stream_query().
+           Both stop times are of the same feed (up to 1.0.0, pairs of stop
+           times of different feeds sharing a trip ID were returned too).
+           With window=True, pairs are computed with a LEAD() window function
+           over stop times (one scan, no self-join): see _window_hops(). The
+           pairs are the same, unless stop sequences have gaps (imports w/o
+           normalization): pairs skipping a gap are then left out. On
+           SQLite this is about 15% slower than the indexed self-join for all
+           the hops of a feed, and about 20% faster with a filter needing
+           joins (e.g. on dates): hence off by default."""
+        if prefetch_stop_times:
+            prefetch_trips = True
+        if window:
+            query = self._window_hops(delta, fltr)
+            if stream:
+                return self._stream_query(query, lambda hop: hop, batch_size, prefetch_trips, prefetch_stop_times)
+            # Loader options do not apply to the window statement, trips are prefetched by batches
+            hops = query.all()
+            if prefetch_trips:
+                batch_size = batch_size if batch_size > 0 else 1000
+                for i in range(0, len(hops), batch_size):
+                    self._prefetch_trips([ stoptime for hop in hops[i:i + batch_size] for stoptime in hop ], prefetch_stop_times)
+            return hops
+        query = self._session.query(self._stoptime1, self._stoptime2).filter((self._stoptime1.feed_id == self._stoptime2.feed_id) & (self._stoptime1.trip_id == self._stoptime2.trip_id) & ((self._stoptime1.stop_sequence + delta) == self._stoptime2.stop_sequence)).distinct()
         if fltr is not None:
             query = _AutoJoiner(self._orm, query, fltr).autojoin()
             query = query.filter(fltr)
-        if prefetch_stop_times:
-            prefetch_trips = True
+        if stream:
+            return self._stream_query(query, lambda hop: hop, batch_size, prefetch_trips, prefetch_stop_times)
         if prefetch_trips:
             loadopt = subqueryload('trip')
             if prefetch_stop_times:
@@ -312,6 +820,50 @@ class Dao(object):
             query = query.options(loadopt)
         return query.all()
 
+    def _window_hops(self, delta, fltr):
+        # Each stop time row carries the columns of the stop time delta rows
+        # after it in its trip (LEAD). Filters on hop_first() / hop_second()
+        # (or StopTime) are rewritten against these columns, other entities
+        # are auto-joined to the first stop time. The rows are then loaded as
+        # (hop_first, hop_second) instances from their labelled columns.
+        engine = self._session.bind
+        if engine.dialect.name == 'sqlite' and engine.dialect.dbapi.sqlite_version_info < (3, 25):
+            raise ValueError("Window functions require SQLite 3.25+, found %s" % engine.dialect.dbapi.sqlite_version)
+        stop_times = self._orm.table(StopTime)
+        partition = (stop_times.c.feed_id, stop_times.c.trip_id)
+        over = dict(partition_by=partition, order_by=stop_times.c.stop_sequence)
+        hop_window = sqlalchemy.select(list(stop_times.c) +
+                    [ sqlalchemy.func.lead(column, delta).over(**over).label('next_' + column.name)
+                      for column in stop_times.c if column.name not in ('feed_id', 'trip_id') ]) \
+                .alias('hop_window')
+        def second(name):
+            # Both stop times are of the same partition (trip)
+            return hop_window.c.get('next_' + name, hop_window.c[name])
+        first = aliased(StopTime, hop_window)
+        query = self._session.query(first).filter(hop_window.c.next_stop_sequence == hop_window.c.stop_sequence + delta)
+        if fltr is not None:
+            stoptime1 = sqlalchemy.inspect(self._stoptime1).selectable
+            stoptime2 = sqlalchemy.inspect(self._stoptime2).selectable
+            def replace(elem):
+                if isinstance(elem, sqlalchemy.Column):
+                    if elem.table is stop_times or elem.table is stoptime1:
+                        return hop_window.c[elem.name]
+                    if elem.table is stoptime2:
+                        return second(elem.name)
+                return None
+            fltr = replacement_traverse(fltr, {}, replace)
+            autojoiner = _AutoJoiner(self._orm, query, fltr)
+            query = autojoiner.autojoin().filter(fltr)
+            if autojoiner.joins_any(CalendarDate, Transfer):
+                # The only joins that may repeat a hop
+                query = query.distinct()
+        columns = [ hop_window.c[column.name].label('first_stop_time_' + column.name) for column in stop_times.c ] + \
+                  [ second(column.name).label('second_stop_time_' + column.name) for column in stop_times.c ]
+        hops = query.with_entities(*columns).subquery('hops')
+        # Result columns are matched to the hop_first() / hop_second() columns by label
+        statement = sqlalchemy.select([ sqlalchemy.column(c.name, c.type) for c in hops.c ]).select_from(hops)
+        return self._session.query(self._stoptime1, self._stoptime2).from_statement(statement)
+
     def shape(self, shape_id, feed_id="", prefetch_shape_points=True):
         query = self._session.query(Shape)
         if prefetch_shape_points:
@@ -323,14 +875,12 @@ class Dao(object):
         if fltr is not None:
             idquery = _AutoJoiner(self._orm, idquery, fltr).autojoin()
             idquery = idquery.filter(fltr)
-        # Only query IDs first
-        shapeids = idquery.all()
         def query_factory():
             query = self._session.query(Shape)
             if prefetch_points:
                 query = query.options(subqueryload('points'))
             return query
-        return self._page_query(query_factory, Shape.feed_id, Shape.shape_id, shapeids, batch_size)
+        return self._page_query(query_factory, Shape.feed_id, Shape.shape_id, idquery, batch_size)
 
     def fare_attribute(self, fare_id, feed_id="", prefetch_fare_rules=True):
         query = self._session.query(FareAttribute)
@@ -366,21 +916,237 @@ class Dao(object):
         return query.all()
 
     def _page_query(self, query_factory, item_feed_id_column, item_id_column, ids, batch_size):
+        """Yield items by batches. ids are (feed_id, item_id) pairs, either as a
+           list or as a query returning them; such a query is paginated over
+           (feed_id, item_id) ranges, so only one batch of IDs is held at a time."""
         if batch_size <= 0:
             batch_size = 1000
-        for feed_id, item_ids in group_pairs(ids, batch_size):
+        if isinstance(ids, Query):
+            pages = self._keyset_pages(ids, item_feed_id_column, item_id_column, batch_size)
+        else:
+            pages = group_pairs(ids, batch_size)
+        for feed_id, item_ids in pages:
             query = query_factory()
             query = query.filter((item_feed_id_column == feed_id) & (item_id_column.in_(item_ids)))
             batch = query.all()
             for item in batch:
                 yield item
 
-    def load_gtfs(self, filename, feed_id="", lenient=False, disable_normalization=False, **kwargs):
+    def _keyset_pages(self, idquery, feed_id_column, id_column, batch_size):
+        # Resume after the last ID of the previous page, instead of using an
+        # OFFSET, so that each page is an index range scan when not filtered
+        last = None
+        while True:
+            query = idquery
+            if last is not None:
+                query = query.filter((feed_id_column > last[0]) | ((feed_id_column == last[0]) & (id_column > last[1])))
+            page = query.order_by(feed_id_column, id_column).limit(batch_size).all()
+            for feed_id, rows in itertools.groupby(page, key=lambda row: row[0]):
+                yield feed_id, [ item_id for _, item_id in rows ]
+            if len(page) < batch_size:
+                return
+            last = page[-1]
+
+    def load_gtfs(self, filename, feed_id="", lenient=False, disable_normalization=False, bulk_load=False, staging=False,
+                  checkpointed=False, resume=False, metrics=None, **kwargs):
+        """Load a GTFS into the database, under the given feed ID. The GTFS is
+           a zip file, or a directory of plain and/or gzipped (.txt.gz) tables.
+           Pass snapping_cache=True to keep stop-to-shape snapping results
+           in the database and re-use them across imports, and jobs=N to
+           parse stop times with N processes. See bulk_load_mode() for
+           bulk_load=True. With lazy_frequencies=True frequencies are stored
+           with their template trips instead of being expanded into trips;
+           trips() and stoptimes() expand them on the fly. With incremental=True
+           an existing feed is updated in place: only new, changed or removed
+           entities are written, and only changed trips are normalized. With
+           staging=True the feed is first imported under a temporary feed ID,
+           then replaces any existing feed in a single, shorter, transaction:
+           readers see the old feed until the new one is complete. The swap
+           copies the staged rows (INSERT ... SELECT) and deletes the old ones,
+           so it grows with the feed size; on a partitioned database, stop
+           times and shape points are copied before the swap, which only
+           attaches them (see _swap_partitions()). The staged feed is deleted
+           after the swap.
+           With checkpointed=True each phase of the import is committed
+           separately, and an interrupted import can be continued with
+           resume=True, from the same file, instead of being restarted
+           (resuming a complete import does nothing); restarting it requires
+           deleting the feed first. Pass an ImportMetrics
+           instance as metrics to measure each phase of the import."""
+        if self._readonly:
+            raise ValueError("Can not load a GTFS with a read-only DAO")
+        if resume:
+            checkpointed = True
+        if staging and kwargs.get('incremental'):
+            raise ValueError("Staging and incremental loads are mutually exclusive")
+        if checkpointed and kwargs.get('incremental'):
+            raise ValueError("Checkpointed and incremental loads are mutually exclusive")
+        load_feed_id = _STAGING_FEED_ID % feed_id if staging else feed_id
+        if not resume and not staging and self.loader_state(load_feed_id) is not None:
+            # Staging loads delete their own leftovers
+            raise ValueError("Feed '%s' has an unfinished checkpointed import: resume it with resume=True, or delete the feed first" % feed_id)
+        if resume and self.loader_state(load_feed_id) is None and self.feed(load_feed_id) is not None:
+            # Import already complete, nothing to resume
+            return
+        if metrics is not None:
+            metrics.start(feed_id, self._session.bind, self._session)
+            self._metrics = metrics
+        try:
+            self._load_gtfs(filename, feed_id, load_feed_id, lenient, disable_normalization, bulk_load, staging,
+                            checkpointed, resume, metrics, **kwargs)
+        finally:
+            if metrics is not None:
+                self._metrics = None
+                metrics.stop()
+
+    def _load_gtfs(self, filename, feed_id, load_feed_id, lenient, disable_normalization, bulk_load, staging,
+                   checkpointed, resume, metrics, **kwargs):
+        source_digest = _file_digest(filename) if checkpointed else None
         @transactional(self.session())
         def _do_load_gtfs():
-            with Gtfs(ZipFileSource(filename)).load() as gtfs:
-                _convert_gtfs_model(feed_id, gtfs, self, lenient, disable_normalization, **kwargs)
-        _do_load_gtfs()
+            with Gtfs(open_source(filename)).load() as gtfs:
+                _convert_gtfs_model(load_feed_id, gtfs, self, lenient, disable_normalization,
+                                    checkpointed=checkpointed, resume=resume, source_digest=source_digest,
+                                    metrics=metrics, **kwargs)
+        if staging and not resume:
+            # Leftovers of a failed staging load
+            self.delete_feed(load_feed_id)
+            self.commit()
+        try:
+            if bulk_load:
+                with self.bulk_load_mode():
+                    _do_load_gtfs()
+                    if metrics is not None:
+                        metrics.begin_phase('indexes')
+            else:
+                _do_load_gtfs()
+        except:
+            # Checkpointed staging loads are kept to be resumed
+            if staging and not checkpointed:
+                self.delete_feed(load_feed_id)
+                self.commit()
+            raise
+        if staging:
+            if metrics is not None:
+                metrics.begin_phase('swap')
+            if self._orm.partitioned_tables:
+                self._swap_partitions(load_feed_id, feed_id)
+            else:
+                @transactional(self.session())
+                def _swap_staging():
+                    self.delete_feed(feed_id)
+                    self.copy_feed(load_feed_id, feed_id)
+                _swap_staging()
+            # Out of the swap transaction
+            self.delete_feed(load_feed_id)
+            self.commit()
+
+    def _swap_partitions(self, from_feed_id, to_feed_id):
+        """Replace a feed by a copy of another, on a partitioned database. The rows
+           of the partitioned tables are first copied into standalone tables, with
+           the final feed ID and all indexes. The swap transaction then detaches
+           the old partitions, replaces the rows of the other (small) tables, and
+           attaches the new tables in their place. Old partitions are dropped once
+           the swap is committed."""
+        preparer = self._identifier_preparer
+        value = self._feed_id_literal(to_feed_id)
+        partitioned_tables = self._orm.partitioned_tables
+
+        @transactional(self.session())
+        def _prepare_partitions():
+            for table in partitioned_tables:
+                columns = [ preparer.quote(column.name) for column in table.c ]
+                new_partition = self._partition_name(table, to_feed_id, "_new")
+                # Leftovers of a failed swap
+                for leftover in (new_partition, self._partition_name(table, to_feed_id, "_old")):
+                    self._session.execute("DROP TABLE IF EXISTS %s" % leftover)
+                # The CHECK constraint saves the validation scan when attaching the table
+                self._session.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING INDEXES, CHECK (feed_id = %s))" %
+                                      (new_partition, preparer.format_table(table), value))
+                self._session.execute("INSERT INTO %s (%s) SELECT %s FROM %s WHERE feed_id = %s" %
+                                      (new_partition, ", ".join(columns),
+                                       ", ".join(value if column.name == 'feed_id' else preparer.quote(column.name) for column in table.c),
+                                       preparer.format_table(table), self._feed_id_literal(from_feed_id)))
+        _prepare_partitions()
+
+        @transactional(self.session())
+        def _swap_staging():
+            for table in partitioned_tables:
+                partition = self._partition_name(table, to_feed_id)
+                if self._session.execute("SELECT to_regclass(:name) IS NOT NULL", dict(name=partition)).scalar():
+                    self._session.execute("ALTER TABLE %s DETACH PARTITION %s" % (preparer.format_table(table), partition))
+                    # The old rows must not reference the rows replaced below
+                    foreign_keys = self._session.execute("SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(:name) AND contype = 'f'",
+                                                         dict(name=partition)).fetchall()
+                    for (constraint_name,) in foreign_keys:
+                        self._session.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (partition, preparer.quote(constraint_name)))
+                    self._session.execute("ALTER TABLE %s RENAME TO %s" %
+                                          (partition, self._partition_name(table, to_feed_id, "_old", qualified=False)))
+            self.delete_feed(to_feed_id)
+            partitioned_names = set(table.name for table in partitioned_tables)
+            self._copy_feed_rows(from_feed_id, to_feed_id, [ table for table in self._orm.feed_tables() if table.name not in partitioned_names ])
+            for table in partitioned_tables:
+                new_partition = self._partition_name(table, to_feed_id, "_new")
+                self._session.execute("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES IN (%s)" % (preparer.format_table(table), new_partition, value))
+                self._session.execute("ALTER TABLE %s RENAME TO %s" % (new_partition, self._partition_name(table, to_feed_id, qualified=False)))
+        _swap_staging()
+
+        for table in partitioned_tables:
+            self._session.execute("DROP TABLE IF EXISTS %s" % self._partition_name(table, to_feed_id, "_old"))
+        self.commit()
+
+    @contextmanager
+    def bulk_load_mode(self):
+        """Context manager for loading large amounts of data. Secondary indexes
+           are dropped, then rebuilt on exit, even on error. On SQLite, the
+           durability settings are relaxed (no sync, in-memory journal, large
+           page cache) and restored on exit: a crash during the load may
+           corrupt the database. Rebuilding indexes covers all the data, so
+           this only pays off when loading a large share of the database.
+           Pending changes are committed on entry; changes made in the block
+           are committed on exit, or rolled back on error."""
+        engine = self._session.bind
+        # Switching connections would discard them
+        self._session.commit()
+        self._session.close()
+        # Pin a single connection, as SQLite pragmas are per connection
+        connection = engine.connect()
+        self._session.bind = connection
+        try:
+            pragmas = {}
+            if engine.dialect.name == 'sqlite':
+                for pragma, value in _SQLITE_BULK_LOAD_PRAGMAS:
+                    pragmas[pragma] = connection.execute("PRAGMA %s" % pragma).scalar()
+                    connection.execute("PRAGMA %s=%s" % (pragma, value))
+            indexes = self._orm.indexes()
+            for index in indexes:
+                index.drop(bind=connection)
+            try:
+                yield
+                self._session.commit()
+            except:
+                self._session.rollback()
+                raise
+            finally:
+                self._session.close()
+                inspector = sqlalchemy.inspect(connection)
+                existing = set()
+                for table in set(index.table for index in indexes):
+                    try:
+                        existing.update(idx['name'] for idx in inspector.get_indexes(table.name, schema=table.schema))
+                    except NoSuchTableError:
+                        # Partitioned tables are not reflected, their indexes were dropped above
+                        pass
+                for index in indexes:
+                    if index.name not in existing:
+                        index.create(bind=connection)
+                for pragma, value in _SQLITE_BULK_LOAD_PRAGMAS:
+                    if pragma in pragmas:
+                        connection.execute("PRAGMA %s=%s" % (pragma, pragmas[pragma]))
+        finally:
+            self._session.close()
+            self._session.bind = engine
+            connection.close()
 
 class _AutoJoiner(object):
 
@@ -478,12 +1244,112 @@ class _AutoJoiner(object):
 
         return self._query
 
+    def joins_any(self, *classes):
+        """After autojoin(), return True if the filter uses any of the given classes."""
+        return any(self._orm.table(clazz).name in self._join_tables for clazz in classes)
+
     def _recurse_inspect(self, fltr_node):
         if hasattr(fltr_node, "table"):
             self._join_tables.add(fltr_node.table.name)
         for child in fltr_node.get_children():
             self._recurse_inspect(child)
 
+def _file_digest(filename):
+    digest = hashlib.sha1()
+    if os.path.isdir(filename):
+        paths = [ os.path.join(filename, name) for name in sorted(os.listdir(filename))
+                  if os.path.isfile(os.path.join(filename, name)) ]
+    else:
+        paths = [ filename ]
+    for path in paths:
+        digest.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+# Make a DB-API connection read-only, per dialect
+_READONLY_SQL = {
+    'sqlite': "PRAGMA query_only = ON",
+    'postgresql': "SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY",
+}
+
+def _set_readonly(dbapi_connection, readonly_sql):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(readonly_sql)
+    cursor.close()
+    # Not to be rolled back with the first transaction
+    dbapi_connection.commit()
+
+def _refuse_flush(session, flush_context, instances):
+    raise InvalidRequestError("Read-only DAO: changes can not be flushed")
+
+def _like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _shift_stop_times(fltr, stop_times_table, offset):
+    """Return a copy of the filter with stop times arrival/departure shifted by offset."""
+    def replace(elem):
+        if isinstance(elem, sqlalchemy.Column) and elem.table is stop_times_table \
+                and elem.name in ('arrival_time', 'departure_time'):
+            return elem + offset
+        return None
+    return replacement_traverse(fltr, {}, replace)
+
+def _expand_trip(template, departure_time, exact_times):
+    """Build a transient copy of a frequency-based template trip, departing at the
+       given time, as stored by the eager expansion. Relationships are set as
+       committed values to bypass cascades: the copy never enters the session."""
+    offset = departure_time - template.stop_times[0].departure_time
+    trip = Trip(template.feed_id, template.trip_id + "@" + fmttime(departure_time),
+                template.route_id, template.service_id,
+                wheelchair_accessible=template.wheelchair_accessible,
+                bikes_allowed=template.bikes_allowed,
+                exact_times=exact_times,
+                frequency_generated=True,
+                trip_headsign=template.trip_headsign,
+                trip_short_name=template.trip_short_name,
+                direction_id=template.direction_id,
+                block_id=template.block_id)
+    stop_times = []
+    for stoptime in template.stop_times:
+        stoptime2 = StopTime(trip.feed_id, trip.trip_id, stoptime.stop_id, stoptime.stop_sequence,
+                    arrival_time=None if stoptime.arrival_time is None else stoptime.arrival_time + offset,
+                    departure_time=None if stoptime.departure_time is None else stoptime.departure_time + offset,
+                    shape_dist_traveled=stoptime.shape_dist_traveled,
+                    interpolated=stoptime.interpolated,
+                    timepoint=stoptime.timepoint,
+                    pickup_type=stoptime.pickup_type,
+                    drop_off_type=stoptime.drop_off_type)
+        set_committed_value(stoptime2, 'trip', trip)
+        set_committed_value(stoptime2, 'stop', stoptime.stop)
+        stop_times.append(stoptime2)
+    set_committed_value(trip, 'stop_times', stop_times)
+    set_committed_value(trip, 'frequencies', [])
+    set_committed_value(trip, 'route', template.route)
+    set_committed_value(trip, 'calendar', template.calendar)
+    set_committed_value(trip, 'shape', None)
+    return trip
+
+def _copy_text_value(value):
+    """Format a value for the PostgreSQL COPY text format."""
+    if value is None:
+        return six.u('\\N')
+    if isinstance(value, bool):
+        return six.u('t') if value else six.u('f')
+    if isinstance(value, float):
+        return six.text_type(repr(value))
+    if isinstance(value, datetime.date):
+        return six.text_type(value.isoformat())
+    return six.text_type(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+# Temporary feed ID of staging loads
+_STAGING_FEED_ID = "%s~staging"
+
+# Pragmas set on SQLite during bulk loads. Journal is kept (in memory)
+# so that a failed load can still be rolled back.
+_SQLITE_BULK_LOAD_PRAGMAS = (('synchronous', 'OFF'), ('journal_mode', 'MEMORY'), ('cache_size', '-262144'))
+
 def transactional(session):
     def wrap(func):
         def wrapped_func(*args, **kwargs):
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#    This file is part of Gtfslib-python.
+#
+#    Gtfslib-python is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Gtfslib-python is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with gtfslib-python.  If not, see <http://www.gnu.org/licenses/>.
+"""
+@author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
+"""
+import json
+import os
+import sys
+import time
+
+from sqlalchemy import event
+
+import gtfslib
+try:
+    # Optional, not available on all platforms
+    import resource
+except ImportError:
+    resource = None
+try:
+    # Optional, python 3.4+ only
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on OS X, kilobytes elsewhere
+    return peak_rss // 1024 if sys.platform == 'darwin' else peak_rss
+
+
+class _PhaseMetrics(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = time.time()
+        self.cpu_time = _cpu_time()
+        self.rows = 0
+        self.sql_statements = 0
+        self.flushes = 0
+        self.peak_rss_kb = None
+        self.peak_traced_kb = None
+
+    def end(self):
+        self.wall_time = time.time() - self.wall_time
+        self.cpu_time = _cpu_time() - self.cpu_time
+        self.peak_rss_kb = _peak_rss_kb()
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            self.peak_traced_kb = tracemalloc.get_traced_memory()[1] // 1024
+
+    def as_dict(self):
+        return dict(phase=self.name, wall_time=round(self.wall_time, 3), cpu_time=round(self.cpu_time, 3),
+                    rows=self.rows, rows_per_sec=round(self.rows / self.wall_time, 1) if self.wall_time > 0 else None,
+                    sql_statements=self.sql_statements, flushes=self.flushes,
+                    peak_rss_kb=self.peak_rss_kb, peak_traced_kb=self.peak_traced_kb)
+
+
+class ImportMetrics(object):
+    """
+    Per-phase metrics of a GTFS import: wall and CPU time, rows written and
+    rows/sec, SQL statements, session flushes and peak RSS. Rows and
+    statements are counted with SQLAlchemy events. With trace_allocations=True
+    (python 3.4+), the top allocating source lines are also reported, at the
+    cost of a much slower import. Pass an instance to Dao.load_gtfs(), then
+    get the report with report() or write() it as JSON.
+    """
+
+    def __init__(self, trace_allocations=False, top_allocations=20):
+        if trace_allocations and tracemalloc is None:
+            raise ValueError("Tracing allocations requires tracemalloc (python 3.4+)")
+        self.trace_allocations = trace_allocations
+        self.top_allocations = top_allocations
+        self.feed_id = None
+        self.phases = []
+        self._phase = None
+        self._listeners = []
+        self._started_tracing = False
+        self._allocations = []
+
+    def start(self, feed_id, engine, session):
+        """Start measuring an import, listening to events of the given engine and session."""
+        self.feed_id = feed_id
+        self._listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        self._listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        self._listen(session, 'after_flush', self._after_flush)
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.begin_phase('prepare')
+
+    def begin_phase(self, name):
+        """End the phase in progress, if any, and start the given one."""
+        if self._phase is not None:
+            self._phase.end()
+        self._phase = _PhaseMetrics(name)
+        self.phases.append(self._phase)
+
+    def count_rows(self, nrows):
+        """Count rows written without going through SQLAlchemy (eg COPY)."""
+        if self._phase is not None:
+            self._phase.rows += nrows
+
+    def stop(self):
+        if self._phase is not None:
+            self._phase.end()
+            self._phase = None
+        for target, identifier, fn in self._listeners:
+            event.remove(target, identifier, fn)
+        self._listeners = []
+        if self.trace_allocations:
+            snapshot = tracemalloc.take_snapshot()
+            self._allocations = [ dict(location="%s:%d" % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                                       size_kb=stat.size // 1024, count=stat.count)
+                                  for stat in snapshot.statistics('lineno')[:self.top_allocations] ]
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+    def report(self):
+        """Return the report as a dictionary, ready to be serialized to JSON."""
+        phases = [ phase.as_dict() for phase in self.phases ]
+        report = dict(gtfslib_version=gtfslib.__version__, feed_id=self.feed_id, phases=phases)
+        for key in ('wall_time', 'cpu_time'):
+            report[key] = round(sum(phase[key] for phase in phases), 3)
+        for key in ('rows', 'sql_statements', 'flushes'):
+            report[key] = sum(phase[key] for phase in phases)
+        report['peak_rss_kb'] = self.phases[-1].peak_rss_kb if self.phases else None
+        if self.trace_allocations:
+            report['top_allocations'] = self._allocations
+        return report
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def _listen(self, target, identifier, fn):
+        event.listen(target, identifier, fn)
+        self._listeners.append((target, identifier, fn))
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._phase is None:
+            return
+        self._phase.sql_statements += 1
+        if executemany and self._is_dml(context):
+            self._phase.rows += len(parameters)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # INSERT ... SELECT and the like only report their count afterwards
+        if self._phase is not None and not executemany and self._is_dml(context) and cursor.rowcount > 0:
+            self._phase.rows += cursor.rowcount
+
+    def _after_flush(self, session, flush_context):
+        if self._phase is not None:
+            self._phase.flushes += 1
+
+    @staticmethod
+    def _is_dml(context):
+        return context is not None and (context.isinsert or context.isupdate or context.isdelete)
@@ -153,10 +153,21 @@ class Route(object):
 
 class Calendar(object):
     
-    def __init__(self, feed_id, service_id):
+    def __init__(self, feed_id, service_id, start_date=None, days=None):
         self.feed_id = feed_id
         self.service_id = service_id
+        # Compact form of the dates, see DateBitmap. Set on import.
+        self.start_date = start_date
+        self.days = days
         
+    def bitmap(self):
+        """Return the dates of this calendar as a DateBitmap, w/o loading them
+           if the calendar has been imported, from the dates otherwise."""
+        # Not mapped on read-only databases created by older versions
+        if getattr(self, 'days', None) is None:
+            return DateBitmap.from_dates(self.dates)
+        return DateBitmap(self.start_date, self.days)
+
     def __repr__(self):
         return "<%s(id=%s/%s)>" % (
                 self.__class__.__name__, self.feed_id, self.service_id)
@@ -227,6 +238,109 @@ class CalendarDate(object):
             return "<%s(%s)>" % (
                 self.__class__.__name__, self.date)
 
+class DateBitmap(object):
+    """
+    Compact, immutable, set of dates: a start date and one bit per day, packed
+    as a string of hexadecimal digits (4 days per digit, the first one in the
+    most significant bit). Leading and trailing days are always set.
+    """
+
+    def __init__(self, start_date=None, days=""):
+        self.start_date = start_date
+        self.days = days or ""
+
+    @classmethod
+    def from_dates(cls, dates):
+        """Build a bitmap from dates, as CalendarDate or datetime.date."""
+        dates = [ d.as_date() if isinstance(d, CalendarDate) else d for d in dates ]
+        if len(dates) == 0:
+            return cls()
+        start_date = min(dates)
+        bits = [ '0' ] * ((max(dates) - start_date).days + 1)
+        for d in dates:
+            bits[(d - start_date).days] = '1'
+        return cls._from_bits(start_date, ''.join(bits))
+
+    @classmethod
+    def _from_bits(cls, start_date, bits):
+        # bits: one '0' or '1' per day from start_date
+        first = bits.find('1')
+        if first < 0:
+            return cls()
+        bits = bits[first:bits.rfind('1') + 1]
+        bits += '0' * (-len(bits) % 4)
+        return cls(start_date + datetime.timedelta(days=first), '%0*x' % (len(bits) // 4, int(bits, 2)))
+
+    def _bits(self):
+        if not self.days:
+            return ''
+        return bin(int(self.days, 16))[2:].zfill(len(self.days) * 4)
+
+    def _window(self, start_date, ndays):
+        # Bits of the days [start_date, start_date + ndays[, as an integer
+        bits = self._bits()
+        offset = (start_date - self.start_date).days
+        bits = '0' * max(0, -offset) + bits[max(0, offset):]
+        bits = bits[:ndays].ljust(ndays, '0')
+        return int(bits, 2) if bits else 0
+
+    def _span(self, other, union):
+        # Date range covering both (union) or common to both (intersection)
+        ends = [ bm.start_date + datetime.timedelta(days=len(bm.days) * 4) for bm in (self, other) ]
+        if union:
+            return min(self.start_date, other.start_date), max(ends)
+        return max(self.start_date, other.start_date), min(ends)
+
+    def __and__(self, other):
+        if not self.days or not other.days:
+            return DateBitmap()
+        start_date, end_date = self._span(other, False)
+        ndays = (end_date - start_date).days
+        if ndays <= 0:
+            return DateBitmap()
+        bits = self._window(start_date, ndays) & other._window(start_date, ndays)
+        return DateBitmap._from_bits(start_date, bin(bits)[2:].zfill(ndays))
+
+    def __or__(self, other):
+        if not self.days or not other.days:
+            return self if self.days else other
+        start_date, end_date = self._span(other, True)
+        ndays = (end_date - start_date).days
+        bits = self._window(start_date, ndays) | other._window(start_date, ndays)
+        return DateBitmap._from_bits(start_date, bin(bits)[2:].zfill(ndays))
+
+    def __contains__(self, date):
+        if isinstance(date, CalendarDate):
+            date = date.as_date()
+        if not self.days:
+            return False
+        offset = (date - self.start_date).days
+        if offset < 0 or offset >= len(self.days) * 4:
+            return False
+        return int(self.days[offset // 4], 16) & (8 >> (offset % 4)) != 0
+
+    def __len__(self):
+        return self._bits().count('1')
+
+    def __iter__(self):
+        """Iterate over the dates, in order, as CalendarDate."""
+        start = CalendarDate(self.start_date) if self.days else None
+        for offset, bit in enumerate(self._bits()):
+            if bit == '1':
+                yield start.next_day(offset)
+
+    def __eq__(self, other):
+        return isinstance(other, DateBitmap) and (self.start_date, self.days) == (other.start_date, other.days)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.start_date, self.days))
+
+    def __repr__(self):
+        return "<%s(%s, %d dates)>" % (self.__class__.__name__, self.start_date, len(self))
+
 class Trip(object):
 
     # Same values as Stop, but duplicated as they may differ one day    
@@ -314,6 +428,25 @@ class StopTime(object):
         return "<%s(id=%s/%s/%s, %s)>" % (
                 self.__class__.__name__, self.feed_id, self.trip_id, self.stop_sequence, _public_vars(self))
 
+class Frequency(object):
+    """A frequency window of a template trip, only stored when frequencies
+       are not expanded at import time."""
+
+    def __init__(self, feed_id, trip_id, start_time, end_time, headway_secs, exact_times=Trip.TIME_APPROX):
+        self.feed_id = feed_id
+        self.trip_id = trip_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.headway_secs = headway_secs
+        self.exact_times = exact_times
+
+    def departure_times(self):
+        return range(self.start_time, self.end_time, self.headway_secs)
+
+    def __repr__(self):
+        return "<%s(id=%s/%s/%s, %s)>" % (
+                self.__class__.__name__, self.feed_id, self.trip_id, self.start_time, _public_vars(self))
+
 class Shape(object):
 
     def __init__(self, feed_id, shape_id):
@@ -17,22 +17,44 @@
 @author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
 """
 
+from sqlalchemy import inspect
 from sqlalchemy.orm import mapper, relationship, backref, clear_mappers
 from sqlalchemy.orm.relationships import foreign
 from sqlalchemy.sql.schema import Column, MetaData, Table, ForeignKey, \
     ForeignKeyConstraint, Index
-from sqlalchemy.sql.sqltypes import String, Integer, Float, Date, Boolean
+from sqlalchemy.sql.expression import text
+from sqlalchemy.sql.sqltypes import String, Integer, Float, Date, Boolean, Text
 
 from gtfslib.model import FeedInfo, Agency, Stop, Route, Calendar, CalendarDate, \
-    Trip, StopTime, Transfer, Shape, ShapePoint, Zone, FareAttribute, FareRule
+    Trip, StopTime, Transfer, Shape, ShapePoint, Zone, FareAttribute, FareRule, Frequency
 
 
 # ORM Mappings
 class _Orm(object):
 
-    def __init__(self, engine, schema=None):
+    def __init__(self, engine, schema=None, partitioned=False, compact_calendars=False, create_schema=True,
+                 existing_schema=None):
+        """existing_schema describes the database opened, see _existing_schema()."""
         self._metadata = MetaData(schema=schema)
+        existing_schema = existing_schema or {}
+        if existing_schema.get('compact_calendars') is not None:
+            # The mode of an existing database can not be changed
+            if compact_calendars and not existing_schema['compact_calendars']:
+                raise ValueError("Compact calendars can only be enabled when creating the database")
+            compact_calendars = existing_schema['compact_calendars']
+        if existing_schema.get('partitioned') is not None:
+            if partitioned and not existing_schema['partitioned']:
+                raise ValueError("Partitioned storage can only be enabled when creating the database")
+            partitioned = existing_schema['partitioned']
+        # Calendar bitmap columns, missing in databases created by older versions
+        missing_calendar_columns = set()
+        if existing_schema.get('calendar_columns') is not None:
+            missing_calendar_columns = set([ 'start_date', 'days' ]) - existing_schema['calendar_columns']
         self.mappers = []
+        # Calendar dates only stored as bitmaps in calendars, calendar_dates being a view
+        self.compact_calendars = compact_calendars
+        # Largest tables, stored in one partition per feed if partitioned (PostgreSQL only)
+        _partition_opts = { 'postgresql_partition_by': 'LIST (feed_id)' } if partitioned else {}
 
         _feedinfo_id_column = Column('feed_id', String, primary_key=True)
         _agency_feed_id_column = Column('feed_id', String, ForeignKey('feed_info.feed_id'), primary_key=True)
@@ -161,9 +183,15 @@ class _Orm(object):
 
         _calendar_feed_id_column = Column('feed_id', String, ForeignKey('feed_info.feed_id'), primary_key=True)
         _calendar_id_column = Column('service_id', String, primary_key=True)
+        _calendar_bitmap_columns = [ Column('start_date', Date), Column('days', Text) ]
+        if not create_schema:
+            # They can not be added, calendars are then w/o bitmap (see Calendar.bitmap())
+            _calendar_bitmap_columns = [ column for column in _calendar_bitmap_columns
+                                         if column.name not in missing_calendar_columns ]
         _calendar_mapper = Table('calendar', self._metadata,
                     _calendar_feed_id_column,
-                    _calendar_id_column
+                    _calendar_id_column,
+                    *_calendar_bitmap_columns
                     )
         self.mappers.append(mapper(Calendar, _calendar_mapper, properties={
             'feed' : relationship(FeedInfo, backref=backref('calendars', cascade="all,delete-orphan"),
@@ -177,7 +205,8 @@ class _Orm(object):
                     ForeignKeyConstraint(['feed_id', 'service_id'], ['calendar.feed_id', 'calendar.service_id']),
                     # TOCHECK It seems a composite primary key on (a,b,c) does not need indexing on left elements,
                     # such as (a) and (a,b); but need on (a,c) for example.
-                    Index('idx_calendar_dates_date', 'feed_id', 'date'))
+                    Index('idx_calendar_dates_date', 'feed_id', 'date'),
+                    info={ 'view': compact_calendars })
         self.mappers.append(mapper(CalendarDate, _calendar_date_mapper, properties={
             'calendar' : relationship(Calendar, backref=backref('dates', cascade="all,delete-orphan"))
         }))
@@ -204,7 +233,8 @@ class _Orm(object):
                     Column('shape_pt_lat', Float, nullable=False),
                     Column('shape_pt_lon', Float, nullable=False),
                     ForeignKeyConstraint(['feed_id', 'shape_id'], ['shapes.feed_id', 'shapes.shape_id']),
-                    Index('idx_shape_pt_shape', 'feed_id', 'shape_id'))
+                    Index('idx_shape_pt_shape', 'feed_id', 'shape_id'),
+                    **_partition_opts)
         self.mappers.append(mapper(ShapePoint, _shape_pt_mapper, properties={
             # Note: here we specify foreign() on shape_pt feed_id column as there is no ownership relation of feed to shape_pts
             'shape' : relationship(Shape, backref=backref('points', order_by=_shape_pt_seq_column, cascade="all,delete-orphan"),
@@ -266,7 +296,8 @@ class _Orm(object):
                     ForeignKeyConstraint(['feed_id', 'trip_id'], ['trips.feed_id', 'trips.trip_id']),
                     ForeignKeyConstraint(['feed_id', 'stop_id'], ['stops.feed_id', 'stops.stop_id']),
                     Index('idx_stop_times_stop', 'feed_id', 'stop_id'),
-                    Index('idx_stop_times_sequence', 'feed_id', 'stop_sequence'))
+                    Index('idx_stop_times_sequence', 'feed_id', 'stop_sequence'),
+                    **_partition_opts)
         self.mappers.append(mapper(StopTime, _stop_times_mapper, properties={
             # Note: here we specify foreign() on stop_times feed_id column as there is no ownership relation of feed to stop_times
             'trip' : relationship(Trip, backref=backref('stop_times', order_by=_stop_seq_column, cascade="all,delete-orphan"),
@@ -275,6 +306,22 @@ class _Orm(object):
                                   primaryjoin=(_stop_id_column == foreign(_stop_times_stop_id_column)) & (_stop_feed_id_column == _stop_times_feed_id_column)),
         }))
 
+        _frequency_feed_id_column = Column('feed_id', String, ForeignKey('feed_info.feed_id'), primary_key=True)
+        _frequency_trip_id_column = Column('trip_id', String, primary_key=True)
+        _frequency_start_time_column = Column('start_time', Integer, primary_key=True)
+        _frequency_mapper = Table('frequencies', self._metadata,
+                    _frequency_feed_id_column,
+                    _frequency_trip_id_column,
+                    _frequency_start_time_column,
+                    Column('end_time', Integer, nullable=False),
+                    Column('headway_secs', Integer, nullable=False),
+                    Column('exact_times', Integer, nullable=False),
+                    ForeignKeyConstraint(['feed_id', 'trip_id'], ['trips.feed_id', 'trips.trip_id']))
+        self.mappers.append(mapper(Frequency, _frequency_mapper, properties={
+            'trip' : relationship(Trip, backref=backref('frequencies', order_by=_frequency_start_time_column, cascade="all,delete-orphan"),
+                                  primaryjoin=(_trip_id_column == foreign(_frequency_trip_id_column)) & (_trip_feed_id_column == foreign(_frequency_feed_id_column)))
+        }))
+
         _fareattr_feed_id_column = Column('feed_id', String, ForeignKey('feed_info.feed_id'), primary_key=True)
         _fareattr_id_column = Column('fare_id', String, primary_key=True)
         _fareattr_mapper = Table('fare_attributes', self._metadata,
@@ -322,12 +369,68 @@ class _Orm(object):
                             primaryjoin=(_zone_id_column == foreign(_farerule_contains_id_column)) & (_zone_feed_id_column == _farerule_feed_id_column))
         }))
 
-        self._metadata.create_all(engine)
+        # Not mapped: persistent cache of stop-to-shape snapping results,
+        # shared by all feeds, keyed by shape geometry and stop pattern hashes.
+        self.snapping_cache_table = Table('shape_snapping_cache', self._metadata,
+                    Column('shape_hash', String, primary_key=True),
+                    Column('pattern_hash', String, primary_key=True),
+                    Column('distances', Text, nullable=False))
+
+        # Not mapped: work table used while expanding frequencies,
+        # one row per generated trip. Emptied after each import.
+        self.frequency_departures_table = Table('frequency_departures', self._metadata,
+                    Column('feed_id', String, primary_key=True),
+                    Column('trip_id', String, primary_key=True),
+                    Column('template_trip_id', String, nullable=False),
+                    Column('time_offset', Integer, nullable=False),
+                    Column('exact_times', Integer, nullable=False))
+
+        # Not mapped: hashes of the source data of some entities of a feed
+        # (trips with their stop times, shapes, calendars), for incremental reloads.
+        self.entity_hashes_table = Table('feed_entity_hashes', self._metadata,
+                    Column('feed_id', String, primary_key=True),
+                    Column('kind', String, primary_key=True),
+                    Column('entity_id', String, primary_key=True),
+                    Column('hash', String, nullable=False))
+
+        # Not mapped: progress of checkpointed imports, one row per feed being
+        # imported: the phase in progress and the units of work it committed.
+        self.loader_state_table = Table('loader_state', self._metadata,
+                    Column('feed_id', String, primary_key=True),
+                    Column('source_digest', String, nullable=False),
+                    Column('phase', String, nullable=False),
+                    Column('progress', Integer, nullable=False))
+
+        self.partitioned_tables = [ _shape_pt_mapper, _stop_times_mapper ] if partitioned else []
+
+        if compact_calendars and engine.dialect.name not in _CALENDAR_DATES_VIEW_SQL:
+            raise ValueError("Compact calendars are not supported on %s" % engine.dialect.name)
+        # Not for read-only connections, the schema must then already exist
+        if create_schema:
+            self._metadata.create_all(engine, tables=self._tables())
+            # create_all() does not alter existing tables
+            preparer = engine.dialect.identifier_preparer
+            for column in _calendar_bitmap_columns:
+                if column.name in missing_calendar_columns:
+                    engine.execute(text("ALTER TABLE %s ADD COLUMN %s %s" % (preparer.format_table(_calendar_mapper),
+                                        preparer.format_column(column), column.type.compile(dialect=engine.dialect))))
+            if partitioned and existing_schema.get('partitioned') is None:
+                # Rows of feeds without partitions of their own (added w/o load_gtfs)
+                for table in self.partitioned_tables:
+                    default = preparer.quote("%s_default" % table.name)
+                    if table.schema is not None:
+                        default = "%s.%s" % (preparer.quote_schema(table.schema), default)
+                    engine.execute(text("CREATE TABLE IF NOT EXISTS %s PARTITION OF %s DEFAULT" % (default, preparer.format_table(table))))
+            if compact_calendars:
+                engine.execute(text(_CALENDAR_DATES_VIEW_SQL[engine.dialect.name].format(
+                            view=preparer.format_table(_calendar_date_mapper), calendar=preparer.format_table(_calendar_mapper))))
         self._class_for_table = {}
         self._table_for_class = {}
+        self._mapped_table_for_class = {}
         for _mapper in self.mappers:
             self._class_for_table[_mapper.mapped_table.name] = _mapper.class_
             self._table_for_class[_mapper.class_] = _mapper.mapped_table.name
+            self._mapped_table_for_class[_mapper.class_] = _mapper.mapped_table
 
     def class_for_table(self, tablename):
         """Return the class associated to a given table name.
@@ -338,3 +441,65 @@ class _Orm(object):
     def table_for_class(self, clazz):
         """Return the table name associated to a give entity class."""
         return self._table_for_class.get(clazz)
+
+    def table(self, clazz):
+        """Return the SqlAlchemy core Table object associated to a given entity class."""
+        return self._mapped_table_for_class.get(clazz)
+
+    def _tables(self):
+        # Actual tables, not views
+        return [ table for table in self._metadata.sorted_tables if not table.info.get('view') ]
+
+    def feed_tables(self):
+        """Return all tables storing data of feeds, referenced tables first."""
+        return [ table for table in self._tables() if 'feed_id' in table.c ]
+
+    def indexes(self):
+        """Return all secondary indexes, which can be dropped during bulk loads."""
+        return [ index for table in self._tables() for index in table.indexes ]
+
+def _existing_schema(engine, schema=None):
+    """Return the parts of the schema of the database which depend on the
+       version or options it was created with: its tables, the columns of
+       the calendar table, whether calendar dates are a view (compact
+       calendars) and whether stop times are partitioned (PostgreSQL 10+).
+       The last three are None if the table does not exist yet."""
+    inspector = inspect(engine)
+    table_names = inspector.get_table_names(schema=schema)
+    calendar_columns = None
+    if 'calendar' in table_names:
+        calendar_columns = set(column['name'] for column in inspector.get_columns('calendar', schema=schema))
+    compact_calendars = None
+    if 'calendar_dates' in inspector.get_view_names(schema=schema):
+        compact_calendars = True
+    elif 'calendar_dates' in table_names:
+        compact_calendars = False
+    partitioned = None
+    if engine.dialect.name == 'postgresql' and engine.dialect.server_version_info >= (10,):
+        # Partitioned tables are not listed by the inspector
+        partitioned_tables = engine.execute(text("""SELECT count(*) FROM pg_partitioned_table p
+                JOIN pg_class c ON c.oid = p.partrelid JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE c.relname = 'stop_times' AND n.nspname = coalesce(:schema, current_schema())"""), schema=schema).scalar()
+        if partitioned_tables > 0:
+            partitioned = True
+        elif 'stop_times' in table_names:
+            partitioned = False
+    elif 'stop_times' in table_names:
+        partitioned = False
+    return dict(table_names=set(table_names), calendar_columns=calendar_columns, compact_calendars=compact_calendars,
+                partitioned=partitioned)
+
+# Expand calendar bitmaps (see model.DateBitmap) into one row per date
+_CALENDAR_DATES_VIEW_SQL = {
+    'sqlite': """CREATE VIEW IF NOT EXISTS {view} AS
+        WITH RECURSIVE calendar_days(feed_id, service_id, start_date, days, day) AS (
+            SELECT feed_id, service_id, start_date, days, 0 FROM {calendar} WHERE length(days) > 0
+            UNION ALL
+            SELECT feed_id, service_id, start_date, days, day + 1 FROM calendar_days WHERE day + 1 < 4 * length(days))
+        SELECT feed_id, service_id, date(start_date, '+' || day || ' days') AS date FROM calendar_days
+        WHERE ((instr('0123456789abcdef', substr(days, day / 4 + 1, 1)) - 1) >> (3 - day % 4)) & 1 = 1""",
+    'postgresql': """CREATE OR REPLACE VIEW {view} AS
+        SELECT feed_id, service_id, start_date + day AS date
+        FROM {calendar}, generate_series(0, 4 * length(days) - 1) AS day
+        WHERE ((strpos('0123456789abcdef', substr(days, day / 4 + 1, 1)) - 1) >> (3 - day % 4)) & 1 = 1"""
+}
@@ -16,8 +16,15 @@
 """
 @author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
 """
+import bisect
 import math
 import pyqtree
+from collections import defaultdict
+try:
+    # Optional, used to speed-up computations on large arrays
+    import numpy
+except ImportError:
+    numpy = None
 
 # Radius of earth in meters
 EARTH_RADIUS = 6371000
@@ -30,6 +37,29 @@ def orthodromic_distance(a, b):
     c = 2 * math.asin(math.sqrt(math.sin(dlat / 2) ** 2 + math.cos(lat_a) * math.cos(lat_b) * math.sin(dlon / 2) ** 2))
     return c * EARTH_RADIUS
 
+def cumulative_orthodromic_distances(points):
+    """Return the list of cumulative distances in meters along a polyline,
+       starting at 0 on the first point. Vectorized if numpy is available."""
+    if len(points) == 0:
+        return []
+    if numpy is None:
+        distances = [ 0.0 ]
+        distance = 0.0
+        for a, b in zip(points, points[1:]):
+            distance += orthodromic_distance(a, b)
+            distances.append(distance)
+        return distances
+    lats = numpy.radians(numpy.fromiter((p.lat() for p in points), dtype=float, count=len(points)))
+    lons = numpy.radians(numpy.fromiter((p.lon() for p in points), dtype=float, count=len(points)))
+    dlat = numpy.diff(lats)
+    dlon = numpy.diff(lons)
+    # Haversine formula, same as orthodromic_distance()
+    c = 2 * numpy.arcsin(numpy.sqrt(numpy.sin(dlat / 2) ** 2 + numpy.cos(lats[:-1]) * numpy.cos(lats[1:]) * numpy.sin(dlon / 2) ** 2))
+    distances = numpy.empty(len(points))
+    distances[0] = 0.0
+    numpy.cumsum(c * EARTH_RADIUS, out=distances[1:])
+    return distances.tolist()
+
 """
 @return A 2-tuple composed of
             1) the distance in meter from the point p to the segment [ab],
@@ -84,6 +114,87 @@ class DistanceCache(object):
         self._cache[key] = d
         return d
 
+class SegmentIndex(object):
+    """A uniform grid index over the segments of a polyline, for fast nearest
+       segment lookup. Segment #i goes from points[i] to points[i+1]. Points
+       need lat() and lon() methods. Each segment is registered in all the
+       cells its bounding box overlaps; the cell size is based on the mean
+       segment length."""
+
+    # Segments overlapping more cells than this are not gridded,
+    # they are always returned as candidates.
+    MAX_CELLS_PER_SEGMENT = 64
+
+    def __init__(self, points):
+        self._nsegments = max(len(points) - 1, 0)
+        lats = [ pt.lat() for pt in points ]
+        lons = [ pt.lon() for pt in points ]
+        self._lat0 = min(lats) if lats else 0.0
+        self._lon0 = min(lons) if lons else 0.0
+        cos_lat = max(math.cos(math.radians(sum(lats) / len(lats))), 0.01) if lats else 1.0
+        extent = 0.0
+        for i in range(self._nsegments):
+            extent += max(abs(lats[i + 1] - lats[i]), abs(lons[i + 1] - lons[i]) * cos_lat)
+        extent /= max(self._nsegments, 1)
+        self._dlat = max(2 * extent, 1e-6)
+        self._dlon = self._dlat / cos_lat
+        self._cells = defaultdict(list)
+        self._large_segments = []
+        for i in range(self._nsegments):
+            ilat1, ilon1 = self._cell(min(lats[i], lats[i + 1]), min(lons[i], lons[i + 1]))
+            ilat2, ilon2 = self._cell(max(lats[i], lats[i + 1]), max(lons[i], lons[i + 1]))
+            if (ilat2 - ilat1 + 1) * (ilon2 - ilon1 + 1) > self.MAX_CELLS_PER_SEGMENT:
+                self._large_segments.append(i)
+                continue
+            for ilat in range(ilat1, ilat2 + 1):
+                for ilon in range(ilon1, ilon2 + 1):
+                    # Segments are inserted in order, lists stay sorted
+                    self._cells[(ilat, ilon)].append(i)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor((lat - self._lat0) / self._dlat)),
+                int(math.floor((lon - self._lon0) / self._dlon)))
+
+    def segments_by_distance(self, p, istart=0):
+        """Yield batches of segment indexes (all >= istart, each segment returned
+           only once), as (min_distance, segments) tuples, in rings of growing
+           distance around p. min_distance is a lower bound, in meters, of the
+           distance from p to any segment of this batch and following ones,
+           using the same metric as orthodromic_seg_distance()."""
+        remaining = self._nsegments - istart
+        if remaining <= 0:
+            return
+        seen = set()
+        batch = [ i for i in self._large_segments if i >= istart ]
+        seen.update(batch)
+        cos_p = math.cos(math.radians(p.lat()))
+        cell_meters = EARTH_RADIUS * min(math.radians(self._dlat), math.radians(self._dlon) * cos_p)
+        ilat, ilon = self._cell(p.lat(), p.lon())
+        k = 0
+        while len(seen) < remaining:
+            if k > 0 and 8 * k > len(self._cells):
+                # Rings are now larger than the whole grid, scan all cells
+                ring = self._cells.keys()
+            elif k == 0:
+                ring = [ (ilat, ilon) ]
+            else:
+                ring = [ (ilat - k, ilon + j) for j in range(-k, k + 1) ] + \
+                       [ (ilat + k, ilon + j) for j in range(-k, k + 1) ] + \
+                       [ (ilat + j, ilon - k) for j in range(-k + 1, k) ] + \
+                       [ (ilat + j, ilon + k) for j in range(-k + 1, k) ]
+            for cell in ring:
+                segments = self._cells.get(cell)
+                if not segments:
+                    continue
+                for i in segments[bisect.bisect_left(segments, istart):]:
+                    if i not in seen:
+                        seen.add(i)
+                        batch.append(i)
+            # Segments found in ring k lie outside the block of rings < k
+            yield max(k - 1, 0) * cell_meters, batch
+            batch = []
+            k += 1
+
 class RectangularArea(object):
     
     def __init__(self, min_lat, min_lon, max_lat, max_lon):
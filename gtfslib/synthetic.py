@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+#    This file is part of Gtfslib-python.
+#
+#    Gtfslib-python is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Gtfslib-python is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with gtfslib-python.  If not, see <http://www.gnu.org/licenses/>.
+"""gtfssynthetic - Deterministic synthetic GTFS generator, for benchmarking
+
+Usage:
+  gtfssynthetic <output> [--stops=<n>] [--routes=<n>]
+                [--trips=<n>] [--routestops=<n>]
+                [--shapedensity=<n>] [--days=<n>]
+                [--frequencies=<n>] [--transfers=<n>]
+                [--timepoints=<n>] [--seed=<n>]
+  gtfssynthetic (-h | --help)
+
+Options:
+  <output>             The GTFS to write: a zip file if it ends with ".zip",
+                       otherwise a directory of plain tables.
+  --stops=<n>          Number of stops [default: 1000].
+  --routes=<n>         Number of routes [default: 50].
+  --trips=<n>          Number of trips per route [default: 100].
+  --routestops=<n>     Number of stops per route [default: 20].
+  --shapedensity=<n>   Number of shape points between two stops [default: 5].
+  --days=<n>           Span of the calendars, in days [default: 365].
+  --frequencies=<n>    Number of routes using frequencies [default: 0].
+  --transfers=<n>      Number of transfers, between neighbor stops, at most
+                       one per pair [default: 0].
+  --timepoints=<n>     Only give times every n stops, the others are to be
+                       interpolated [default: 1].
+  --seed=<n>           Seed of the random generator [default: 0].
+  -h --help            Show help on options.
+
+Examples:
+  gtfssynthetic big.gtfs.zip --stops=20000 --routes=1000 --trips=1000
+        Write a GTFS with 20M stop times to big.gtfs.zip
+
+Authors:
+  Laurent GRÉGOIRE (MECATRAN) <laurent.gregoire@mecatran.com>
+"""
+import datetime
+import math
+import os
+import random
+import shutil
+import tempfile
+import zipfile
+
+from docopt import docopt
+
+from gtfslib.utils import fmttime
+
+# Bottom-left corner of the stop grid, and distance between grid stops
+_ORIGIN = (45.0, 5.0)
+_GRID_STEP = 0.003
+# Meters per degree of latitude
+_METERS_PER_DEGREE = 111195
+_SPEED_MPS = 8
+_DWELL_SECS = 20
+# Frequency windows of frequency-based trips: start, end, headway
+_FREQUENCY_WINDOWS = ((6 * 3600, 9 * 3600, 600), (9 * 3600, 16 * 3600, 900), (16 * 3600, 20 * 3600, 600))
+
+_TABLES = {
+    'agency': ('agency_id', 'agency_name', 'agency_url', 'agency_timezone'),
+    'feed_info': ('feed_publisher_name', 'feed_publisher_url', 'feed_lang', 'feed_start_date', 'feed_end_date'),
+    'stops': ('stop_id', 'stop_name', 'stop_lat', 'stop_lon'),
+    'routes': ('route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type'),
+    'calendar': ('service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday',
+                 'start_date', 'end_date'),
+    'calendar_dates': ('service_id', 'date', 'exception_type'),
+    'shapes': ('shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'),
+    'trips': ('route_id', 'service_id', 'trip_id', 'direction_id', 'shape_id'),
+    'stop_times': ('trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'),
+    'frequencies': ('trip_id', 'start_time', 'end_time', 'headway_secs'),
+    'transfers': ('from_stop_id', 'to_stop_id', 'transfer_type', 'min_transfer_time'),
+}
+
+# Service ID, days of the week
+_SERVICES = (('WEEK', (1, 1, 1, 1, 1, 0, 0)), ('SAT', (0, 0, 0, 0, 0, 1, 0)), ('SUN', (0, 0, 0, 0, 0, 0, 1)))
+
+
+class _TableWriter(object):
+
+    def __init__(self, directory, table):
+        self.filename = os.path.join(directory, table + ".txt")
+        self.nrows = 0
+        self._file = open(self.filename, 'wb')
+        self._write(_TABLES[table])
+
+    def _write(self, values):
+        self._file.write((','.join('' if value is None else str(value) for value in values) + '\n').encode('utf-8'))
+
+    def writerow(self, values):
+        self._write(values)
+        self.nrows += 1
+
+    def close(self):
+        self._file.close()
+
+
+class SyntheticGtfs(object):
+    """
+    Deterministic generator of synthetic, valid, GTFS. Stops are laid out on a
+    grid; each route is a random walk on this grid, served in both directions
+    with its own shape, by trips evenly spread over the day (05:00 to 23:00)
+    and over 3 services (week days, saturdays and sundays, with a few days
+    removed). The same parameters and seed always give the same GTFS (for a
+    given python version). The size of the output is mostly driven by the
+    number of stop times: routes * trips_per_route * stops_per_route. Routes
+    using frequencies have one template trip per direction and service.
+    """
+
+    def __init__(self, n_stops=1000, n_routes=50, trips_per_route=100, stops_per_route=20, shape_density=5,
+                 calendar_days=365, frequency_routes=0, n_transfers=0, timepoint_interval=1, seed=0,
+                 start_date=datetime.date(2017, 1, 1)):
+        if stops_per_route > n_stops:
+            raise ValueError("Routes cannot have more stops (%d) than the feed (%d)" % (stops_per_route, n_stops))
+        if stops_per_route < 2:
+            raise ValueError("Routes should have at least 2 stops")
+        if frequency_routes > n_routes:
+            raise ValueError("Frequency routes (%d) are a subset of the %d routes" % (frequency_routes, n_routes))
+        self.n_stops = n_stops
+        self.n_routes = n_routes
+        self.trips_per_route = trips_per_route
+        self.stops_per_route = stops_per_route
+        self.shape_density = shape_density
+        self.calendar_days = calendar_days
+        self.frequency_routes = frequency_routes
+        self.n_transfers = n_transfers
+        self.timepoint_interval = max(1, timepoint_interval)
+        self.seed = seed
+        self.start_date = start_date
+
+    def write(self, output):
+        """Write the GTFS to a zip file if the output name ends with '.zip',
+           to a directory otherwise. Return the number of rows of each table."""
+        if not output.endswith('.zip'):
+            if not os.path.isdir(output):
+                os.makedirs(output)
+            return self._write_tables(output)
+        directory = tempfile.mkdtemp()
+        try:
+            nrows = self._write_tables(directory)
+            # Zip64 for multi-GB tables
+            with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+                for table in sorted(nrows):
+                    zf.write(os.path.join(directory, table + ".txt"), table + ".txt")
+            return nrows
+        finally:
+            shutil.rmtree(directory)
+
+    def _write_tables(self, directory):
+        rand = random.Random(self.seed)
+        writers = { table: _TableWriter(directory, table) for table in _TABLES }
+        try:
+            end_date = self.start_date + datetime.timedelta(days=self.calendar_days - 1)
+            writers['agency'].writerow(('A', 'Synthetic transit', 'http://www.example.com/', 'Europe/Paris'))
+            writers['feed_info'].writerow(('Synthetic transit', 'http://www.example.com/', 'en',
+                                           self._fmtdate(self.start_date), self._fmtdate(end_date)))
+            self._write_calendars(rand, writers, end_date)
+            stops = self._write_stops(writers)
+            self._write_transfers(rand, writers, stops)
+            for route_index in range(self.n_routes):
+                self._write_route(rand, writers, stops, route_index)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        return { table: writer.nrows for table, writer in writers.items() }
+
+    def _write_calendars(self, rand, writers, end_date):
+        holidays = sorted(rand.sample(range(self.calendar_days), min(self.calendar_days, 5)))
+        for service_id, days in _SERVICES:
+            writers['calendar'].writerow((service_id,) + days + (self._fmtdate(self.start_date), self._fmtdate(end_date)))
+            for offset in holidays:
+                writers['calendar_dates'].writerow((service_id, self._fmtdate(self.start_date + datetime.timedelta(days=offset)), 2))
+
+    def _write_stops(self, writers):
+        width = int(math.ceil(math.sqrt(self.n_stops)))
+        stops = []
+        for index in range(self.n_stops):
+            row, column = divmod(index, width)
+            stop = ('S%d' % index, _ORIGIN[0] + row * _GRID_STEP, _ORIGIN[1] + column * _GRID_STEP, row, column)
+            writers['stops'].writerow(('S%d' % index, 'Stop %d' % index, '%.6f' % stop[1], '%.6f' % stop[2]))
+            stops.append(stop)
+        return stops
+
+    def _write_transfers(self, rand, writers, stops):
+        # Between neighbor stops only, each pair at most once
+        by_cell = { (stop[3], stop[4]): stop for stop in stops }
+        pairs = [ (stop, other) for stop in stops for other in self._neighbors(by_cell, stop) ]
+        for stop, other in rand.sample(pairs, min(self.n_transfers, len(pairs))):
+            writers['transfers'].writerow((stop[0], other[0], 2, 60 + rand.randrange(4) * 60))
+
+    def _write_route(self, rand, writers, stops, route_index):
+        route_id = 'R%d' % route_index
+        writers['routes'].writerow((route_id, 'A', str(route_index), 'Route %d' % route_index, 3))
+        path = self._random_walk(rand, stops)
+        frequency_based = route_index < self.frequency_routes
+        for direction_id in (0, 1):
+            if direction_id == 1:
+                path = path[::-1]
+            shape_id = '%s:%d' % (route_id, direction_id)
+            self._write_shape(rand, writers, path, shape_id)
+            # Time from the first stop to each stop
+            offsets = [ 0 ]
+            for stop1, stop2 in zip(path, path[1:]):
+                offsets.append(offsets[-1] + _DWELL_SECS + int(self._distance(stop1, stop2) / _SPEED_MPS))
+            if frequency_based:
+                ntrips = len(_SERVICES)
+            else:
+                # Split trips between both directions, then between services
+                ntrips = (self.trips_per_route + 1 - direction_id) // 2
+            trips_per_service = max(1, (ntrips + len(_SERVICES) - 1) // len(_SERVICES))
+            for trip_index in range(ntrips):
+                service_id = _SERVICES[trip_index % len(_SERVICES)][0]
+                trip_id = '%s:%d:%d' % (route_id, direction_id, trip_index)
+                writers['trips'].writerow((route_id, service_id, trip_id, direction_id, shape_id))
+                if frequency_based:
+                    departure = _FREQUENCY_WINDOWS[0][0]
+                    for start_time, end_time, headway_secs in _FREQUENCY_WINDOWS:
+                        writers['frequencies'].writerow((trip_id, fmttime(start_time), fmttime(end_time), headway_secs))
+                else:
+                    # Trips of each service evenly spread from 05:00 to 23:00
+                    departure = 5 * 3600 + 18 * 3600 * (trip_index // len(_SERVICES)) // trips_per_service
+                for stop_sequence, (stop, offset) in enumerate(zip(path, offsets)):
+                    last = stop_sequence == len(path) - 1
+                    if stop_sequence % self.timepoint_interval == 0 or last:
+                        arrival = fmttime(departure + offset)
+                        departure_time = fmttime(departure + offset + (0 if last else _DWELL_SECS // 2))
+                    else:
+                        arrival = departure_time = None
+                    writers['stop_times'].writerow((trip_id, arrival, departure_time, stop[0], stop_sequence))
+
+    def _write_shape(self, rand, writers, path, shape_id):
+        sequence = 0
+        for stop1, stop2 in zip(path, path[1:]):
+            for i in range(self.shape_density + 1):
+                # Points slightly off the straight line between stops
+                t = float(i) / (self.shape_density + 1)
+                jitter = (rand.random() - 0.5) * _GRID_STEP * 0.1 if i > 0 else 0
+                writers['shapes'].writerow((shape_id, '%.6f' % (stop1[1] + (stop2[1] - stop1[1]) * t + jitter),
+                                            '%.6f' % (stop1[2] + (stop2[2] - stop1[2]) * t + jitter), sequence))
+                sequence += 1
+        writers['shapes'].writerow((shape_id, '%.6f' % path[-1][1], '%.6f' % path[-1][2], sequence))
+
+    def _random_walk(self, rand, stops):
+        # Walk to an unvisited neighbor stop, jump anywhere when stuck
+        by_cell = { (stop[3], stop[4]): stop for stop in stops }
+        stop = stops[rand.randrange(len(stops))]
+        path = [ stop ]
+        visited = set([ stop[0] ])
+        while len(path) < self.stops_per_route:
+            neighbors = [ other for other in self._neighbors(by_cell, stop) if other[0] not in visited ]
+            if neighbors:
+                stop = neighbors[rand.randrange(len(neighbors))]
+            else:
+                stop = stops[rand.randrange(len(stops))]
+                if stop[0] in visited:
+                    continue
+            path.append(stop)
+            visited.add(stop[0])
+        return path
+
+    @staticmethod
+    def _neighbors(by_cell, stop):
+        cells = ((stop[3] - 1, stop[4]), (stop[3] + 1, stop[4]), (stop[3], stop[4] - 1), (stop[3], stop[4] + 1))
+        return [ by_cell[cell] for cell in cells if cell in by_cell ]
+
+    @staticmethod
+    def _distance(stop1, stop2):
+        dlat = (stop2[1] - stop1[1]) * _METERS_PER_DEGREE
+        dlon = (stop2[2] - stop1[2]) * _METERS_PER_DEGREE * math.cos(math.radians(stop1[1]))
+        return math.hypot(dlat, dlon)
+
+    @staticmethod
+    def _fmtdate(date):
+        return date.strftime('%Y%m%d')
+
+
+def main():
+    arguments = docopt(__doc__)
+    gtfs = SyntheticGtfs(n_stops=int(arguments['--stops']), n_routes=int(arguments['--routes']),
+                         trips_per_route=int(arguments['--trips']), stops_per_route=int(arguments['--routestops']),
+                         shape_density=int(arguments['--shapedensity']), calendar_days=int(arguments['--days']),
+                         frequency_routes=int(arguments['--frequencies']), n_transfers=int(arguments['--transfers']),
+                         timepoint_interval=int(arguments['--timepoints']), seed=int(arguments['--seed']))
+    nrows = gtfs.write(arguments['<output>'])
+    for table in sorted(nrows):
+        print("%s: %d rows" % (table, nrows[table]))
+
+if __name__ == '__main__':
+    main()
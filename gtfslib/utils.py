@@ -23,9 +23,9 @@ import six.moves
 from collections import defaultdict
 
 def timing(f):
-    def wrap(*args):
+    def wrap(*args, **kwargs):
         time1 = time.time()
-        ret = f(*args)
+        ret = f(*args, **kwargs)
         time2 = time.time()
         logging.info("%s() took %0.3f sec" % (f.__name__, time2 - time1))
         return ret
@@ -72,6 +72,12 @@ class ContinousPiecewiseLinearFunc(object):
         self._y.append(y)
         self._sorted = False
 
+    def extend(self, xs, ys):
+        """Append several points at once, given as two sequences of same length."""
+        self._x.extend(xs)
+        self._y.extend(ys)
+        self._sorted = False
+
     def interpolate(self, x):
 
         if len(self._x) == 0:
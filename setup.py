@@ -33,10 +33,12 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        'numpy': ['numpy'],
     },
     entry_points={
         'console_scripts': [
             'gtfsdbloader=gtfslib.gtfsdbloader:main',
+            'gtfssynthetic=gtfslib.synthetic:main',
             'gtfsrun=gtfsplugins.gtfsrun:main'
         ],
     },
@@ -17,8 +17,13 @@
 @author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
 """
 
+import os
+import shutil
+import tempfile
 import unittest
+import zipfile
 
+import sqlalchemy
 from gtfslib.dao import Dao
 from sqlalchemy.orm import clear_mappers
 
@@ -56,5 +61,42 @@ class TestMiniGtfs(unittest.TestCase):
         self.assertAlmostEquals(stop00.stop_lat, 0.0, 5)
         self.assertAlmostEquals(stop00.stop_lon, 0.0, 5)
 
+    def test_broken_bulk_load(self):
+        clear_mappers()
+        dao = Dao("")
+        with self.assertRaises(KeyError):
+            dao.load_gtfs(BROKEN_GTFS, lenient=False, bulk_load=True)
+        # Indexes are rebuilt and the failed load rolled back
+        inspector = sqlalchemy.inspect(dao.session().bind)
+        self.assertEqual(sorted(idx['name'] for idx in inspector.get_indexes('stop_times')),
+                         ['idx_stop_times_sequence', 'idx_stop_times_stop'])
+        self.assertEqual(len(dao.routes()), 0)
+
+    def test_duplicated_stop_sequence(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # Sample feed with a second stop time at the same sequence in trip STBA
+            duplicated = os.path.join(tmpdir, "duplicated.zip")
+            with zipfile.ZipFile("test/sample-feed.zip") as zin, zipfile.ZipFile(duplicated, 'w') as zout:
+                for name in zin.namelist():
+                    data = zin.read(name).decode('utf-8')
+                    if name == 'stop_times.txt':
+                        data = data.rstrip() + "\nSTBA,6:10:00,6:10:00,BEATTY_AIRPORT,2,,,,\n"
+                    zout.writestr(name, data)
+            clear_mappers()
+            dao = Dao("")
+            with self.assertRaises(KeyError):
+                dao.load_gtfs(duplicated, lenient=False)
+
+            clear_mappers()
+            dao = Dao("")
+            dao.load_gtfs(duplicated, lenient=True)
+            # STBA is expanded by frequencies
+            trip = dao.trip('STBA@6:00:00')
+            self.assertEqual([ (st.stop_id, st.departure_time) for st in trip.stop_times ],
+                             [ ('STAGECOACH', 6 * 3600), ('BEATTY_AIRPORT', None) ])
+        finally:
+            shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
     unittest.main()
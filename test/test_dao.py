@@ -17,12 +17,15 @@
 @author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
 """
 
+import datetime
 import unittest
 
+import sqlalchemy
 from gtfslib.spatial import RectangularArea
 from sqlalchemy.orm import clear_mappers
 
-from gtfslib.dao import Dao
+from gtfslib.dao import Dao, _copy_text_value
+from gtfslib.orm import _Orm
 from gtfslib.model import CalendarDate, FeedInfo, Agency, Route, Calendar, Stop, \
     Trip, StopTime, Transfer, Shape, ShapePoint, Zone, FareAttribute, FareRule
 
@@ -364,5 +367,79 @@ class TestDao(unittest.TestCase):
         self.assertTrue(fr1a == fr1b)
         self.assertTrue(fr1a != fr2)
 
+    def test_bulk_insert(self):
+        dao = Dao()
+        f1 = FeedInfo("")
+        sh1 = Shape("", "Sh1")
+        dao.add_all([ f1, sh1 ])
+        dao.bulk_insert(ShapePoint, ('feed_id', 'shape_id', 'shape_pt_sequence', 'shape_pt_lat', 'shape_pt_lon', 'shape_dist_traveled'),
+                        [ ("", "Sh1", i, 45.0 + i * 0.01, 0.0, i * 100.0) for i in range(5) ])
+        dao.bulk_insert(ShapePoint, ('feed_id', 'shape_id'), [])
+        dao.commit()
+
+        sh = dao.shape("Sh1")
+        self.assertTrue(len(sh.points) == 5)
+        for i, pt in enumerate(sh.points):
+            self.assertTrue(pt.shape_pt_sequence == i)
+            self.assertAlmostEqual(pt.shape_dist_traveled, i * 100.0, 6)
+
+    def test_expand_frequencies(self):
+        dao = Dao()
+        f1 = FeedInfo("")
+        a1 = Agency("", "A1", "Agency 1", agency_url="http://www.agency.fr/", agency_timezone="Europe/Paris")
+        r1 = Route("", "R1", "A1", 3)
+        c1 = Calendar("", "C1")
+        s1 = Stop("", "S1", "Stop 1", 45.0, 0.0)
+        s2 = Stop("", "S2", "Stop 2", 45.1, 0.0)
+        t1 = Trip("", "T1", "R1", "C1", trip_headsign="Headsign")
+        t1.stop_times = [ StopTime("", "T1", "S1", 0, None, 3600, 0.0),
+                          StopTime("", "T1", "S2", 1, 3900, None, 1000.0) ]
+        dao.add_all([ f1, a1, r1, c1, s1, s2, t1 ])
+        dao.flush()
+        dao.expand_frequencies("", [ ("T1@08:00:00", "T1", 28800 - 3600, Trip.TIME_EXACT),
+                                     ("T1@09:00:00", "T1", 32400 - 3600, Trip.TIME_EXACT) ], [ "T1" ])
+        dao.commit()
+
+        self.assertTrue(dao.trip("T1") is None)
+        trips = dao.trips(prefetch_stop_times=True)
+        self.assertTrue(sorted(trip.trip_id for trip in trips) == [ "T1@08:00:00", "T1@09:00:00" ])
+        t9 = dao.trip("T1@09:00:00")
+        self.assertTrue(t9.frequency_generated)
+        self.assertTrue(t9.exact_times == Trip.TIME_EXACT)
+        self.assertTrue(t9.trip_headsign == "Headsign")
+        self.assertTrue([ (st.stop_id, st.arrival_time, st.departure_time, st.shape_dist_traveled) for st in t9.stop_times ]
+                        == [ ("S1", None, 32400, 0.0), ("S2", 32700, None, 1000.0) ])
+        self.assertTrue(len(dao.stoptimes()) == 4)
+
+    def test_partitioned_schema(self):
+        self.assertRaises(ValueError, Dao, "", partitioned=True)
+        clear_mappers()
+        ddl = []
+        engine = sqlalchemy.create_engine("postgresql://", strategy='mock',
+                                          executor=lambda sql, *args, **kwargs: ddl.append(str(sql.compile(dialect=engine.dialect))))
+        _Orm(engine, partitioned=True)
+        partitioned = [ sql.split()[2] for sql in ddl if "PARTITION BY LIST (feed_id)" in sql ]
+        self.assertTrue(sorted(partitioned) == [ "shape_pts", "stop_times" ])
+        defaults = [ sql.split()[5] for sql in ddl if sql.endswith(" DEFAULT") ]
+        self.assertTrue(sorted(defaults) == [ "shape_pts_default", "stop_times_default" ])
+        # The mode of an existing database prevails, its DEFAULT partitions already exist
+        clear_mappers()
+        del ddl[:]
+        _Orm(engine, existing_schema=dict(partitioned=True))
+        self.assertTrue(len([ sql for sql in ddl if "PARTITION BY LIST (feed_id)" in sql ]) == 2)
+        self.assertTrue(len([ sql for sql in ddl if sql.endswith(" DEFAULT") ]) == 0)
+        clear_mappers()
+        self.assertRaises(ValueError, _Orm, engine, partitioned=True, existing_schema=dict(partitioned=False))
+
+    def test_copy_text_format(self):
+        self.assertTrue(_copy_text_value(None) == "\\N")
+        self.assertTrue(_copy_text_value(True) == "t")
+        self.assertTrue(_copy_text_value(False) == "f")
+        self.assertTrue(_copy_text_value(42) == "42")
+        self.assertTrue(float(_copy_text_value(0.1)) == 0.1)
+        self.assertTrue(_copy_text_value(datetime.date(2016, 2, 29)) == "2016-02-29")
+        self.assertTrue(_copy_text_value("") == "")
+        self.assertTrue(_copy_text_value("A\tB\\C\nD") == "A\\tB\\\\C\\nD")
+
 if __name__ == '__main__':
     unittest.main()
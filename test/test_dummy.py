@@ -18,15 +18,24 @@
 """
 
 import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
 
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError, InvalidRequestError
 from sqlalchemy.sql.expression import or_
 from sqlalchemy.sql.functions import func
 from sqlalchemy.orm import clear_mappers
 
+from gtfslib import converter
+from gtfslib.converter import _Odometer
 from gtfslib.dao import Dao
+from gtfslib.metrics import ImportMetrics
 from gtfslib.model import CalendarDate, Route, Calendar, Stop, \
-    Trip, StopTime
+    Trip, StopTime, DateBitmap, Transfer, FeedInfo
 from gtfslib.spatial import RectangularArea, SpatialClusterizer
 from gtfslib.utils import gtfstime
 
@@ -186,6 +195,323 @@ class TestDummyGtfs(unittest.TestCase):
         self.assertTrue(len(feed_b.calendars) * 2 == len(dao.calendars()))
         self.assertTrue(len(feed_a.trips) * 2 == len(list(dao.trips())))
         self.assertTrue(len(feed_b.trips) * 2 == len(list(dao.trips())))
+        # Hops never pair stop times of different feeds
+        hops = dao.hops(fltr=dao.hop_first().feed_id == 'A')
+        self.assertTrue(len(hops) > 0)
+        self.assertTrue(all(st2.feed_id == 'A' for st1, st2 in hops))
+        self.assertEqual(len(dao.hops()), 2 * len(hops))
+        # Compared to the former join, on trip ID and stop sequence only,
+        # only the pairs of stop times of different feeds are left out
+        def key(hop):
+            return tuple((st.feed_id, st.trip_id, st.stop_sequence) for st in hop)
+        stoptime1, stoptime2 = dao.hop_first(), dao.hop_second()
+        former = set(key(hop) for hop in dao.session().query(stoptime1, stoptime2)
+                     .filter((stoptime1.trip_id == stoptime2.trip_id) & ((stoptime1.stop_sequence + 1) == stoptime2.stop_sequence)))
+        self.assertEqual(len(former), 4 * len(hops))
+        same_feed = set(hop for hop in former if hop[0][0] == hop[1][0])
+        self.assertEqual(set(key(hop) for hop in dao.hops(prefetch_trips=False)), same_feed)
+        self.assertEqual(set(key(hop) for hop in dao.hops(prefetch_trips=False, window=True)), same_feed)
+
+    def test_snapping_cache(self):
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+        # Load without cache, then twice with (cold then warm) cache
+        dao.load_gtfs(DUMMY_GTFS, feed_id='A')
+        dao.load_gtfs(DUMMY_GTFS, feed_id='B', snapping_cache=True)
+        dao.load_gtfs(DUMMY_GTFS, feed_id='C', snapping_cache=True)
+
+        def stoptimes(feed_id):
+            return { (st.trip_id, st.stop_sequence): (st.shape_dist_traveled, st.arrival_time, st.departure_time)
+                    for st in dao.stoptimes(fltr=StopTime.feed_id == feed_id, prefetch_trips=False) }
+
+        sta = stoptimes('A')
+        self.assertTrue(len(sta) > 0)
+        self.assertEqual(sta, stoptimes('B'))
+        self.assertEqual(sta, stoptimes('C'))
+
+    def test_parallel_parsing(self):
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+        dao.load_gtfs(DUMMY_GTFS, feed_id='A')
+        dao.load_gtfs(DUMMY_GTFS, feed_id='B', jobs=2)
+
+        def stoptimes(feed_id):
+            return [ (st.trip_id, st.stop_sequence, st.stop_id, st.arrival_time, st.departure_time,
+                      st.shape_dist_traveled, st.interpolated, st.pickup_type, st.drop_off_type, st.stop_headsign)
+                    for st in dao.stoptimes(fltr=StopTime.feed_id == feed_id, prefetch_trips=False) ]
+
+        sta = stoptimes('A')
+        self.assertTrue(len(sta) > 0)
+        self.assertEqual(sta, stoptimes('B'))
+
+    def test_paginated_queries(self):
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+        dao.load_gtfs(DUMMY_GTFS, feed_id='A')
+        dao.load_gtfs(DUMMY_GTFS, feed_id='B')
+        trip_ids = sorted((trip.feed_id, trip.trip_id) for trip in dao.trips(prefetch_stop_times=False))
+        stop_ids = sorted((stop.feed_id, stop.stop_id) for stop in dao.stops())
+        self.assertEqual(len(trip_ids), 2 * len(dao.feed('A').trips))
+        for batch_size in (1, 7, len(trip_ids) // 2, len(trip_ids)):
+            # Batches can span both feeds
+            trips = list(dao.trips(prefetch_stop_times=False, batch_size=batch_size))
+            self.assertEqual(sorted((trip.feed_id, trip.trip_id) for trip in trips), trip_ids)
+            stops = list(dao.stops(batch_size=batch_size))
+            self.assertEqual(sorted((stop.feed_id, stop.stop_id) for stop in stops), stop_ids)
+        trips = list(dao.trips(fltr=(Trip.feed_id == 'B') & (Route.route_short_name == 'R1'), batch_size=3))
+        self.assertEqual(len(trips), 29)
+        for trip in trips:
+            self.assertEqual(trip.route.route_short_name, 'R1')
+            self.assertEqual(trip.feed_id, 'B')
+
+    def test_streaming_queries(self):
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+        dao.load_gtfs(DUMMY_GTFS, feed_id='A')
+        dao.load_gtfs(DUMMY_GTFS, feed_id='B')
+
+        def stoptime_key(st):
+            return (st.feed_id, st.trip_id, st.stop_sequence, st.departure_time)
+        fltr = StopTime.feed_id == 'A'
+        stoptimes = sorted(stoptime_key(st) for st in dao.stoptimes(fltr=fltr))
+        streamed = dao.stoptimes(fltr=fltr, stream=True, batch_size=7)
+        self.assertFalse(isinstance(streamed, list))
+        self.assertEqual(sorted(stoptime_key(st) for st in streamed), stoptimes)
+        hops = sorted((stoptime_key(st1), stoptime_key(st2)) for st1, st2 in dao.hops(fltr=fltr))
+        self.assertTrue(len(hops) > 0)
+        for prefetch_stop_times in (False, True):
+            streamed = list(dao.hops(fltr=fltr, stream=True, batch_size=10, prefetch_stop_times=prefetch_stop_times))
+            self.assertEqual(sorted((stoptime_key(st1), stoptime_key(st2)) for st1, st2 in streamed), hops)
+            for st1, st2 in streamed:
+                self.assertTrue(st1.trip is st2.trip)
+                self.assertEqual(st1.trip.trip_id, st1.trip_id)
+                self.assertTrue(st1 in st1.trip.stop_times)
+
+    def test_bulk_load(self):
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+        dao.load_gtfs(DUMMY_GTFS, feed_id='A', bulk_load=True)
+        dao.load_gtfs(DUMMY_GTFS, feed_id='B')
+
+        self.assertEqual(len(dao.feed('A').trips), len(dao.feed('B').trips))
+        self.assertEqual(len(dao.stoptimes(fltr=StopTime.feed_id == 'A')),
+                         len(dao.stoptimes(fltr=StopTime.feed_id == 'B')))
+        # Check that we can use the DAO normally afterwards
+        bbg = dao.stop("BBG", feed_id='A')
+        self.assertTrue(len(bbg.stop_times) > 0)
+        # Pending changes are committed, not discarded
+        dao.add(FeedInfo('C'))
+        with dao.bulk_load_mode():
+            dao.add(FeedInfo('D'))
+        with self.assertRaises(ZeroDivisionError):
+            with dao.bulk_load_mode():
+                dao.add(FeedInfo('E'))
+                dao.flush()
+                1 / 0
+        dao.session().rollback()
+        self.assertEqual(sorted(feed.feed_id for feed in dao.feeds()), [ 'A', 'B', 'C', 'D' ])
+
+    def test_staging_load(self):
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+        dao.load_gtfs("test/mini.gtfs.zip", feed_id='A')
+        dao.load_gtfs(DUMMY_GTFS, feed_id='A', staging=True)
+        dao.load_gtfs(DUMMY_GTFS, feed_id='B')
+
+        self.assertEqual(sorted(feed.feed_id for feed in dao.feeds()), [ 'A', 'B' ])
+        self.assertEqual(sorted(stop.stop_id for stop in dao.stops(fltr=Stop.feed_id == 'A')),
+                         sorted(stop.stop_id for stop in dao.stops(fltr=Stop.feed_id == 'B')))
+        self.assertEqual(sorted((st.trip_id, st.stop_sequence, st.departure_time, st.shape_dist_traveled)
+                                for st in dao.stoptimes(fltr=StopTime.feed_id == 'A')),
+                         sorted((st.trip_id, st.stop_sequence, st.departure_time, st.shape_dist_traveled)
+                                for st in dao.stoptimes(fltr=StopTime.feed_id == 'B')))
+        self.assertEqual(len(dao.shape("BR:5", feed_id='A').points), len(dao.shape("BR:5", feed_id='B').points))
+        # Replace a feed with transfers
+        dao.load_gtfs(DUMMY_GTFS, feed_id='A', staging=True)
+        self.assertEqual(len(dao.transfers(fltr=Transfer.feed_id == 'A')), len(dao.transfers(fltr=Transfer.feed_id == 'B')))
+
+    def test_resume_load(self):
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+        # Interrupt the import while normalizing the third shape
+        shapes_done = []
+        def normalize_and_register_shape(odometer, shape):
+            if len(shapes_done) == 2:
+                raise MemoryError()
+            shapes_done.append(shape.shape_id)
+            return original(odometer, shape)
+        original = _Odometer.normalize_and_register_shape
+        _Odometer.normalize_and_register_shape = normalize_and_register_shape
+        checkpoint_trips = converter._CHECKPOINT_TRIPS
+        converter._CHECKPOINT_TRIPS = 1
+        try:
+            self.assertRaises(MemoryError, dao.load_gtfs, DUMMY_GTFS, feed_id='A', checkpointed=True)
+        finally:
+            _Odometer.normalize_and_register_shape = original
+            converter._CHECKPOINT_TRIPS = checkpoint_trips
+        self.assertEqual(dao.loader_state('A')[1:], ('normalization', 2))
+        # Shapes normalized before the interruption are kept
+        self.assertTrue(len(dao.stoptimes(fltr=StopTime.feed_id == 'A')) > 0)
+        self.assertRaises(ValueError, dao.load_gtfs, "test/mini.gtfs.zip", feed_id='A', resume=True)
+        # Restarting the partly committed import is refused
+        self.assertRaises(ValueError, dao.load_gtfs, DUMMY_GTFS, feed_id='A', checkpointed=True)
+        self.assertRaises(ValueError, dao.load_gtfs, DUMMY_GTFS, feed_id='A')
+        self.assertEqual(dao.loader_state('A')[1:], ('normalization', 2))
+
+        dao.load_gtfs(DUMMY_GTFS, feed_id='A', resume=True)
+        self.assertTrue(dao.loader_state('A') is None)
+        dao.load_gtfs(DUMMY_GTFS, feed_id='B')
+        self.assertEqual(len(dao.feed('A').trips), len(dao.feed('B').trips))
+        self.assertEqual(sorted((st.trip_id, st.stop_sequence, st.arrival_time, st.departure_time, st.shape_dist_traveled)
+                                for st in dao.stoptimes(fltr=StopTime.feed_id == 'A')),
+                         sorted((st.trip_id, st.stop_sequence, st.arrival_time, st.departure_time, st.shape_dist_traveled)
+                                for st in dao.stoptimes(fltr=StopTime.feed_id == 'B')))
+        # Nothing left to resume
+        dao.load_gtfs(DUMMY_GTFS, feed_id='A', resume=True)
+
+    def test_import_metrics(self):
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+        metrics = ImportMetrics()
+        dao.load_gtfs(DUMMY_GTFS, feed_id='A', staging=True, metrics=metrics)
+        report = metrics.report()
+        self.assertEqual([ phase['phase'] for phase in report['phases'] ],
+                         [ 'prepare', 'feedinfo', 'agencies', 'stops', 'transfers', 'routes', 'fares', 'calendars',
+                           'shapes', 'trips', 'stoptimes', 'normalization', 'frequencies', 'swap' ])
+        phases = { phase['phase']: phase for phase in report['phases'] }
+        self.assertEqual(phases['trips']['rows'], len(dao.feed('A').trips))
+        self.assertTrue(phases['normalization']['rows'] >= len(dao.stoptimes(fltr=StopTime.feed_id == 'A')))
+        self.assertTrue(phases['swap']['rows'] > 0)
+        self.assertEqual(report['rows'], sum(phase['rows'] for phase in report['phases']))
+        self.assertTrue(report['sql_statements'] > 0)
+        self.assertTrue(report['flushes'] > 0)
+        # Events are not listened to anymore
+        dao.load_gtfs(DUMMY_GTFS, feed_id='B')
+        self.assertEqual(metrics.report(), report)
+
+    def test_compact_calendars(self):
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG, compact_calendars=True)
+        self.assertTrue(dao.compact_calendars())
+        dao.load_gtfs(DUMMY_GTFS)
+
+        ndates = { "WEEK": 253, "SUMMER": 42, "MONDAY": 49, "SAT": 53 }
+        for service_id, n in ndates.items():
+            calendar = dao.calendar(service_id)
+            self.assertEqual(len(calendar.dates), n)
+            self.assertEqual(len(calendar.bitmap()), n)
+            self.assertEqual(calendar.bitmap(), DateBitmap.from_dates(calendar.dates))
+            self.assertEqual(list(calendar.bitmap()), sorted(calendar.dates))
+        july4 = CalendarDate.ymd(2016, 7, 4)
+        trips = list(dao.trips(fltr=func.date(CalendarDate.date) == july4.date, prefetch_calendars=True))
+        self.assertTrue(len(trips) > 30)
+        for trip in trips:
+            self.assertTrue(july4 in trip.calendar.bitmap())
+        self.assertEqual(len(dao.calendars(func.date(CalendarDate.date) == datetime.date(2016, 5, 1))), 0)
+
+        dao.delete_feed("")
+        self.assertEqual(len(dao.calendars()), 0)
+
+    def test_compact_calendars_detection(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            compact_db = os.path.join(tmpdir, "compact.sqlite")
+            dao = Dao(compact_db, sql_logging=SQL_LOG, compact_calendars=True)
+            dao.load_gtfs(DUMMY_GTFS)
+            dao.session().close()
+            # The mode is read from the database
+            clear_mappers()
+            dao = Dao(compact_db, sql_logging=SQL_LOG)
+            self.assertTrue(dao.compact_calendars())
+            dao.load_gtfs(DUMMY_GTFS, feed_id='B')
+            self.assertEqual(len(dao.calendar("WEEK", feed_id='B').dates), 253)
+            dao.delete_feed('B')
+            dao.commit()
+            self.assertEqual(len(dao.calendars()), 4)
+            dao.session().close()
+
+            db = os.path.join(tmpdir, "normal.sqlite")
+            clear_mappers()
+            Dao(db, sql_logging=SQL_LOG).session().close()
+            clear_mappers()
+            self.assertRaises(ValueError, Dao, db, sql_logging=SQL_LOG, compact_calendars=True)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_readonly(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = DAO_URL or os.path.join(tmpdir, "readonly.sqlite")
+            dao = Dao(db, sql_logging=SQL_LOG)
+            dao.load_gtfs(DUMMY_GTFS, feed_id='A')
+            dao.commit()
+            dao.session().close()
+            clear_mappers()
+
+            dao = Dao(db, sql_logging=SQL_LOG, readonly=True)
+            self.assertTrue(dao.readonly())
+            fltr = (Trip.feed_id == 'A') & (Route.route_short_name == 'R1')
+            trips = sorted(trip.trip_id for trip in dao.trips(fltr=fltr))
+            self.assertTrue(len(trips) > 0)
+            records = list(dao.records(Trip, fltr=fltr))
+            self.assertEqual(sorted(record.trip_id for record in records), trips)
+            self.assertEqual(records[0].route_id, 'BR')
+            self.assertRaises(AttributeError, setattr, records[0], 'trip_id', 'X')
+            self.assertEqual(len(dao.session().identity_map), 0)
+            # Looking for frequencies once per transaction
+            dao.commit()
+            statements = []
+            def before_cursor_execute(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(dao.session().bind, 'before_cursor_execute', before_cursor_execute)
+            for _ in range(3):
+                list(dao.trips(fltr=fltr, prefetch_stop_times=False))
+            event.remove(dao.session().bind, 'before_cursor_execute', before_cursor_execute)
+            self.assertEqual(len([ sql for sql in statements if sql.startswith("SELECT frequencies.trip_id") ]), 1)
+
+            # Loaded objects are kept on commit, but changes can not be flushed
+            stop = dao.stop('BQ', feed_id='A')
+            dao.commit()
+            self.assertTrue('stop_name' in stop.__dict__)
+            stop.stop_name = "Foo"
+            self.assertRaises(InvalidRequestError, dao.commit)
+            dao.session().rollback()
+            # Nor can they be written directly
+            self.assertRaises(DBAPIError, dao.session().execute, "DELETE FROM stops")
+            dao.session().rollback()
+            self.assertRaises(ValueError, dao.load_gtfs, DUMMY_GTFS, feed_id='B')
+            self.assertEqual(dao.stop('BQ', feed_id='A').stop_name, stop.stop_name)
+            dao.session().close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_older_schema(self):
+        # Calendars w/o bitmap columns and no frequencies table, as created by older versions
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = os.path.join(tmpdir, "older.sqlite")
+            dao = Dao(db, sql_logging=SQL_LOG)
+            dao.load_gtfs(DUMMY_GTFS)
+            dao.commit()
+            dao.session().close()
+            connection = sqlite3.connect(db)
+            connection.executescript("""
+                CREATE TABLE calendar2 AS SELECT feed_id, service_id FROM calendar;
+                DROP TABLE calendar;
+                ALTER TABLE calendar2 RENAME TO calendar;
+                DROP TABLE frequencies;""")
+            connection.close()
+
+            for readonly in (True, False):
+                clear_mappers()
+                dao = Dao(db, sql_logging=SQL_LOG, readonly=readonly)
+                calendar = dao.calendar("WEEK")
+                self.assertEqual(len(calendar.dates), 253)
+                self.assertEqual(list(calendar.bitmap()), sorted(calendar.dates))
+                trips = list(dao.trips(prefetch_calendars=True))
+                self.assertTrue(len(trips) > 0)
+                self.assertEqual(len(dao.stoptimes(fltr=StopTime.trip_id == trips[0].trip_id)), len(trips[0].stop_times))
+                dao.session().close()
+            # Columns are added, and set by new imports
+            clear_mappers()
+            dao = Dao(db, sql_logging=SQL_LOG)
+            dao.load_gtfs(DUMMY_GTFS, feed_id='B')
+            self.assertEqual(len(dao.calendar("WEEK", feed_id='B').bitmap()), 253)
+            self.assertTrue(dao.calendar("WEEK", feed_id='B').days is not None)
+            dao.session().close()
+        finally:
+            shutil.rmtree(tmpdir)
 
     def test_complex_queries(self):
         dao = Dao(DAO_URL, sql_logging=SQL_LOG)
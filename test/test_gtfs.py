@@ -17,12 +17,19 @@
 @author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
 """
 
+import gzip
+import os
+import shutil
+import tempfile
 import unittest
+import zipfile
 
 from sqlalchemy.orm import clear_mappers
 
 from gtfslib.spatial import orthodromic_distance
 from gtfslib.dao import Dao
+from gtfslib.csvgtfs import Gtfs, ZipFileSource, DirectorySource, MmapSource, GzipSource, open_source, parse_chunk
+from gtfslib.model import Trip, StopTime, Stop, Route, CalendarDate
 
 # Location of GTFS files to tests.
 # This unit-test is not dependent on the content of a GTFS file.
@@ -136,5 +143,155 @@ class TestGtfs(unittest.TestCase):
             print("Testing %s" % gtfs)
             self._test_one_gtfs(gtfs)
 
+    def test_projected_tables(self):
+        columns = ('trip_id', 'stop_sequence', 'nonexistent_column', 'stop_id')
+        for gtfs in GTFS_LIST:
+            with Gtfs(ZipFileSource(gtfs)).load() as gtfs:
+                expected = [ tuple(row.get(column) for column in columns) for row in gtfs.stop_times() ]
+                self.assertEqual(list(gtfs.stop_times(columns=columns)), expected)
+                self.assertTrue(all(row[2] is None for row in expected))
+                self.assertEqual(list(gtfs.routes(columns=('route_id',))),
+                                 [ (row.get('route_id'),) for row in gtfs.routes() ])
+                self.assertEqual(list(gtfs.fare_rules(columns=columns)),
+                                 [ tuple(row.get(column) for column in columns) for row in gtfs.fare_rules() ])
+
+    def test_lazy_frequencies(self):
+        clear_mappers()
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+        dao.load_gtfs("test/sample-feed.zip", feed_id='E')
+        dao.load_gtfs("test/sample-feed.zip", feed_id='L', lazy_frequencies=True)
+        self.assertTrue(len(dao.feed('L').trips) < len(dao.feed('E').trips))
+
+        def trips(feed_id, fltr):
+            return sorted((trip.trip_id, trip.exact_times, trip.frequency_generated, trip.route.route_id,
+                           tuple((st.stop.stop_id, st.arrival_time, st.departure_time) for st in trip.stop_times))
+                          for trip in dao.trips(fltr=(Trip.feed_id == feed_id) & fltr))
+
+        def stoptimes(feed_id, fltr, **kwargs):
+            return sorted((st.trip.trip_id, st.stop_sequence, st.stop_id, st.arrival_time, st.departure_time)
+                          for st in dao.stoptimes(fltr=(StopTime.feed_id == feed_id) & fltr, **kwargs))
+
+        for fltr in (Trip.trip_id != None, StopTime.departure_time > 12 * 3600,
+                     (StopTime.departure_time >= 10 * 3600) & (StopTime.stop_id == 'STAGECOACH')):
+            expanded = trips('E', fltr)
+            self.assertTrue(len(expanded) > 0)
+            self.assertEqual(expanded, trips('L', fltr))
+            expanded = stoptimes('E', fltr)
+            self.assertTrue(len(expanded) > 0)
+            self.assertEqual(expanded, stoptimes('L', fltr))
+            self.assertEqual(expanded, stoptimes('L', fltr, stream=True, batch_size=5))
+        # Expanded trips are also found by ID
+        expanded_trips = [ trip for trip in dao.trips(fltr=Trip.feed_id == 'L') if trip.frequency_generated ]
+        self.assertTrue(len(expanded_trips) > 0)
+        for expanded in expanded_trips:
+            trip = dao.trip(expanded.trip_id, feed_id='L')
+            self.assertEqual((trip.trip_id, trip.exact_times, trip.frequency_generated, trip.route.route_id,
+                              [ (st.stop_id, st.arrival_time, st.departure_time) for st in trip.stop_times ]),
+                             (expanded.trip_id, expanded.exact_times, expanded.frequency_generated, expanded.route.route_id,
+                              [ (st.stop_id, st.arrival_time, st.departure_time) for st in expanded.stop_times ]))
+        self.assertEqual(dao.trip('CITY1@6:00:00', feed_id='L').trip_id, 'CITY1@6:00:00')
+        self.assertEqual(dao.trip('CITY1@6:00:00', feed_id='E').trip_id, 'CITY1@6:00:00')
+        self.assertTrue(dao.trip('CITY1@6:01:00', feed_id='L') is None)
+        self.assertTrue(dao.trip('CITY1@foo', feed_id='L') is None)
+        # Expanded items are never added to the session
+        self.assertEqual(len(dao.session().new), 0)
+
+    def test_incremental_reload(self):
+        clear_mappers()
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # Modified copy of the sample feed
+            edits = { 'stops.txt': ("36.425288,-117.133162", "36.426,-117.134"),
+                      'stop_times.txt': ("STBA,6:20:00,6:20:00", "STBA,6:25:00,6:25:00"),
+                      'frequencies.txt': ("CITY1,6:00:00,7:59:59,1800", "CITY1,6:00:00,7:59:59,1200"),
+                      'calendar_dates.txt': ("FULLW,20070604,2", "FULLW,20070605,2") }
+            modified = os.path.join(tmpdir, "modified.zip")
+            with zipfile.ZipFile("test/sample-feed.zip") as zin, zipfile.ZipFile(modified, 'w') as zout:
+                for name in zin.namelist():
+                    data = zin.read(name).decode('utf-8')
+                    if name in edits:
+                        self.assertTrue(edits[name][0] in data)
+                        data = data.replace(*edits[name])
+                    zout.writestr(name, data)
+
+            def content(feed_id):
+                return (sorted((stop.stop_id, stop.stop_lat, stop.stop_lon) for stop in dao.stops(fltr=Stop.feed_id == feed_id)),
+                        sorted((route.route_id, route.route_long_name) for route in dao.routes(fltr=Route.feed_id == feed_id)),
+                        sorted((date.service_id, date.date) for date in dao.session().query(CalendarDate)
+                               .filter(CalendarDate.feed_id == feed_id)),
+                        sorted((st.trip.trip_id, st.stop_sequence, st.stop_id, st.arrival_time, st.departure_time,
+                                st.shape_dist_traveled) for st in dao.stoptimes(fltr=StopTime.feed_id == feed_id)))
+
+            dao.load_gtfs("test/sample-feed.zip", feed_id='I', incremental=True)
+            dao.load_gtfs("test/sample-feed.zip", feed_id='F')
+            self.assertEqual(content('I'), content('F'))
+            dao.load_gtfs(modified, feed_id='I', incremental=True)
+            dao.load_gtfs(modified, feed_id='M')
+            self.assertEqual(content('I'), content('M'))
+            self.assertNotEqual(content('I'), content('F'))
+            # And back to the original version
+            dao.load_gtfs("test/sample-feed.zip", feed_id='I', incremental=True)
+            self.assertEqual(content('I'), content('F'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_sources(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for i, gtfs in enumerate(GTFS_LIST):
+                plaindir = os.path.join(tmpdir, "plain%d" % i)
+                gzipdir = os.path.join(tmpdir, "gzip%d" % i)
+                mixeddir = os.path.join(tmpdir, "mixed%d" % i)
+                os.mkdir(gzipdir)
+                with zipfile.ZipFile(gtfs) as zin:
+                    zin.extractall(plaindir)
+                    zin.extractall(mixeddir)
+                    for j, name in enumerate(zin.namelist()):
+                        # Every other table gzipped in the mixed directory
+                        for directory in (gzipdir, mixeddir) if j % 2 == 0 else (gzipdir,):
+                            with gzip.open(os.path.join(directory, name + ".gz"), 'wb') as f:
+                                f.write(zin.read(name))
+                        if j % 2 == 0:
+                            os.remove(os.path.join(mixeddir, name))
+                self.assertTrue(isinstance(open_source(gtfs), ZipFileSource))
+                self.assertTrue(isinstance(open_source(plaindir), DirectorySource))
+                self.assertTrue(isinstance(open_source(gzipdir), GzipSource))
+
+                def tables(source):
+                    with Gtfs(source).load() as gtfs:
+                        return [ list(getattr(gtfs, table['getter'])()) for table in Gtfs.TABLES ] + \
+                               [ list(gtfs.chunks('stop_times.txt', chunk_lines=5)) ]
+                expected = tables(ZipFileSource(gtfs))
+                for source in (DirectorySource(plaindir), MmapSource(plaindir), GzipSource(gzipdir), open_source(mixeddir)):
+                    self.assertEqual(tables(source), expected)
+                # Mapped tables read into a buffer, then closed
+                with open(os.path.join(plaindir, 'stops.txt'), 'rb') as f:
+                    data = f.read()
+                mapped = MmapSource(plaindir).open('stops.txt')
+                buf = bytearray(len(data) + 10)
+                self.assertEqual(mapped.readinto(buf), len(data))
+                self.assertEqual(bytes(buf[:len(data)]), data)
+                self.assertEqual(mapped.readinto(buf), 0)
+                mapped.close()
+            # Load from a directory
+            clear_mappers()
+            dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+            dao.load_gtfs(os.path.join(tmpdir, "gzip1"), feed_id='G')
+            dao.load_gtfs(GTFS_LIST[1], feed_id='Z')
+            self.assertEqual(len(dao.stoptimes(fltr=StopTime.feed_id == 'G')), len(dao.stoptimes(fltr=StopTime.feed_id == 'Z')))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_chunks(self):
+        columns = ('trip_id', 'stop_id', 'stop_sequence', 'stop_headsign')
+        for gtfs in GTFS_LIST:
+            with Gtfs(ZipFileSource(gtfs)).load() as gtfs:
+                expected = list(gtfs.stop_times(columns=columns))
+                rows = []
+                for header, chunk in gtfs.chunks('stop_times.txt', chunk_lines=7):
+                    rows.extend(parse_chunk(header, chunk, columns))
+                self.assertEqual(rows, expected)
+
 if __name__ == '__main__':
     unittest.main()
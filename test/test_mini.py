@@ -17,11 +17,15 @@
 @author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
 """
 
+from array import array
 import unittest
 
 from sqlalchemy.orm import clear_mappers
+from sqlalchemy.sql.functions import func
 
-from gtfslib.model import Trip
+import gtfslib.columnar
+from gtfslib.columnar import DictionaryColumn
+from gtfslib.model import Trip, Route, CalendarDate, StopTime
 from gtfslib.dao import Dao
 
 # Location of mini.gtfs.zip.
@@ -137,5 +141,62 @@ class TestMiniGtfs(unittest.TestCase):
             self.assertTrue(st1.stop_sequence + 2 == st2.stop_sequence)
             self.assertTrue(st1.trip == st2.trip)
 
+    def test_window_hops(self):
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+        dao.load_gtfs(MINI_GTFS)
+
+        def hop_ids(hops):
+            return sorted(((st1.trip_id, st1.stop_sequence), (st2.trip_id, st2.stop_sequence)) for st1, st2 in hops)
+        fltrs = [ None,
+                  dao.hop_second().shape_dist_traveled - dao.hop_first().shape_dist_traveled > 70000,
+                  dao.hop_second().arrival_time - dao.hop_first().departure_time <= 3600,
+                  dao.hop_first().stop_id == 'SJ',
+                  Route.route_long_name == 'Route 1',
+                  func.date(CalendarDate.date) == CalendarDate.ymd(2016, 1, 5).date ]
+        for delta in (1, 2):
+            for fltr in fltrs:
+                hops = dao.hops(delta=delta, fltr=fltr, window=True)
+                self.assertEqual(hop_ids(hops), hop_ids(dao.hops(delta=delta, fltr=fltr)))
+                self.assertEqual(hop_ids(hops), hop_ids(dao.hops(delta=delta, fltr=fltr, window=True, stream=True, batch_size=3)))
+                for st1, st2 in hops:
+                    self.assertTrue(st1.stop_sequence + delta == st2.stop_sequence)
+                    self.assertTrue(st1.trip is st2.trip)
+                    # Same instances as in the session
+                    self.assertTrue(st1 in st1.trip.stop_times)
+                    self.assertTrue(st2 in st1.trip.stop_times)
+                    self.assertTrue(st1 is dao.session().query(StopTime).get((st1.feed_id, st1.trip_id, st1.stop_sequence)))
+
+    def test_columns(self):
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG)
+        dao.load_gtfs(MINI_GTFS)
+
+        def nan_to_none(value):
+            return None if value != value else value
+        names = [ 'trip_id', 'stop_id', 'stop_sequence', 'departure_time', 'shape_dist_traveled', 'interpolated' ]
+        fltr = (Route.route_long_name == 'Route 1') & (StopTime.stop_id != 'SF')
+        expected = sorted((st.trip_id, st.stop_id, st.stop_sequence, st.departure_time, st.shape_dist_traveled, int(st.interpolated))
+                          for st in dao.stoptimes(fltr=fltr, expand_frequencies=False))
+        _numpy = gtfslib.columnar.numpy
+        try:
+            for numpy in (_numpy, None):
+                gtfslib.columnar.numpy = numpy
+                columns = dao.columns(StopTime, names, fltr=fltr, batch_size=7)
+                self.assertEqual(list(columns.keys()), names)
+                self.assertTrue(isinstance(columns['trip_id'], DictionaryColumn))
+                self.assertEqual(len(columns['stop_id'].values), 2)
+                if numpy is None:
+                    self.assertTrue(isinstance(columns['departure_time'], array))
+                    self.assertEqual(columns['departure_time'].itemsize, 8)
+                rows = zip(*[ columns[name] for name in names ])
+                self.assertEqual(sorted(tuple(nan_to_none(value) for value in row) for row in rows), expected)
+        finally:
+            gtfslib.columnar.numpy = _numpy
+
+        # Trips running on some date, each trip once
+        fltr = func.date(CalendarDate.date) == CalendarDate.ymd(2016, 1, 5).date
+        trip_ids = dao.columns(Trip, [ 'trip_id' ], fltr=fltr)['trip_id'].decode()
+        self.assertEqual(sorted(trip_ids), sorted(trip.trip_id for trip in dao.trips(fltr=fltr)))
+        self.assertRaises(ValueError, dao.columns, Trip, [ 'foo' ])
+
 if __name__ == '__main__':
     unittest.main()
@@ -19,7 +19,7 @@
 
 import unittest
 
-from gtfslib.model import CalendarDate, Stop
+from gtfslib.model import CalendarDate, DateBitmap, Stop
 import datetime
 
 
@@ -80,6 +80,22 @@ class TestModel(unittest.TestCase):
             n += 1
         self.assertEqual(n, 31)
 
+    def test_date_bitmap(self):
+        d0 = CalendarDate.ymd(2016, 1, 1)
+        dates = [ d0.next_day(n) for n in (2, 3, 9, 40) ]
+        bm = DateBitmap.from_dates(dates)
+        self.assertEqual(bm.start_date, dates[0].as_date())
+        self.assertEqual(len(bm), 4)
+        self.assertEqual(list(bm), dates)
+        for n in range(50):
+            self.assertEqual(d0.next_day(n) in bm, d0.next_day(n) in dates)
+        self.assertEqual(bm, DateBitmap.from_dates(reversed(dates)))
+        self.assertEqual(len(DateBitmap.from_dates([])), 0)
+        bm2 = DateBitmap.from_dates([ d0.next_day(n) for n in (0, 3, 40, 60) ])
+        self.assertEqual(list(bm & bm2), [ d0.next_day(3), d0.next_day(40) ])
+        self.assertEqual(list(bm | bm2), [ d0.next_day(n) for n in (0, 2, 3, 9, 40, 60) ])
+        self.assertEqual(len(bm & DateBitmap.from_dates([ d0.next_day(100) ])), 0)
+
     def test_same_station(self):
         s1a = Stop('F1', 'Sa', 'StopA', 45, 0)
         s1b = Stop('F1', 'Sb', 'StopB', 45, 0.1)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#    This file is part of Gtfslib-python.
+#
+#    Gtfslib-python is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Gtfslib-python is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with gtfslib-python.  If not, see <http://www.gnu.org/licenses/>.
+"""
+@author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
+"""
+
+import os
+import unittest
+
+import sqlalchemy
+from sqlalchemy.orm import clear_mappers
+
+from gtfslib.dao import Dao
+from gtfslib.model import FeedInfo, Stop, StopTime
+
+# Location of dummy.gtfs.zip.
+DUMMY_GTFS = "test/dummy.gtfs.zip"
+
+# PostgreSQL-only features are tested when this is set to a database URL,
+# for example "postgresql://gtfs@localhost/gtfs". Tests run in their own
+# schema, dropped afterwards.
+DAO_URL = os.environ.get("GTFSLIB_TEST_POSTGRESQL")
+SCHEMA = "gtfslib_test"
+# Set this to true to activate SQL logging
+SQL_LOG = False
+
+@unittest.skipIf(DAO_URL is None, "GTFSLIB_TEST_POSTGRESQL is not set")
+class TestPostgresql(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        clear_mappers()
+        self.engine = sqlalchemy.create_engine(DAO_URL)
+        self.engine.execute("DROP SCHEMA IF EXISTS %s CASCADE" % SCHEMA)
+        self.engine.execute("CREATE SCHEMA %s" % SCHEMA)
+        self.daos = []
+
+    def tearDown(self):
+        for dao in self.daos:
+            dao.session().close()
+            dao.session().bind.dispose()
+        self.engine.execute("DROP SCHEMA IF EXISTS %s CASCADE" % SCHEMA)
+        self.engine.dispose()
+        unittest.TestCase.tearDown(self)
+
+    def _dao(self, **kwargs):
+        dao = Dao(DAO_URL, sql_logging=SQL_LOG, schema=SCHEMA, **kwargs)
+        self.daos.append(dao)
+        return dao
+
+    def _partitions(self, table_name):
+        return sorted(name for (name,) in self.engine.execute("""SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+                JOIN pg_namespace n ON n.oid = p.relnamespace
+                WHERE p.relname = %s AND n.nspname = %s""", (table_name, SCHEMA)))
+
+    def test_partitioned_staging_load(self):
+        dao = self._dao(partitioned=True)
+        dao.load_gtfs("test/mini.gtfs.zip", feed_id='A')
+        partitions = self._partitions('stop_times')
+        dao.load_gtfs(DUMMY_GTFS, feed_id='A', staging=True)
+        # Same partition names, the old partitions and staged feed are dropped
+        self.assertEqual(self._partitions('stop_times'), partitions)
+        self.assertEqual(len(self._partitions('shape_pts')), 2)
+        leftovers = self.engine.execute("""SELECT count(*) FROM pg_tables WHERE schemaname = %s
+                AND (tablename LIKE '%%\\_old' OR tablename LIKE '%%\\_new')""", (SCHEMA,)).scalar()
+        self.assertEqual(leftovers, 0)
+
+        dao.load_gtfs(DUMMY_GTFS, feed_id='B')
+        self.assertEqual(sorted(feed.feed_id for feed in dao.feeds()), [ 'A', 'B' ])
+        self.assertEqual(sorted((st.trip_id, st.stop_sequence, st.departure_time, st.shape_dist_traveled)
+                                for st in dao.stoptimes(fltr=StopTime.feed_id == 'A')),
+                         sorted((st.trip_id, st.stop_sequence, st.departure_time, st.shape_dist_traveled)
+                                for st in dao.stoptimes(fltr=StopTime.feed_id == 'B')))
+        self.assertEqual(len(dao.shape("BR:5", feed_id='A').points), len(dao.shape("BR:5", feed_id='B').points))
+        # And replaced again, by a smaller feed
+        dao.load_gtfs("test/mini.gtfs.zip", feed_id='A', staging=True)
+        dao.load_gtfs("test/mini.gtfs.zip", feed_id='C')
+        self.assertEqual(len(dao.stoptimes(fltr=StopTime.feed_id == 'A')), len(dao.stoptimes(fltr=StopTime.feed_id == 'C')))
+
+    def test_copy_bulk_insert(self):
+        dao = self._dao()
+        # Bulk inserts are streamed with COPY FROM STDIN
+        self.assertTrue(dao._copy_bulk_insert)
+        dao.add(FeedInfo('F'))
+        columns = ('feed_id', 'stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'location_type',
+                   'wheelchair_boarding', 'stop_code', 'stop_desc')
+        rows = [ ('F', 'S1', "Tab\there", 45.0, 1.5, 0, 0, None, "Line\nfeed"),
+                 ('F', 'S2', "Back\\slash \\N", 45.000001, -1.25, 1, 2, "", "Carriage\rreturn"),
+                 ('F', 'S3', u"Unicode \u00e9\u20ac", 0.1, 0.2, 0, 1, "\\t", None) ]
+        dao.bulk_insert(Stop, columns, rows)
+        dao.commit()
+        stops = sorted(tuple(getattr(stop, column) for column in columns) for stop in dao.stops(fltr=Stop.feed_id == 'F'))
+        self.assertEqual(stops, rows)
+        # A full load, through the same path
+        dao.load_gtfs(DUMMY_GTFS, feed_id='D')
+        self.assertTrue(len(dao.stoptimes(fltr=StopTime.feed_id == 'D')) > 0)
+
+if __name__ == '__main__':
+    unittest.main()
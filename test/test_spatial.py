@@ -14,8 +14,10 @@
 #    You should have received a copy of the GNU General Public License
 #    along with gtfslib-python.  If not, see <http://www.gnu.org/licenses/>.
 from gtfslib.spatial import orthodromic_distance, orthodromic_seg_distance,\
-    SpatialClusterizer
+    SpatialClusterizer, SegmentIndex, cumulative_orthodromic_distances
+import gtfslib.spatial
 import math
+import random
 """
 @author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
 """
@@ -137,5 +139,49 @@ class TestSpatial(unittest.TestCase):
         self.assertTrue(sc.in_same_cluster(p2, p3))
         self.assertTrue(len(sc.clusters()) == 1)
 
+    def test_cumulative_distances(self):
+        random.seed(42)
+        points = [ SimplePoint(45 + random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(1000) ]
+        self.assertTrue(cumulative_orthodromic_distances([]) == [])
+        self.assertTrue(cumulative_orthodromic_distances(points[:1]) == [ 0.0 ])
+        distances = cumulative_orthodromic_distances(points)
+        self.assertTrue(len(distances) == len(points))
+        self.assertAlmostEqual(distances[0], 0.0, 6)
+        self.assertAlmostEqual(distances[1], orthodromic_distance(points[0], points[1]), 6)
+        # Compare with the pure python version if numpy is installed
+        _numpy = gtfslib.spatial.numpy
+        try:
+            gtfslib.spatial.numpy = None
+            distances2 = cumulative_orthodromic_distances(points)
+        finally:
+            gtfslib.spatial.numpy = _numpy
+        for d1, d2 in zip(distances, distances2):
+            self.assertAlmostEqual(d1, d2, 3)
+
+    def test_segment_index(self):
+        random.seed(42)
+        # A random walk, with some long segments and back-and-forth
+        lat, lon = 45.0, 0.0
+        points = []
+        for i in range(500):
+            step = 0.05 if i % 97 == 0 else 0.001
+            lat += random.uniform(-step, step)
+            lon += random.uniform(-step, step)
+            points.append(SimplePoint(lat, lon))
+        index = SegmentIndex(points)
+        for _ in range(50):
+            p = SimplePoint(random.uniform(44.9, 45.1), random.uniform(-0.1, 0.1))
+            istart = random.randint(0, len(points) - 1)
+            dists = [ orthodromic_seg_distance(p, points[i], points[i+1])[0] for i in range(len(points) - 1) ]
+            seen = []
+            last_bound = 0.0
+            for lower_bound, segments in index.segments_by_distance(p, istart):
+                self.assertTrue(lower_bound >= last_bound)
+                last_bound = lower_bound
+                for i in segments:
+                    self.assertTrue(dists[i] >= lower_bound - 1e-6)
+                seen.extend(segments)
+            self.assertTrue(sorted(seen) == list(range(istart, len(points) - 1)))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#    This file is part of Gtfslib-python.
+#
+#    Gtfslib-python is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Gtfslib-python is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with gtfslib-python.  If not, see <http://www.gnu.org/licenses/>.
+"""
+@author: Laurent GRÉGOIRE <laurent.gregoire@mecatran.com>
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from sqlalchemy.orm import clear_mappers
+
+from gtfslib.dao import Dao
+from gtfslib.model import StopTime
+from gtfslib.synthetic import SyntheticGtfs
+
+
+class TestSynthetic(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        clear_mappers()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        unittest.TestCase.tearDown(self)
+
+    def test_synthetic_gtfs(self):
+        gtfs = SyntheticGtfs(n_stops=50, n_routes=4, trips_per_route=9, stops_per_route=6, shape_density=2,
+                             calendar_days=30, frequency_routes=1, n_transfers=5, timepoint_interval=2, seed=42)
+        filename = os.path.join(self.tmpdir, "synthetic.gtfs.zip")
+        nrows = gtfs.write(filename)
+        self.assertEqual(nrows['stops'], 50)
+        self.assertEqual(nrows['routes'], 4)
+        # 3 regular routes, 1 route with a template trip per direction and service
+        self.assertEqual(nrows['trips'], 3 * 9 + 2 * 3)
+        self.assertEqual(nrows['stop_times'], nrows['trips'] * 6)
+        self.assertEqual(nrows['shapes'], 4 * 2 * (5 * 3 + 1))
+        self.assertEqual(nrows['transfers'], 5)
+
+        # Deterministic, to a zip or a directory
+        dirname = os.path.join(self.tmpdir, "synthetic")
+        self.assertEqual(gtfs.write(dirname), nrows)
+        with zipfile.ZipFile(filename) as zf:
+            for table in nrows:
+                with open(os.path.join(dirname, table + ".txt"), 'rb') as f:
+                    self.assertEqual(zf.read(table + ".txt"), f.read())
+
+        dao = Dao()
+        dao.load_gtfs(filename)
+        self.assertEqual(len(list(dao.stops())), 50)
+        self.assertEqual(len(list(dao.routes())), 4)
+        self.assertEqual(len(list(dao.calendars())), 3)
+        self.assertEqual(len(list(dao.shapes())), 8)
+        # Untimed stops are interpolated
+        for stoptime in dao.stoptimes(fltr=StopTime.stop_sequence == 1):
+            self.assertTrue(stoptime.interpolated)
+            self.assertTrue(stoptime.departure_time is not None)
+
+    def test_transfers(self):
+        # 2x2 grid: 8 possible transfers, between neighbors, each pair at most once
+        gtfs = SyntheticGtfs(n_stops=4, n_routes=1, trips_per_route=2, stops_per_route=2, n_transfers=100)
+        nrows = gtfs.write(os.path.join(self.tmpdir, "transfers.gtfs.zip"))
+        self.assertEqual(nrows['transfers'], 8)
+
+if __name__ == '__main__':
+    unittest.main()